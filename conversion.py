@@ -1,80 +1,1015 @@
+import argparse
+import csv
+import fnmatch
+import glob
+import hashlib
+import json
+import math
+import os
+import re
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date, datetime, timedelta
+import openpyxl
 import pandas as pd
 import mysql.connector
 from mysql.connector import Error
 
-def create_table(cursor, table_name):
+# Read by the web interface to invalidate cached query results
+VERSION_TABLE = 'table_versions'
+
+# Files, and per source file and date the content digest and natural keys loaded, for incremental loads.
+# load_manifest_dates, keyed per date only, is no longer written.
+MANIFEST_TABLE = 'load_manifest'
+MANIFEST_DATES_TABLE = 'load_manifest_file_dates'
+
+# Natural unique keys, the first one whose columns are all in the sheet is used
+NATURAL_KEYS = [
+    ('Segment', 'Record_Date', 'Time_Block'),
+    ('Segment', 'Record_Date', 'Instrument_Name'),
+    ('Segment', 'Record_Date', 'Record_Hour')
+]
+NATURAL_KEY_NAME = 'uq_natural_key'
+
+# Secondary indexes for the generated query shapes: date-range filters grouped by segment,
+# hour or block. Segment-first lookups are already served by the natural key.
+SECONDARY_INDEXES = [
+    ('idx_date_segment', ('Record_Date', 'Segment')),
+    ('idx_date_hour', ('Record_Date', 'Record_Hour')),
+    ('idx_date_block', ('Record_Date', 'Time_Block'))
+]
+
+# Daily and monthly pre-aggregates kept next to each market table and read by the web interface.
+# Each measure gets sum, non-null count, min and max columns, so averages stay exact.
+ROLLUP_SUFFIXES = ('_daily', '_monthly')
+ROLLUP_MEASURES = [
+    'MCP_Rs_MWh', 'MCP_Rs_MW', 'MCV_MW', 'Final_Scheduled_Volume_MW', 'Purchase_Bid_MW', 'Sell_Bid_MW',
+    'Highest_Price', 'Lowest_Price', 'Average_Price', 'Weighted_Average', 'Total_Traded_Volume_MWh',
+    'No_of_Trades'
+]
+
+# Per-date digests are order-independent sums of row hashes modulo 2**160
+DIGEST_MODULUS = 1 << 160
+
+# Rows per multi-row INSERT and rows per transaction
+INSERT_BATCH_SIZE = 5000
+COMMIT_EVERY = 50000
+
+# Market segment named in a file name -> target table. Green markets are listed first so
+# "gdam" isn't taken for "dam".
+SEGMENT_TABLES = {
+    'gdam': 'energy_bids_gdam',
+    'gtam': 'energy_bids_gtam',
+    'dam': 'energy_bids_dam',
+    'rtm': 'energy_bids_rtm',
+    'tam': 'energy_bids_tam'
+}
+
+INPUT_PATTERNS = ('*.xlsx', '*.xlsm', '*.csv')
+
+# Column types for new tables. Other columns are FLOAT for rollup measures, DATE when the name
+# contains "date" and VARCHAR otherwise.
+COLUMN_TYPES = {
+    'Segment': 'VARCHAR(50)',
+    'Record_Date': 'DATE',
+    'Contract_Type': 'VARCHAR(50)',
+    'Instrument_Name': 'VARCHAR(100)',
+    'Time_Block': 'VARCHAR(50)',
+    'Record_Hour': 'INT',
+    'No_of_Trades': 'INT'
+}
+
+# Formats tried for CSV values in columns whose name contains "date"
+CSV_DATE_FORMATS = ('%Y-%m-%d', '%d-%m-%Y', '%d/%m/%Y', '%Y/%m/%d', '%d-%b-%Y')
+
+DEFAULT_MYSQL_CONFIG = {
+    'host': os.environ.get('MYSQL_HOST', 'localhost'),
+    'user': os.environ.get('MYSQL_USER', 'root'),
+    'password': os.environ.get('MYSQL_PASSWORD', 'password1234'),
+    'database': os.environ.get('MYSQL_DATABASE', 'iexinternetdatacenter'),
+    'port': int(os.environ.get('MYSQL_PORT', 3306))
+}
+
+def month_starts(first_month, last_month):
+    current = first_month.replace(day=1)
+    while current <= last_month:
+        yield current
+        current = (current.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+def month_partitions(first_month, last_month):
+    """One RANGE partition per month plus a catch-all for later dates"""
+    partitions = []
+    for month in month_starts(first_month, last_month):
+        next_month = (month.replace(day=28) + timedelta(days=4)).replace(day=1)
+        partitions.append(f"PARTITION p{month:%Y%m} VALUES LESS THAN (TO_DAYS('{next_month.isoformat()}'))")
+    partitions.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+    return ",\n        ".join(partitions)
+
+def column_type(column):
+    if column in COLUMN_TYPES:
+        return COLUMN_TYPES[column]
+    if column in ROLLUP_MEASURES:
+        return 'FLOAT'
+    return 'DATE' if 'date' in column.lower() else 'VARCHAR(255)'
+
+def create_table(cursor, table_name, columns, partition_months=None):
+    """Create the table for a sheet's columns with its natural key and secondary indexes.
+    
+    partition_months=(first, last) adds monthly RANGE partitions on Record_Date.
+    """
+    definitions = [f"{column} {column_type(column)}" for column in columns]
+    key = natural_key(columns)
+    if key:
+        definitions.append(f"UNIQUE KEY {NATURAL_KEY_NAME} ({', '.join(key)})")
+    definitions.extend(f"KEY {name} ({', '.join(index_columns)})" for name, index_columns in SECONDARY_INDEXES
+                       if all(column in columns for column in index_columns))
+    
+    partition_clause = ""
+    if partition_months and 'Record_Date' in columns:
+        partition_clause = f"""
+    PARTITION BY RANGE (TO_DAYS(Record_Date)) (
+        {month_partitions(*partition_months)}
+    )"""
+    separator = ",\n        "
     create_table_query = f"""
     CREATE TABLE IF NOT EXISTS {table_name} (
+        {separator.join(definitions)}
+    ){partition_clause};
+    """
+    cursor.execute(create_table_query)
+
+def create_manifest_tables(cursor):
+    cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS {MANIFEST_TABLE} (
+        table_name VARCHAR(64) NOT NULL,
+        file_hash CHAR(64) NOT NULL,
+        file_path VARCHAR(512),
+        min_date DATE,
+        max_date DATE,
+        row_count INT,
+        loaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (table_name, file_hash)
+    );
+    """)
+    cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS {MANIFEST_DATES_TABLE} (
+        table_name VARCHAR(64) NOT NULL,
+        source_file VARCHAR(512) NOT NULL,
+        record_date DATE NOT NULL,
+        digest CHAR(40) NOT NULL,
+        row_count INT,
+        natural_keys MEDIUMTEXT,
+        loaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+        PRIMARY KEY (table_name, source_file, record_date),
+        KEY idx_table_date (table_name, record_date)
+    );
+    """)
+
+def create_version_table(cursor):
+    cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS {VERSION_TABLE} (
+        table_name VARCHAR(64) PRIMARY KEY,
+        version BIGINT NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+    );
+    """)
+
+def bump_table_version(cursor, table_name):
+    cursor.execute(
+        f"INSERT INTO {VERSION_TABLE} (table_name, version) VALUES (%s, 1) "
+        f"ON DUPLICATE KEY UPDATE version = version + 1",
+        (table_name.lower(),)
+    )
+
+def rollup_measures(columns):
+    by_name = {column.lower(): column for column in columns}
+    return [by_name[measure.lower()] for measure in ROLLUP_MEASURES if measure.lower() in by_name]
+
+def create_rollup_tables(cursor, table_name, measures):
+    measure_columns = "".join(
+        f"        {m}_sum DOUBLE,\n        {m}_count BIGINT,\n        {m}_min DOUBLE,\n        {m}_max DOUBLE,\n"
+        for m in measures
+    )
+    for suffix in ROLLUP_SUFFIXES:
+        cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS {table_name}{suffix} (
         Segment VARCHAR(50),
         Record_Date DATE,
-        Contract_Type varchar(50),
-        Instrument_Name VARCHAR(100),
-        Highest_Price FLOAT,
-        Lowest_Price FLOAT,
-        Average_Price FLOAT,
-        Weighted_Average FLOAT,
-        Total_Traded_Volume_MWh FLOAT,
-        No_of_Trades INT
+        row_count BIGINT,
+{measure_columns}        UNIQUE KEY uq_rollup (Segment, Record_Date),
+        KEY idx_rollup_date (Record_Date)
     );
+    """)
+
+def refresh_rollups(cursor, table_name, first_date=None, last_date=None):
+    """Recompute the daily rollup for a date range and the monthly rollup for the months it touches.
+    
+    Without a range both are rebuilt from the whole table. The rollups are then stamped with the
+    table's current version, which is how the web interface knows they are up to date.
     """
-    cursor.execute(create_table_query)
+    columns = table_columns(cursor, table_name)
+    measures = rollup_measures(columns)
+    if 'Segment' not in columns or 'Record_Date' not in columns or not measures:
+        return False
+    daily, monthly = (f"{table_name}{suffix}" for suffix in ROLLUP_SUFFIXES)
+    
+    cursor.execute(f"SELECT version FROM {VERSION_TABLE} WHERE table_name = %s", (daily.lower(),))
+    row = cursor.fetchone()
+    if not table_columns(cursor, daily) or (row and row[0] < 0):
+        # New, or invalidated by a failed load, so rows outside this range may be missing or stale
+        first_date = None
+    create_rollup_tables(cursor, table_name, measures)
+    
+    if first_date is None:
+        day_filter = month_filter = " WHERE Record_Date IS NOT NULL"
+        day_params = month_params = ()
+    else:
+        next_month = (last_date.replace(day=28) + timedelta(days=4)).replace(day=1)
+        day_filter = " WHERE Record_Date BETWEEN %s AND %s"
+        month_filter = " WHERE Record_Date >= %s AND Record_Date < %s"
+        day_params = (first_date, last_date)
+        month_params = (first_date.replace(day=1), next_month)
+    
+    rollup_columns = ", ".join(f"{m}_sum, {m}_count, {m}_min, {m}_max" for m in measures)
+    cursor.execute(f"DELETE FROM {daily}{day_filter}", day_params)
+    cursor.execute(
+        f"INSERT INTO {daily} (Segment, Record_Date, row_count, {rollup_columns}) "
+        f"SELECT Segment, Record_Date, COUNT(*), "
+        f"{', '.join(f'SUM({m}), COUNT({m}), MIN({m}), MAX({m})' for m in measures)} "
+        f"FROM {table_name}{day_filter} GROUP BY Segment, Record_Date",
+        day_params
+    )
+    # Months are re-aggregated from the daily rows, Record_Date holds the first day of the month
+    cursor.execute(f"DELETE FROM {monthly}{month_filter}", month_params)
+    cursor.execute(
+        f"INSERT INTO {monthly} (Segment, Record_Date, row_count, {rollup_columns}) "
+        f"SELECT Segment, DATE_SUB(Record_Date, INTERVAL DAYOFMONTH(Record_Date) - 1 DAY) AS month_start, "
+        f"SUM(row_count), "
+        f"{', '.join(f'SUM({m}_sum), SUM({m}_count), MIN({m}_min), MAX({m}_max)' for m in measures)} "
+        f"FROM {daily}{month_filter} GROUP BY Segment, month_start",
+        month_params
+    )
+    
+    cursor.execute(f"SELECT version FROM {VERSION_TABLE} WHERE table_name = %s", (table_name.lower(),))
+    row = cursor.fetchone()
+    version = row[0] if row else 0
+    cursor.executemany(
+        f"INSERT INTO {VERSION_TABLE} (table_name, version) VALUES (%s, %s) "
+        f"ON DUPLICATE KEY UPDATE version = VALUES(version)",
+        [(rollup.lower(), version) for rollup in (daily, monthly)]
+    )
+    return True
+
+def stamp_rollups(cursor, table_name):
+    """Mark existing, valid rollups current after a load that wrote no dated rows"""
+    cursor.execute(
+        f"UPDATE {VERSION_TABLE} r JOIN {VERSION_TABLE} t ON t.table_name = %s "
+        f"SET r.version = t.version WHERE r.table_name IN (%s, %s) AND r.version >= 0",
+        (table_name.lower(), *(f"{table_name}{suffix}".lower() for suffix in ROLLUP_SUFFIXES))
+    )
+
+def invalidate_rollups(cursor, table_name):
+    """Stop queries being routed to the rollups until they are rebuilt in full"""
+    cursor.execute(
+        f"UPDATE {VERSION_TABLE} SET version = -1 WHERE table_name IN (%s, %s)",
+        tuple(f"{table_name}{suffix}".lower() for suffix in ROLLUP_SUFFIXES)
+    )
+
+def track_date_range(batches, date_index, date_range):
+    """Pass batches through, widening date_range = [first, last] with every Record_Date seen"""
+    for batch in batches:
+        dates = [row[date_index] for row in batch if row[date_index] is not None]
+        if dates:
+            first, last = min(dates), max(dates)
+            date_range[0] = first if date_range[0] is None else min(date_range[0], first)
+            date_range[1] = last if date_range[1] is None else max(date_range[1], last)
+        yield batch
+
+def dataframe_to_rows(df):
+    """Convert column-wise: timestamps to dates, NaN/NaT to None, numpy scalars to Python values"""
+    df = df.copy()
+    for col in df.columns:
+        if pd.api.types.is_datetime64_any_dtype(df[col]):
+            df[col] = df[col].dt.date
+    return df.astype(object).where(df.notna(), None).values.tolist()
+
+def read_dataframe(file_path):
+    if file_path.lower().endswith('.csv'):
+        # read_csv leaves dates as strings, parse them like the streaming reader does
+        df = pd.read_csv(file_path)
+        for col in df.columns:
+            if 'date' in str(col).lower():
+                df[col] = [convert_value(value, True) for value in df[col]]
+        return df
+    return pd.read_excel(file_path, engine='openpyxl')
+
+def iter_sheet_rows(file_path):
+    """Yield raw row tuples, header first, without loading the whole file"""
+    if file_path.lower().endswith('.csv'):
+        with open(file_path, newline='', encoding='utf-8-sig') as f:
+            yield from csv.reader(f)
+        return
+    
+    workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        yield from workbook.active.iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+def convert_value(value, is_date):
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    if isinstance(value, str):
+        value = value.strip()
+        if not value:
+            return None
+        if is_date:
+            for fmt in CSV_DATE_FORMATS:
+                try:
+                    return datetime.strptime(value, fmt).date()
+                except ValueError:
+                    continue
+    return value
+
+def as_date(value):
+    """A Record_Date as a date, or None if it isn't one"""
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, str):
+        value = convert_value(value, True)
+    return value if isinstance(value, date) else None
+
+def read_row_batches(file_path, batch_size=INSERT_BATCH_SIZE):
+    """Return (columns, batches): the header and a generator of typed row lists of at most batch_size.
+    
+    Rows are read lazily (openpyxl read-only mode or csv.reader), so memory stays flat
+    however large the file is.
+    """
+    rows = iter_sheet_rows(file_path)
+    header = next(rows, None)
+    if header is None:
+        raise ValueError(f"'{file_path}' is empty")
+    
+    # Ignore unnamed columns, e.g. formatting that spills past the table
+    keep = [i for i, name in enumerate(header) if name is not None and str(name).strip()]
+    columns = [str(header[i]).strip() for i in keep]
+    is_date = [('date' in name.lower()) for name in columns]
+    
+    def batches():
+        batch = []
+        for row in rows:
+            values = tuple(convert_value(row[i] if i < len(row) else None, date_col)
+                           for i, date_col in zip(keep, is_date))
+            if all(value is None for value in values):
+                continue
+            batch.append(values)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    
+    return columns, batches()
+
+def chunked(rows, size):
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+def insert_batches(connection, cursor, insert_query, batches, commit_every=COMMIT_EVERY):
+    """Insert batch by batch, executemany turns each batch into one multi-row INSERT"""
+    inserted = 0
+    uncommitted = 0
+    for chunk in batches:
+        cursor.executemany(insert_query, chunk)
+        inserted += len(chunk)
+        uncommitted += len(chunk)
+        if uncommitted >= commit_every:
+            connection.commit()
+            uncommitted = 0
+    return inserted
+
+def file_sha256(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def manifest_has_file(cursor, table_name, file_hash):
+    cursor.execute(
+        f"SELECT 1 FROM {MANIFEST_TABLE} WHERE table_name = %s AND file_hash = %s",
+        (table_name.lower(), file_hash)
+    )
+    return cursor.fetchone() is not None
+
+def natural_key(columns):
+    for key in NATURAL_KEYS:
+        if all(column in columns for column in key):
+            return key
+    return None
+
+def duplicate_key_count(cursor, table_name, key):
+    """Number of natural key values held by more than one row"""
+    cursor.execute(
+        f"SELECT COUNT(*) FROM (SELECT 1 FROM {table_name} GROUP BY {', '.join(key)} HAVING COUNT(*) > 1) d"
+    )
+    return cursor.fetchone()[0]
+
+def dedupe_table(cursor, table_name, key):
+    """Rebuild the table with the unique key, keeping one row per natural key value.
+    
+    The rows go into a keyed copy with INSERT IGNORE, which is then swapped in atomically.
+    """
+    copy, old = f"{table_name}_dedupe", f"{table_name}_duplicates"
+    cursor.execute(f"DROP TABLE IF EXISTS {copy}")
+    cursor.execute(f"CREATE TABLE {copy} LIKE {table_name}")
+    cursor.execute(f"ALTER TABLE {copy} ADD UNIQUE KEY {NATURAL_KEY_NAME} ({', '.join(key)})")
+    cursor.execute(f"INSERT IGNORE INTO {copy} SELECT * FROM {table_name}")
+    kept = cursor.rowcount
+    cursor.execute(f"RENAME TABLE {table_name} TO {old}, {copy} TO {table_name}")
+    cursor.execute(f"DROP TABLE {old}")
+    return kept
+
+def ensure_natural_key(cursor, table_name, key, dedupe=False):
+    """Add the unique key to tables created before it existed, returns True if rows were removed.
+    
+    Duplicate rows block the key: with dedupe the table is rebuilt keeping one row per key,
+    otherwise ValueError points at migrate.
+    """
+    cursor.execute(
+        "SELECT COUNT(*) FROM information_schema.STATISTICS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = %s",
+        (table_name, NATURAL_KEY_NAME)
+    )
+    if cursor.fetchone()[0] != 0:
+        return False
+    duplicates = duplicate_key_count(cursor, table_name, key)
+    if duplicates and not dedupe:
+        raise ValueError(f"'{table_name}' has no unique key on ({', '.join(key)}) and {duplicates} key value(s) "
+                         f"with duplicate rows, run 'python conversion.py migrate {table_name}' first")
+    if duplicates:
+        print(f"Removing duplicate rows for {duplicates} key value(s) from '{table_name}'...")
+        kept = dedupe_table(cursor, table_name, key)
+        print(f"Rebuilt '{table_name}' with unique key ({', '.join(key)}), {kept} rows kept.")
+        return True
+    print(f"Adding unique key ({', '.join(key)}) to '{table_name}'...")
+    cursor.execute(f"ALTER TABLE {table_name} ADD UNIQUE KEY {NATURAL_KEY_NAME} ({', '.join(key)})")
+    return False
+
+def table_columns(cursor, table_name):
+    cursor.execute(
+        "SELECT COLUMN_NAME FROM information_schema.COLUMNS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s ORDER BY ORDINAL_POSITION",
+        (table_name,)
+    )
+    return [name for (name,) in cursor.fetchall()]
+
+def table_partitions(cursor, table_name):
+    cursor.execute(
+        "SELECT PARTITION_NAME FROM information_schema.PARTITIONS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL",
+        (table_name,)
+    )
+    return {name for (name,) in cursor.fetchall()}
+
+def add_secondary_indexes(cursor, table_name, columns):
+    cursor.execute(
+        "SELECT DISTINCT INDEX_NAME FROM information_schema.STATISTICS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+        (table_name,)
+    )
+    existing = {name for (name,) in cursor.fetchall()}
+    missing = [(name, index_columns) for name, index_columns in SECONDARY_INDEXES
+               if name not in existing and all(column in columns for column in index_columns)]
+    if missing:
+        # One ALTER so the table is rebuilt once
+        additions = ", ".join(f"ADD KEY {name} ({', '.join(index_columns)})" for name, index_columns in missing)
+        print(f"Adding {', '.join(name for name, _ in missing)} to '{table_name}'...")
+        cursor.execute(f"ALTER TABLE {table_name} {additions}")
 
-def excel_to_mysql_with_create(file_path, mysql_config, table_name):
+def partition_table(cursor, table_name, first_month, last_month):
+    """Partition by month on Record_Date, or split new months out of pmax if already partitioned"""
+    existing = table_partitions(cursor, table_name)
+    if not existing:
+        print(f"Partitioning '{table_name}' by month from {first_month:%Y-%m} to {last_month:%Y-%m}...")
+        cursor.execute(
+            f"ALTER TABLE {table_name} PARTITION BY RANGE (TO_DAYS(Record_Date)) "
+            f"({month_partitions(first_month, last_month)})"
+        )
+        return
+    
+    new_months = [month for month in month_starts(first_month, last_month) if f"p{month:%Y%m}" not in existing]
+    latest = max((name for name in existing if name != 'pmax'), default=None)
+    # REORGANIZE can only split pmax, so only months after the last existing partition qualify
+    new_months = [month for month in new_months if latest is None or f"p{month:%Y%m}" > latest]
+    if new_months and 'pmax' in existing:
+        print(f"Adding {len(new_months)} monthly partition(s) to '{table_name}'...")
+        cursor.execute(
+            f"ALTER TABLE {table_name} REORGANIZE PARTITION pmax INTO "
+            f"({month_partitions(new_months[0], new_months[-1])})"
+        )
+
+def date_digests(batches, date_index, key_indexes=()):
+    """Content digest, row count and natural keys per Record_Date, independent of row order.
+    
+    Keys are JSON arrays of the key columns at key_indexes, Record_Date left out.
+    """
+    sums = {}
+    counts = {}
+    keys = {}
+    for batch in batches:
+        for row in batch:
+            record_date = row[date_index]
+            if record_date is None:
+                continue
+            row_hash = int.from_bytes(hashlib.sha1(repr(row).encode('utf-8')).digest(), 'big')
+            sums[record_date] = (sums.get(record_date, 0) + row_hash) % DIGEST_MODULUS
+            counts[record_date] = counts.get(record_date, 0) + 1
+            keys.setdefault(record_date, set()).add(json.dumps([row[i] for i in key_indexes], default=str))
+    return {record_date: format(total, '040x') for record_date, total in sums.items()}, counts, keys
+
+def insert_statement(table_name, columns):
+    """Multi-row INSERT that overwrites rows with the same natural key, so a re-load replaces them"""
+    cols = ", ".join(columns)
+    placeholders = ", ".join(["%s"] * len(columns))
+    query = f"INSERT INTO {table_name} ({cols}) VALUES ({placeholders})"
+    key = natural_key(columns)
+    if key is None:
+        return query
+    updates = ", ".join(f"{column} = VALUES({column})" for column in columns if column not in key)
+    return f"{query} ON DUPLICATE KEY UPDATE {updates or f'{key[0]} = {key[0]}'}"
+
+def manifest_date_keys(cursor, table_name, source_file, other_sources=False, dates=None):
+    """{record_date: (digest, natural keys)} loaded from source_file, or from every other file"""
+    query = (f"SELECT record_date, digest, natural_keys FROM {MANIFEST_DATES_TABLE} "
+             f"WHERE table_name = %s AND source_file {'<>' if other_sources else '='} %s")
+    params = [table_name.lower(), source_file]
+    if dates is not None:
+        query += f" AND record_date IN ({', '.join(['%s'] * len(dates))})"
+        params.extend(dates)
+    cursor.execute(query, tuple(params))
+    known = {}
+    for record_date, digest, natural_keys in cursor.fetchall():
+        keys = set(json.loads(natural_keys)) if natural_keys else set()
+        if record_date in known:
+            keys |= known[record_date][1]
+        known[record_date] = (digest, keys)
+    return known
+
+def upsert_changed_dates(connection, cursor, table_name, columns, batch_source, source_file,
+                         commit_every=COMMIT_EVERY):
+    """Upsert the rows of dates whose content in source_file differs from its previous load.
+    
+    batch_source() must return a fresh iterator of row batches; it is read twice, once to
+    digest each date and once to write the changed ones. Rows only ever change through their
+    natural key, so files that overlap on a date leave each other's rows alone. Keys that
+    source_file loaded before but no longer has are deleted, unless another file loaded them
+    too. Returns (rows_written, changed_dates).
+    """
+    key = natural_key(columns)
+    if key is None or 'Record_Date' not in columns:
+        raise ValueError(f"Incremental load needs one of the natural keys {NATURAL_KEYS}, got {columns}")
+    ensure_natural_key(cursor, table_name, key)
+    date_index = columns.index('Record_Date')
+    key_columns = [column for column in key if column != 'Record_Date']
+    
+    digests, counts, keys = date_digests(batch_source(), date_index, [columns.index(c) for c in key_columns])
+    known = manifest_date_keys(cursor, table_name, source_file)
+    changed = {record_date for record_date, digest in digests.items()
+               if record_date not in known or known[record_date][0] != digest}
+    dropped = sorted(record_date for record_date in known if record_date not in digests)
+    if not changed and not dropped:
+        return 0, []
+    
+    changed_batches = ([row for row in batch if row[date_index] in changed] for batch in batch_source())
+    written = insert_batches(connection, cursor, insert_statement(table_name, columns),
+                             (batch for batch in changed_batches if batch), commit_every)
+    
+    vanished = {record_date: known[record_date][1] - keys.get(record_date, set())
+                for record_date in sorted(changed | set(dropped)) if record_date in known}
+    vanished = {record_date: gone for record_date, gone in vanished.items() if gone}
+    if vanished:
+        others = manifest_date_keys(cursor, table_name, source_file, other_sources=True, dates=sorted(vanished))
+        conditions = " AND ".join(f"{column} = %s" for column in ['Record_Date'] + key_columns)
+        cursor.executemany(
+            f"DELETE FROM {table_name} WHERE {conditions}",
+            [(record_date, *json.loads(natural_key_value))
+             for record_date, gone in vanished.items()
+             for natural_key_value in sorted(gone - others.get(record_date, (None, set()))[1])]
+        )
+    
+    cursor.executemany(
+        f"INSERT INTO {MANIFEST_DATES_TABLE} "
+        f"(table_name, source_file, record_date, digest, row_count, natural_keys) "
+        f"VALUES (%s, %s, %s, %s, %s, %s) "
+        f"ON DUPLICATE KEY UPDATE digest = VALUES(digest), row_count = VALUES(row_count), "
+        f"natural_keys = VALUES(natural_keys)",
+        [(table_name.lower(), source_file, record_date, digests[record_date], counts[record_date],
+          json.dumps(sorted(keys[record_date]))) for record_date in sorted(changed)]
+    )
+    if dropped:
+        cursor.executemany(
+            f"DELETE FROM {MANIFEST_DATES_TABLE} WHERE table_name = %s AND source_file = %s AND record_date = %s",
+            [(table_name.lower(), source_file, record_date) for record_date in dropped]
+        )
+    return written, sorted(changed | set(dropped))
+
+def record_manifest(cursor, table_name, file_hash, file_path, dates, row_count):
+    cursor.execute(
+        f"INSERT INTO {MANIFEST_TABLE} (table_name, file_hash, file_path, min_date, max_date, row_count) "
+        f"VALUES (%s, %s, %s, %s, %s, %s) "
+        f"ON DUPLICATE KEY UPDATE file_path = VALUES(file_path), loaded_at = CURRENT_TIMESTAMP",
+        (table_name.lower(), file_hash, os.path.abspath(file_path),
+         min(dates) if dates else None, max(dates) if dates else None, row_count)
+    )
+
+def load_data_infile(cursor, df, table_name):
+    """Bulk load through a temporary CSV, needs local_infile enabled on the server.
+    
+    Rows replace existing ones with the same natural key, like the INSERT path.
+    """
+    with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False, newline='', encoding='utf-8') as tmp:
+        df.to_csv(tmp, index=False, header=False, na_rep='\\N', date_format='%Y-%m-%d', lineterminator='\n')
     try:
-        # Read Excel file
-        df = pd.read_excel(file_path, engine='openpyxl')
+        cols = ", ".join(df.columns)
+        cursor.execute(
+            f"LOAD DATA LOCAL INFILE %s REPLACE INTO TABLE {table_name} "
+            f"FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '\"' "
+            f"LINES TERMINATED BY '\\n' ({cols})",
+            (tmp.name,)
+        )
+        return cursor.rowcount
+    finally:
+        os.remove(tmp.name)
+
+def excel_to_mysql_with_create(file_path, mysql_config, table_name, use_infile=False, stream=False,
+                               incremental=False, batch_size=INSERT_BATCH_SIZE, commit_every=COMMIT_EVERY,
+                               partition_months=None):
+    connection = None
+    cursor = None
+    inserted = 0
+    writing = False
+    loaded = False
+    try:
+        started = time.perf_counter()
         
         # Connect to MySQL
-        connection = mysql.connector.connect(**mysql_config)
+        if use_infile:
+            connection = mysql.connector.connect(**mysql_config, allow_local_infile=True)
+        else:
+            connection = mysql.connector.connect(**mysql_config)
         cursor = connection.cursor()
         
-        # Create table
-        create_table(cursor, table_name)
+        create_version_table(cursor)
+        if incremental:
+            create_manifest_tables(cursor)
+            file_hash = file_sha256(file_path)
+            if manifest_has_file(cursor, table_name, file_hash):
+                print(f"'{file_path}' is unchanged since it was loaded into '{table_name}', skipping.")
+                loaded = True
+                return 0
+        
+        # Read the sheet, lazily in streaming mode
+        if stream:
+            columns = read_row_batches(file_path, batch_size)[0]
+            batch_source = lambda: read_row_batches(file_path, batch_size)[1]
+        else:
+            df = read_dataframe(file_path)
+            columns = list(df.columns)
+            if not use_infile:
+                rows = dataframe_to_rows(df)
+                batch_source = lambda: chunked(rows, batch_size)
+        
+        # Create table from the sheet's columns, partitioned by month when it is new and
+        # partition_months is given
+        create_table(cursor, table_name, columns, partition_months)
         print(f"Table '{table_name}' is ready.")
         
-        # Prepare insert query
-        cols = ", ".join(df.columns)
-        placeholders = ", ".join(["%s"] * len(df.columns))
-        insert_query = f"INSERT INTO {table_name} ({cols}) VALUES ({placeholders})"
+        # Upserts only replace rows once the table has its unique key, refuse to add duplicates
+        key = natural_key(columns)
+        if key:
+            ensure_natural_key(cursor, table_name, key)
+        writing = True
         
-        # Convert dataframe rows to tuples, also convert pandas timestamps to python date
-        data = []
-        for row in df.itertuples(index=False):
-            new_row = []
-            for val in row:
-                if pd.isna(val):
-                    new_row.append(None)
-                elif isinstance(val, pd.Timestamp):
-                    new_row.append(val.date())  # Convert to date
-                else:
-                    new_row.append(val)
-            data.append(tuple(new_row))
+        # Dates written by this load, the rollups are recomputed for this range only
+        date_range = [None, None]
+        if use_infile:
+            inserted = load_data_infile(cursor, df, table_name)
+            if 'Record_Date' in df.columns and df['Record_Date'].notna().any():
+                dates = pd.to_datetime(df['Record_Date']).dropna().dt.date
+                date_range = [dates.min(), dates.max()]
+        elif incremental:
+            inserted, changed_dates = upsert_changed_dates(connection, cursor, table_name, columns,
+                                                           batch_source, os.path.abspath(file_path), commit_every)
+            record_manifest(cursor, table_name, file_hash, file_path, changed_dates, inserted)
+            print(f"{len(changed_dates)} new or changed date(s) in '{file_path}'.")
+            if changed_dates:
+                date_range = [changed_dates[0], changed_dates[-1]]
+        else:
+            # Prepare insert query, an upsert on the natural key so re-loading a file doesn't fail
+            insert_query = insert_statement(table_name, columns)
+            
+            batches = batch_source()
+            if 'Record_Date' in columns:
+                batches = track_date_range(batches, columns.index('Record_Date'), date_range)
+            inserted = insert_batches(connection, cursor, insert_query, batches, commit_every)
         
-        # Insert all data
-        cursor.executemany(insert_query, data)
+        # Bump the table version and refresh the rollups with the last batch
+        bump_table_version(cursor, table_name)
+        first_date, last_date = (as_date(value) for value in date_range)
+        if first_date and last_date:
+            refresh_rollups(cursor, table_name, first_date, last_date)
+        elif date_range[0] is not None:
+            # Dates that didn't parse, so the range is unknown
+            refresh_rollups(cursor, table_name)
+        else:
+            stamp_rollups(cursor, table_name)
         connection.commit()
+        loaded = True
         
-        print(f"Inserted {cursor.rowcount} rows into '{table_name}'.")
+        elapsed = time.perf_counter() - started
+        print(f"Inserted {inserted} rows into '{table_name}' in {elapsed:.2f}s "
+              f"({inserted / elapsed:,.0f} rows/s).")
+        return inserted
     
     except Error as e:
-        print(f"MySQL Error: {e}")
+        print(f"MySQL Error loading '{file_path}': {e}")
     except Exception as ex:
-        print(f"General Error: {ex}")
+        print(f"General Error loading '{file_path}': {ex}")
     finally:
+        if cursor and writing and not loaded:
+            # Earlier chunks may already be committed, make sure cached results don't outlive them
+            try:
+                connection.rollback()
+                bump_table_version(cursor, table_name)
+                invalidate_rollups(cursor, table_name)
+                connection.commit()
+            except Error:
+                pass
         if cursor:
             cursor.close()
         if connection:
             connection.close()
 
-# Example usage
-mysql_config = {
-    'host': 'localhost',
-    'user': 'root',
-    'password': 'password1234',
-    'database': 'iexinternetdatacenter'
-}
+def expand_paths(paths):
+    """Files, directories (their Excel and CSV files) and glob patterns, de-duplicated in order"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            matches = sorted(m for pattern in INPUT_PATTERNS for m in glob.glob(os.path.join(path, pattern)))
+        elif glob.has_magic(path):
+            matches = sorted(glob.glob(path))
+        else:
+            matches = [path]
+        for match in matches:
+            if match not in files:
+                files.append(match)
+    return files
+
+def table_for_file(file_path, mappings, default_table=None):
+    """Pick the target table from --map patterns, then from the segment named in the file name"""
+    name = os.path.basename(file_path)
+    for pattern, table_name in mappings:
+        if fnmatch.fnmatch(name, pattern):
+            return table_name
+    if default_table:
+        return default_table
+    
+    words = set(re.split(r'[^a-z]+', name.lower()))
+    for segment, table_name in SEGMENT_TABLES.items():
+        if segment in words:
+            return table_name
+    return None
+
+def load_file(file_path, table_name, mysql_config, use_infile, stream, incremental, batch_size,
+              partition_months=None):
+    """Worker entry point, each process opens its own connection"""
+    started = time.perf_counter()
+    inserted = excel_to_mysql_with_create(file_path, mysql_config, table_name, use_infile, stream,
+                                          incremental, batch_size, partition_months=partition_months)
+    return inserted, time.perf_counter() - started
+
+def load_table_files(table_name, file_paths, mysql_config, use_infile, stream, incremental, batch_size,
+                     partition_months=None):
+    """Worker entry point for one table: its files are loaded one after another, so no two
+    processes create, upsert into or refresh the rollups of the same table at once.
+    Returns (file_path, inserted, elapsed) per file."""
+    return [(file_path, *load_file(file_path, table_name, mysql_config, use_infile, stream, incremental,
+                                   batch_size, partition_months))
+            for file_path in file_paths]
+
+def add_mysql_arguments(parser):
+    parser.add_argument('--host', default=DEFAULT_MYSQL_CONFIG['host'])
+    parser.add_argument('--port', type=int, default=DEFAULT_MYSQL_CONFIG['port'])
+    parser.add_argument('--user', default=DEFAULT_MYSQL_CONFIG['user'])
+    parser.add_argument('--password', default=DEFAULT_MYSQL_CONFIG['password'])
+    parser.add_argument('--database', default=DEFAULT_MYSQL_CONFIG['database'])
+
+def mysql_config_from_args(args):
+    return {
+        'host': args.host,
+        'port': args.port,
+        'user': args.user,
+        'password': args.password,
+        'database': args.database
+    }
+
+def command_load(args):
+    mysql_config = mysql_config_from_args(args)
+    mappings = []
+    for mapping in args.map:
+        pattern, sep, table_name = mapping.partition('=')
+        if not sep or not table_name:
+            print(f"Invalid --map '{mapping}', expected PATTERN=TABLE")
+            return 2
+        mappings.append((pattern, table_name))
+    
+    jobs = []
+    for file_path in expand_paths(args.paths):
+        table_name = table_for_file(file_path, mappings, args.table)
+        if table_name is None:
+            print(f"Skipping '{file_path}': no table mapping (use --map or --table)")
+            continue
+        jobs.append((file_path, table_name))
+    
+    if not jobs:
+        print("No files to load.")
+        return 1
+    
+    # Files for the same table go to one worker in order, tables load in parallel
+    tables = {}
+    for file_path, table_name in jobs:
+        tables.setdefault(table_name, []).append(file_path)
+    
+    partition_months = partition_range(args)
+    workers = max(1, min(args.jobs, len(tables)))
+    print(f"Loading {len(jobs)} file(s) into {len(tables)} table(s) with {workers} worker(s)...")
+    started = time.perf_counter()
+    failures = 0
+    total_rows = 0
+    done = 0
+    
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(load_table_files, table_name, file_paths, mysql_config, args.infile, args.stream,
+                            args.incremental, args.batch_size, partition_months): table_name
+            for table_name, file_paths in tables.items()
+        }
+        for future in as_completed(futures):
+            table_name = futures[future]
+            try:
+                results = future.result()
+            except Exception as ex:
+                print(f"General Error loading into '{table_name}': {ex}")
+                results = [(file_path, None, 0.0) for file_path in tables[table_name]]
+            
+            for file_path, inserted, elapsed in results:
+                done += 1
+                if inserted is None:
+                    failures += 1
+                    print(f"[{done}/{len(jobs)}] FAILED {file_path} -> {table_name}")
+                else:
+                    total_rows += inserted
+                    print(f"[{done}/{len(jobs)}] {file_path} -> {table_name}: {inserted} rows in {elapsed:.2f}s")
+    
+    elapsed = time.perf_counter() - started
+    print(f"Loaded {total_rows} rows from {len(jobs) - failures}/{len(jobs)} file(s) in {elapsed:.2f}s.")
+    return 1 if failures else 0
+
+def parse_month(value):
+    try:
+        return datetime.strptime(value, '%Y-%m').date()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected YYYY-MM, got '{value}'")
+
+def partition_range(args):
+    """(first, last) month from --partition-from/--partition-to, None without --partition-from"""
+    if not args.partition_from:
+        return None
+    last = args.partition_to or (date.today().replace(day=1) + timedelta(days=366)).replace(day=1)
+    return args.partition_from, last
 
-file_path = 'trainingdat2a.xlsx'
-table_name = 'energy_bids_TAM'
+def add_partition_arguments(parser, help_from):
+    parser.add_argument('--partition-from', type=parse_month, metavar='YYYY-MM', help=help_from)
+    parser.add_argument('--partition-to', type=parse_month, metavar='YYYY-MM',
+                        help="last monthly partition (default: a year from now), later dates go to pmax")
+
+def command_migrate(args):
+    """Bring existing tables up to the current key, index and partition layout"""
+    tables = args.tables or list(dict.fromkeys(SEGMENT_TABLES.values()))
+    partition_months = partition_range(args)
+    
+    connection = None
+    cursor = None
+    failures = 0
+    try:
+        connection = mysql.connector.connect(**mysql_config_from_args(args))
+        cursor = connection.cursor()
+        for table_name in tables:
+            columns = table_columns(cursor, table_name)
+            if not columns:
+                print(f"Skipping '{table_name}': table does not exist.")
+                continue
+            try:
+                key = natural_key(columns)
+                if key and ensure_natural_key(cursor, table_name, key, dedupe=True):
+                    # Rows were removed, so cached results and the rollups are stale
+                    create_version_table(cursor)
+                    bump_table_version(cursor, table_name)
+                    refresh_rollups(cursor, table_name)
+                    connection.commit()
+                add_secondary_indexes(cursor, table_name, columns)
+                if partition_months:
+                    partition_table(cursor, table_name, *partition_months)
+                print(f"Table '{table_name}' is up to date.")
+            except Error as e:
+                failures += 1
+                print(f"MySQL Error migrating '{table_name}': {e}")
+    except Error as e:
+        print(f"MySQL Error: {e}")
+        return 1
+    finally:
+        if cursor:
+            cursor.close()
+        if connection:
+            connection.close()
+    return 1 if failures else 0
+
+def command_rollup(args):
+    """Rebuild the daily and monthly rollups from scratch, e.g. for data loaded before they existed"""
+    tables = args.tables or list(dict.fromkeys(SEGMENT_TABLES.values()))
+    connection = None
+    cursor = None
+    failures = 0
+    try:
+        connection = mysql.connector.connect(**mysql_config_from_args(args))
+        cursor = connection.cursor()
+        create_version_table(cursor)
+        for table_name in tables:
+            started = time.perf_counter()
+            try:
+                if not refresh_rollups(cursor, table_name):
+                    print(f"Skipping '{table_name}': missing table, Segment/Record_Date or measure columns.")
+                    continue
+                connection.commit()
+                print(f"Rebuilt rollups for '{table_name}' in {time.perf_counter() - started:.2f}s.")
+            except Error as e:
+                failures += 1
+                connection.rollback()
+                print(f"MySQL Error rebuilding rollups for '{table_name}': {e}")
+    except Error as e:
+        print(f"MySQL Error: {e}")
+        return 1
+    finally:
+        if cursor:
+            cursor.close()
+        if connection:
+            connection.close()
+    return 1 if failures else 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load IEX market data sheets into MySQL")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    
+    load = subparsers.add_parser('load', help="load Excel/CSV sheets, several tables in parallel")
+    load.add_argument('paths', nargs='+', help="Excel/CSV files, directories or glob patterns")
+    load.add_argument('--map', action='append', default=[], metavar='PATTERN=TABLE',
+                      help="load files whose name matches PATTERN into TABLE (repeatable)")
+    load.add_argument('--table', help="load every file into this table")
+    load.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1,
+                      help="maximum number of tables loaded at once (default: CPU count)")
+    mode = load.add_mutually_exclusive_group()
+    mode.add_argument('--infile', action='store_true', help="bulk load with LOAD DATA LOCAL INFILE")
+    mode.add_argument('--stream', action='store_true',
+                      help="read rows lazily in batches, memory stays flat for any file size")
+    load.add_argument('--incremental', action='store_true',
+                      help="skip files already loaded and upsert only new or changed dates")
+    load.add_argument('--batch-size', type=int, default=INSERT_BATCH_SIZE, help="rows per INSERT batch")
+    add_partition_arguments(load, "create new tables partitioned by month on Record_Date from this month")
+    add_mysql_arguments(load)
+    load.set_defaults(func=command_load)
+    
+    migrate = subparsers.add_parser('migrate', help="add keys, indexes and partitions to existing tables")
+    migrate.add_argument('tables', nargs='*', help="tables to migrate (default: all market tables)")
+    add_partition_arguments(migrate, "partition by month on Record_Date starting at this month")
+    add_mysql_arguments(migrate)
+    migrate.set_defaults(func=command_migrate)
+    
+    rollup = subparsers.add_parser('rollup', help="rebuild the daily and monthly rollup tables")
+    rollup.add_argument('tables', nargs='*', help="market tables to roll up (default: all market tables)")
+    add_mysql_arguments(rollup)
+    rollup.set_defaults(func=command_rollup)
+    
+    args = parser.parse_args(argv)
+    if getattr(args, 'incremental', False) and args.infile:
+        parser.error("--incremental can't be combined with --infile")
+    return args.func(args)
 
-excel_to_mysql_with_create(file_path, mysql_config, table_name)
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,23 @@
+"""Production server: gunicorn -c gunicorn.conf.py wsgi:app
+
+The app is loaded once in the master, which builds the schema snapshot and then forks the
+workers. Each worker opens its own MySQL and LLM connections after the fork, and all of
+them share the SQL and result caches through one SQLite file.
+"""
+import multiprocessing
+import os
+
+os.environ.setdefault('ENERGY_ASSISTANT_DEFER_STARTUP', '1')
+os.environ.setdefault('ENERGY_ASSISTANT_CACHE_PATH', 'energy_assistant_cache.sqlite3')
+
+bind = os.environ.get('ENERGY_ASSISTANT_BIND', '127.0.0.1:5000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = 4        # overlap a few LLM and MySQL waits inside each worker
+timeout = 120      # streamed results and SQL repairs can outlast the 30 s default
+preload_app = True
+
+
+def post_fork(server, worker):
+    import webinterface2
+    webinterface2.app_post_fork()
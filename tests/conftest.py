@@ -0,0 +1,70 @@
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# Import the app without connecting to MySQL or starting the background threads
+os.environ.setdefault('ENERGY_ASSISTANT_DEFER_STARTUP', '1')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class StubLLMServer:
+    """OpenAI-style model server on a local port; delay and status can be changed mid-test"""
+    
+    def __init__(self, name):
+        self.name = name
+        self.delay = 0.0
+        self.status = 200
+        self.hits = 0
+        self.lock = threading.Lock()
+        server = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.reply({'data': [{'id': 'stub'}]})
+            
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                with server.lock:
+                    server.hits += 1
+                time.sleep(server.delay)
+                self.reply({'choices': [{'index': 0, 'message': {'content': f"SELECT '{server.name}';"}}]})
+            
+            def reply(self, body):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(server.status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            
+            def log_message(self, format, *args):
+                pass
+        
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+    
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def llm_servers():
+    """Factory for stub model servers, all shut down after the test"""
+    servers = []
+    
+    def start(count):
+        for _ in range(count):
+            servers.append(StubLLMServer(f"backend{len(servers)}"))
+        return servers[-count:]
+    
+    yield start
+    for server in servers:
+        server.close()
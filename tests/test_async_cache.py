@@ -0,0 +1,40 @@
+import asyncio
+import threading
+
+import webinterface2
+import webinterface_async
+from webinterface_async import cache_call
+
+
+def test_shared_cache_calls_run_off_the_event_loop(monkeypatch):
+    monkeypatch.setitem(webinterface2.SHARED_CACHE_CONFIG, 'path', '/tmp/cache.sqlite3')
+    
+    assert asyncio.run(cache_call(threading.get_ident)) != threading.get_ident()
+
+
+def test_in_process_cache_calls_stay_on_the_event_loop(monkeypatch):
+    monkeypatch.setitem(webinterface2.SHARED_CACHE_CONFIG, 'path', None)
+    
+    assert asyncio.run(cache_call(threading.get_ident)) == threading.get_ident()
+
+
+def test_llm_cache_miss_is_stored_through_cache_call(monkeypatch):
+    calls = []
+    
+    async def cache_call(function, *args):
+        calls.append(function.__name__)
+        return function(*args)
+    
+    async def llm_request(path, payload, timeout):
+        return {'choices': [{'message': {'content': 'SELECT 1;'}}]}
+    
+    monkeypatch.setattr(webinterface_async, 'cache_call', cache_call)
+    monkeypatch.setattr(webinterface_async, 'llm_request', llm_request)
+    def sql_cache_store(key, sql):
+        pass
+    
+    monkeypatch.setattr(webinterface_async, 'sql_cache_store', sql_cache_store)
+    snapshot = {'fingerprint': 'test', 'text': '', 'tables': {}}
+    
+    assert asyncio.run(webinterface_async.llm_generate_sql('one', snapshot, 'key')) == 'SELECT 1;'
+    assert calls == ['sql_cache_store']
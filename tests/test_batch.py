@@ -0,0 +1,39 @@
+import pytest
+
+import webinterface2
+from webinterface2 import process_batch
+
+
+@pytest.fixture
+def batch_backend(monkeypatch):
+    """Every question is answered by a template; 'broken' questions fail at execution"""
+    monkeypatch.setattr(webinterface2, 'db_get_schema_snapshot', lambda: {'fingerprint': 'test', 'tables': {}})
+    monkeypatch.setattr(webinterface2, 'template_lookup',
+                        lambda natural_query, snapshot: (f"SELECT '{natural_query}';", 'test'))
+    
+    def execute_with_repair(natural_query, sql_query, run, cacheable=True):
+        if 'broken' in natural_query:
+            raise RuntimeError("Timed out waiting for a database connection")
+        results = {'success': True, 'columns': ['q'], 'rows': [[natural_query]], 'row_count': 1}
+        return sql_query, sql_query, results, None
+    monkeypatch.setattr(webinterface2, 'execute_with_repair', execute_with_repair)
+
+
+def test_execution_errors_are_reported_per_question(batch_backend):
+    batch = process_batch(['prices', 'broken query', 'volumes'])
+    
+    prices, broken, volumes = batch['results']
+    assert prices['results']['rows'] == [['prices']]
+    assert volumes['results']['rows'] == [['volumes']]
+    assert broken['success'] is False
+    assert broken['error'] == "Timed out waiting for a database connection"
+    assert 'total_ms' in broken['timings']
+
+
+def test_duplicates_are_answered_once(batch_backend):
+    batch = process_batch(['prices', 'prices', ''])
+    
+    first, duplicate, empty = batch['results']
+    assert batch['unique_count'] == 2 and batch['llm_count'] == 0
+    assert duplicate['duplicate_of'] == 0 and duplicate['results'] == first['results']
+    assert empty['success'] is False
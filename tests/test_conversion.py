@@ -0,0 +1,197 @@
+from concurrent.futures import Future
+from datetime import date
+
+import pytest
+
+pytest.importorskip('pandas')
+pytest.importorskip('openpyxl')
+pytest.importorskip('mysql.connector')
+
+import conversion
+from conversion import month_partitions, partition_range
+
+
+def test_month_partitions_cover_each_month_and_later_dates():
+    partitions = month_partitions(date(2023, 11, 15), date(2024, 2, 1)).split(",\n        ")
+    
+    assert partitions == [
+        "PARTITION p202311 VALUES LESS THAN (TO_DAYS('2023-12-01'))",
+        "PARTITION p202312 VALUES LESS THAN (TO_DAYS('2024-01-01'))",
+        "PARTITION p202401 VALUES LESS THAN (TO_DAYS('2024-02-01'))",
+        "PARTITION p202402 VALUES LESS THAN (TO_DAYS('2024-03-01'))",
+        "PARTITION pmax VALUES LESS THAN MAXVALUE"
+    ]
+
+
+class Cursor:
+    def __init__(self):
+        self.statements = []
+    
+    def execute(self, statement, params=()):
+        self.statements.append(statement)
+
+
+DAM_COLUMNS = ['Segment', 'Record_Date', 'Time_Block', 'Record_Hour', 'Purchase_Bid_MW', 'MCP_Rs_MWh']
+TAM_COLUMNS = ['Segment', 'Record_Date', 'Contract_Type', 'Instrument_Name', 'Average_Price', 'No_of_Trades']
+
+
+def test_create_table_partitions_only_when_asked():
+    cursor = Cursor()
+    conversion.create_table(cursor, 'energy_bids_dam', DAM_COLUMNS)
+    conversion.create_table(cursor, 'energy_bids_rtm', DAM_COLUMNS, (date(2024, 1, 1), date(2024, 1, 1)))
+    
+    plain, partitioned = cursor.statements
+    assert 'PARTITION' not in plain
+    assert 'PARTITION BY RANGE (TO_DAYS(Record_Date))' in partitioned and 'p202401' in partitioned
+
+
+def test_create_table_follows_the_sheet_columns():
+    cursor = Cursor()
+    conversion.create_table(cursor, 'energy_bids_dam', DAM_COLUMNS)
+    conversion.create_table(cursor, 'energy_bids_tam', TAM_COLUMNS)
+    
+    dam, tam = (' '.join(statement.split()) for statement in cursor.statements)
+    assert 'Time_Block VARCHAR(50), Record_Hour INT, Purchase_Bid_MW FLOAT, MCP_Rs_MWh FLOAT' in dam
+    assert 'UNIQUE KEY uq_natural_key (Segment, Record_Date, Time_Block)' in dam
+    assert ('KEY idx_date_segment (Record_Date, Segment), KEY idx_date_hour (Record_Date, Record_Hour), '
+            'KEY idx_date_block (Record_Date, Time_Block)') in dam
+    assert 'Instrument_Name' not in dam
+    assert 'UNIQUE KEY uq_natural_key (Segment, Record_Date, Instrument_Name)' in tam
+    assert 'idx_date_hour' not in tam and 'Contract_Type VARCHAR(50)' in tam
+
+
+def test_load_accepts_partition_months(monkeypatch):
+    seen = {}
+    monkeypatch.setattr(conversion, 'command_load', lambda args: seen.setdefault('months', partition_range(args)) and 0)
+    
+    conversion.main(['load', 'dam.xlsx', '--partition-from', '2024-01', '--partition-to', '2024-06'])
+    
+    assert seen['months'] == (date(2024, 1, 1), date(2024, 6, 1))
+
+
+class FakeDatabase:
+    """Just enough of MySQL for upsert_changed_dates: one keyed market table and the date manifest"""
+    
+    def __init__(self):
+        self.rows = {}       # (Record_Date, Segment, Time_Block) -> MCP_Rs_MWh
+        self.manifest = {}   # (source_file, record_date) -> (digest, natural_keys)
+        self.result = []
+    
+    def commit(self):
+        pass
+    
+    def execute(self, statement, params=()):
+        if 'information_schema.STATISTICS' in statement:
+            self.result = [(1,)]
+        elif statement.startswith('SELECT record_date'):
+            table_name, source_file, *dates = params
+            other = '<>' in statement
+            self.result = [(record_date, digest, keys) for (source, record_date), (digest, keys) in self.manifest.items()
+                           if (source != source_file if other else source == source_file)
+                           and (not dates or record_date in dates)]
+    
+    def executemany(self, statement, rows):
+        for row in rows:
+            if statement.startswith('INSERT INTO energy_bids_dam'):
+                self.rows[row[:3]] = row[3]
+            elif statement.startswith('DELETE FROM energy_bids_dam'):
+                self.rows.pop(row, None)
+            elif statement.startswith('INSERT INTO load_manifest_file_dates'):
+                self.manifest[row[1], row[2]] = (row[3], row[5])
+            elif statement.startswith('DELETE FROM load_manifest_file_dates'):
+                self.manifest.pop(row[1:], None)
+    
+    def fetchall(self):
+        return self.result
+    
+    def fetchone(self):
+        return self.result[0]
+    
+    def load(self, source_file, rows):
+        columns = ['Record_Date', 'Segment', 'Time_Block', 'MCP_Rs_MWh']
+        return conversion.upsert_changed_dates(self, self, 'energy_bids_dam', columns, lambda: [rows], source_file)
+
+
+DAY = date(2024, 1, 1)
+
+
+def test_incremental_loads_only_touch_the_rows_of_their_own_file():
+    db = FakeDatabase()
+    db.load('a.csv', [(DAY, 'DAM', 1, 10.0), (DAY, 'DAM', 2, 20.0)])
+    db.load('b.csv', [(DAY, 'DAM', 2, 21.0), (DAY, 'DAM', 3, 30.0)])
+    
+    # a.csv no longer has block 2, which b.csv also loaded, and changes block 1
+    written, changed = db.load('a.csv', [(DAY, 'DAM', 1, 11.0)])
+    
+    assert (written, changed) == (1, [DAY])
+    assert db.rows == {(DAY, 'DAM', 1): 11.0, (DAY, 'DAM', 2): 21.0, (DAY, 'DAM', 3): 30.0}
+
+
+def test_rows_and_dates_dropped_from_a_file_are_deleted():
+    db = FakeDatabase()
+    later = date(2024, 1, 2)
+    db.load('a.csv', [(DAY, 'DAM', 1, 10.0), (DAY, 'DAM', 2, 20.0), (later, 'DAM', 1, 12.0)])
+    
+    assert db.load('a.csv', [(DAY, 'DAM', 1, 10.0), (DAY, 'DAM', 2, 20.0), (later, 'DAM', 1, 12.0)]) == (0, [])
+    written, changed = db.load('a.csv', [(DAY, 'DAM', 1, 10.0)])
+    
+    assert (written, changed) == (1, [DAY, later])
+    assert db.rows == {(DAY, 'DAM', 1): 10.0}
+    assert list(db.manifest) == [('a.csv', DAY)]
+
+
+class KeyCursor(Cursor):
+    """information_schema says the unique key is missing, the duplicate count is given"""
+    
+    def __init__(self, duplicates):
+        super().__init__()
+        self.results = [(0,), (duplicates,)]
+        self.rowcount = 90
+    
+    def fetchone(self):
+        return self.results.pop(0)
+
+
+def test_missing_key_is_added_when_there_are_no_duplicates():
+    cursor = KeyCursor(0)
+    
+    assert conversion.ensure_natural_key(cursor, 'energy_bids_dam', ('Segment', 'Record_Date', 'Time_Block')) is False
+    assert cursor.statements[-1] == ("ALTER TABLE energy_bids_dam ADD UNIQUE KEY uq_natural_key "
+                                     "(Segment, Record_Date, Time_Block)")
+
+
+def test_duplicates_block_loads_and_are_removed_by_migrate():
+    key = ('Segment', 'Record_Date', 'Time_Block')
+    with pytest.raises(ValueError, match='migrate energy_bids_dam'):
+        conversion.ensure_natural_key(KeyCursor(10), 'energy_bids_dam', key)
+    
+    cursor = KeyCursor(10)
+    assert conversion.ensure_natural_key(cursor, 'energy_bids_dam', key, dedupe=True) is True
+    assert "INSERT IGNORE INTO energy_bids_dam_dedupe SELECT * FROM energy_bids_dam" in cursor.statements
+    assert ("RENAME TABLE energy_bids_dam TO energy_bids_dam_duplicates, energy_bids_dam_dedupe TO energy_bids_dam"
+            in cursor.statements)
+
+
+def test_files_for_one_table_load_in_order_in_one_worker(monkeypatch):
+    calls = []
+    
+    class Executor:
+        def __init__(self, max_workers):
+            calls.append(('workers', max_workers))
+        
+        def __enter__(self):
+            return self
+        
+        def __exit__(self, *exc_info):
+            return False
+        
+        def submit(self, function, table_name, file_paths, *args):
+            calls.append((table_name, file_paths))
+            future = Future()
+            future.set_result([(file_path, 1, 0.0) for file_path in file_paths])
+            return future
+    
+    monkeypatch.setattr(conversion, 'ProcessPoolExecutor', Executor)
+    
+    assert conversion.main(['load', 'dam_2.csv', 'rtm_1.csv', 'dam_1.csv', '--jobs', '8']) == 0
+    assert calls == [('workers', 2), ('energy_bids_dam', ['dam_2.csv', 'dam_1.csv']), ('energy_bids_rtm', ['rtm_1.csv'])]
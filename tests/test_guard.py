@@ -0,0 +1,64 @@
+import pytest
+
+from webinterface2 import GUARD_CONFIG, QueryRejected, guard_evaluate_plan, guard_prepare
+
+NAMES = ['id', 'select_type', 'table', 'type', 'rows', 'filtered', 'Extra']
+BIG = GUARD_CONFIG['max_estimated_rows'] * 10
+
+
+def step(table, access, rows, filtered=100.0, extra=None, select_id=1):
+    return (select_id, 'SIMPLE', table, access, rows, filtered, extra)
+
+
+def test_limit_is_added_once():
+    sql, limit_added = guard_prepare("SELECT * FROM energy_bids_dam;", 100, None)
+    
+    assert (sql, limit_added) == ("SELECT * FROM energy_bids_dam LIMIT 100", 100)
+    assert guard_prepare(sql, 100, None) == (sql, None)
+
+
+def test_small_plans_pass():
+    assert guard_evaluate_plan("SELECT * FROM energy_bids_dam", NAMES, [step('energy_bids_dam', 'ALL', 1000)]) == 1000
+
+
+def test_streaming_index_lookup_with_limit_passes():
+    sql = "SELECT * FROM energy_bids_dam WHERE Record_Date >= '2020-01-01' LIMIT 100"
+    
+    assert guard_evaluate_plan(sql, NAMES, [step('energy_bids_dam', 'range', BIG)]) == BIG
+
+
+@pytest.mark.parametrize('sql, plan', [
+    # An aggregate reads every row whatever the LIMIT
+    ("SELECT AVG(MCP_Rs_MWh) FROM energy_bids_dam LIMIT 100", [step('energy_bids_dam', 'ALL', BIG)]),
+    ("SELECT AVG(MCP_Rs_MWh) FROM energy_bids_dam WHERE Record_Date >= '2020-01-01' LIMIT 100",
+     [step('energy_bids_dam', 'range', BIG)]),
+    # A selective filter on a non-indexed column scans the table before it finds enough rows
+    ("SELECT * FROM energy_bids_dam WHERE MCV_MW > 99999 LIMIT 100", [step('energy_bids_dam', 'ALL', BIG, 1.0)]),
+    ("SELECT * FROM energy_bids_dam ORDER BY MCP_Rs_MWh LIMIT 100",
+     [step('energy_bids_dam', 'range', BIG, extra='Using filesort')]),
+    ("SELECT * FROM energy_bids_dam", [step('energy_bids_dam', 'range', BIG)]),
+])
+def test_full_reads_over_the_limit_are_rejected(sql, plan):
+    with pytest.raises(QueryRejected, match='Add filters'):
+        guard_evaluate_plan(sql, NAMES, plan)
+
+
+def test_join_fanout_uses_filtered_rows():
+    sql = "SELECT * FROM energy_bids_dam d JOIN energy_bids_rtm r ON r.Record_Date = d.Record_Date"
+    selective = [step('d', 'ALL', 100000, 1.0), step('r', 'ref', 100)]
+    cross = [step('d', 'ALL', 100000), step('r', 'ALL', 100000)]
+    
+    # 100,000 rows of d, 1,000 of them each read 100 rows of r
+    assert guard_evaluate_plan(sql, NAMES, selective) == 200000
+    with pytest.raises(QueryRejected, match='missing join condition'):
+        guard_evaluate_plan(sql, NAMES, cross)
+
+
+def test_timeout_hint_follows_the_outer_select():
+    sql, _ = guard_prepare("SELECT * FROM energy_bids_dam", None, 1000)
+    cte, _ = guard_prepare("WITH daily AS (SELECT Record_Date, AVG(MCP_Rs_MWh) AS price FROM energy_bids_dam "
+                           "GROUP BY Record_Date) SELECT * FROM daily WHERE price > 0", None, 1000)
+    
+    assert sql == "SELECT /*+ MAX_EXECUTION_TIME(1000) */ * FROM energy_bids_dam"
+    assert cte.startswith("WITH daily AS (SELECT Record_Date")
+    assert cte.endswith(") SELECT /*+ MAX_EXECUTION_TIME(1000) */ * FROM daily WHERE price > 0")
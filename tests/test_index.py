@@ -0,0 +1,12 @@
+import re
+
+from webinterface2 import index
+
+
+def test_error_messages_are_not_rendered_as_html():
+    page = index()
+    
+    # Every template literal assigned to innerHTML interpolates numbers only, never error text or schema
+    for literal in re.findall(r'innerHTML = `(.*?)`', page, re.S):
+        assert not re.search(r'\$\{[^}]*(error|schema)', literal)
+    assert "textContent = error" in page
@@ -0,0 +1,129 @@
+import time
+
+import pytest
+import requests
+
+import webinterface2
+from webinterface2 import LLM_POOL_CONFIG, LLMPool, LLMUnavailable
+
+PAYLOAD = {'messages': [{'role': 'user', 'content': 'average price'}]}
+
+
+def make_pool(servers, **overrides):
+    return LLMPool([server.url for server in servers], dict(LLM_POOL_CONFIG, **overrides))
+
+
+def answer(result):
+    return result['choices'][0]['message']['content']
+
+
+def test_requests_alternate_between_idle_backends(llm_servers):
+    first, second = llm_servers(2)
+    pool = make_pool([first, second])
+    
+    for _ in range(10):
+        pool.request('/v1/chat/completions', PAYLOAD, timeout=5)
+    
+    assert (first.hits, second.hits) == (5, 5)
+    assert [backend['outstanding'] for backend in pool.stats()] == [0, 0]
+
+
+def test_least_outstanding_backend_is_chosen(llm_servers):
+    busy, idle = llm_servers(2)
+    pool = make_pool([busy, idle])
+    pool.backends[0].outstanding = 3  # requests still in flight on the first backend
+    
+    for _ in range(4):
+        assert answer(pool.request('/v1/chat/completions', PAYLOAD, timeout=5)) == "SELECT 'backend1';"
+    assert busy.hits == 0
+
+
+def test_acquire_spreads_concurrent_claims(llm_servers):
+    pool = make_pool(llm_servers(3))
+    
+    claimed = [pool.acquire() for _ in range(3)]
+    
+    assert len(set(claimed)) == 3
+    for backend in claimed:
+        pool.release(backend)
+
+
+def test_breaker_opens_after_consecutive_failures(llm_servers):
+    broken, healthy = llm_servers(2)
+    broken.status = 500
+    pool = make_pool([broken, healthy], failure_threshold=3)
+    
+    failures = 0
+    for _ in range(10):
+        try:
+            pool.request('/v1/chat/completions', PAYLOAD, timeout=5)
+        except requests.HTTPError:
+            failures += 1
+    
+    assert failures == 3
+    assert pool.backends[0].open and not pool.backends[1].open
+    hits = broken.hits
+    pool.request('/v1/chat/completions', PAYLOAD, timeout=5)
+    assert broken.hits == hits
+
+
+def test_client_errors_dont_open_the_breaker(llm_servers):
+    server, = llm_servers(1)
+    server.status = 400
+    pool = make_pool([server], failure_threshold=2)
+    
+    for _ in range(4):
+        with pytest.raises(requests.HTTPError):
+            pool.request('/v1/chat/completions', PAYLOAD, timeout=5)
+    
+    assert not pool.backends[0].open
+
+
+def test_every_breaker_open_fails_fast(llm_servers):
+    server, = llm_servers(1)
+    server.status = 503
+    pool = make_pool([server], failure_threshold=1)
+    with pytest.raises(requests.HTTPError):
+        pool.request('/v1/chat/completions', PAYLOAD, timeout=5)
+    
+    with pytest.raises(LLMUnavailable):
+        pool.request('/v1/chat/completions', PAYLOAD, timeout=5)
+
+
+def test_good_probe_closes_the_breaker(llm_servers):
+    server, = llm_servers(1)
+    server.status = 500
+    pool = make_pool([server], failure_threshold=1)
+    pool.probe()
+    assert pool.backends[0].open
+    
+    server.status = 200
+    pool.probe()
+    
+    assert not pool.backends[0].open and pool.backends[0].failures == 0
+    assert answer(pool.request('/v1/chat/completions', PAYLOAD, timeout=5)) == "SELECT 'backend0';"
+
+
+def test_slow_request_is_hedged_to_another_backend(llm_servers):
+    slow, fast = llm_servers(2)
+    slow.delay = 2.0
+    pool = make_pool([slow, fast], hedge=True, hedge_min_samples=1, hedge_min_seconds=0.1)
+    pool.latencies.append(0.05)
+    wins = webinterface2.metrics.value('llm_hedge_wins_total')
+    
+    started = time.perf_counter()
+    result = pool.request('/v1/chat/completions', PAYLOAD, timeout=5)
+    
+    assert answer(result) == "SELECT 'backend1';"
+    assert time.perf_counter() - started < 1.0
+    assert webinterface2.metrics.value('llm_hedge_wins_total') == wins + 1
+    assert (slow.hits, fast.hits) == (1, 1)
+
+
+def test_no_hedge_before_enough_latency_samples(llm_servers):
+    pool = make_pool(llm_servers(2), hedge=True, hedge_min_samples=5)
+    
+    assert pool.hedge_delay() is None
+    for _ in range(5):
+        pool.request('/v1/chat/completions', PAYLOAD, timeout=5)
+    assert pool.hedge_delay() == LLM_POOL_CONFIG['hedge_min_seconds']
@@ -0,0 +1,80 @@
+import sqlite3
+
+import pytest
+
+import webinterface2
+from webinterface2 import db_fetch_page, decode_page_cursor, keyset_condition, paginate_key_columns
+
+SNAPSHOT = {
+    'fingerprint': 'test',
+    'tables': {'energy_bids_dam': {
+        'columns': [[column, 'double', ''] for column in ('Segment', 'Record_Date', 'Time_Block', 'MCP_Rs_MWh')],
+        'unique_keys': [['Segment', 'Record_Date', 'Time_Block']],
+        'samples': []
+    }}
+}
+# Rows with a NULL Time_Block repeat their key, as MySQL unique keys allow
+ROWS = [('DAM', '2024-01-0%d' % day, block, float(day * 10 + (block or 0)))
+        for day in (1, 2, 3) for block in (None, None, 1, 2, 3)]
+
+
+@pytest.fixture
+def database(monkeypatch):
+    """db_execute_query on SQLite, which sorts NULLs first like MySQL and spells <=> as IS"""
+    connection = sqlite3.connect(':memory:')
+    connection.execute("CREATE TABLE energy_bids_dam (Segment TEXT, Record_Date TEXT, Time_Block INT, MCP_Rs_MWh REAL)")
+    connection.executemany("INSERT INTO energy_bids_dam VALUES (?, ?, ?, ?)", ROWS)
+    
+    def db_execute_query(sql):
+        cursor = connection.execute(sql.replace('<=>', 'IS'))
+        rows = [list(row) for row in cursor.fetchall()]
+        return {'success': True, 'columns': [desc[0] for desc in cursor.description], 'rows': rows,
+                'row_count': len(rows)}
+    
+    monkeypatch.setattr(webinterface2, 'db_execute_query', db_execute_query)
+    monkeypatch.setattr(webinterface2, 'db_get_schema_snapshot', lambda: SNAPSHOT)
+
+
+def test_keyset_condition_is_null_safe():
+    assert keyset_condition(['Record_Date', 'Time_Block'], ['2024-01-01', None]) == (
+        "(`Record_Date` > '2024-01-01') OR (`Record_Date` <=> '2024-01-01' AND `Time_Block` IS NOT NULL)"
+    )
+
+
+@pytest.mark.parametrize('page_size', [1, 2, 3, 4, 7, 20])
+def test_every_row_is_returned_exactly_once(database, page_size):
+    sql = "SELECT * FROM energy_bids_dam WHERE Segment = 'DAM'"
+    page = db_fetch_page(sql, page_size)
+    rows = list(page['rows'])
+    while page['next_cursor']:
+        cursor = decode_page_cursor(page['next_cursor'])
+        page = db_fetch_page(cursor['sql'], cursor['size'], cursor['key'], cursor['after'])
+        assert page['rows']
+        rows.extend(page['rows'])
+    
+    assert sorted(map(tuple, rows), key=repr) == sorted(ROWS, key=repr)
+
+
+@pytest.mark.parametrize('sql', [
+    "SELECT * FROM energy_bids_dam ORDER BY MCP_Rs_MWh DESC",
+    "SELECT * FROM energy_bids_dam LIMIT 5",
+    "SELECT DISTINCT Segment, Record_Date, Time_Block FROM energy_bids_dam",
+    "SELECT Segment, Record_Date, COUNT(*) FROM energy_bids_dam GROUP BY Segment, Record_Date",
+    "SELECT Record_Date, MCP_Rs_MWh FROM energy_bids_dam",    # no unique key in the result
+])
+def test_results_without_a_total_order_are_not_paged(sql):
+    columns = [name.strip() for name in sql.split('SELECT', 1)[1].split('FROM')[0].replace('DISTINCT', '').split(',')]
+    if columns == ['*']:
+        columns = ['Segment', 'Record_Date', 'Time_Block', 'MCP_Rs_MWh']
+    
+    assert paginate_key_columns(sql, columns, SNAPSHOT) is None
+
+
+def test_preferred_key_order_is_used_when_it_covers_the_unique_key():
+    columns = ['Segment', 'Record_Date', 'Time_Block', 'MCP_Rs_MWh']
+    
+    assert paginate_key_columns("SELECT * FROM energy_bids_dam", columns, SNAPSHOT) == \
+        ['Record_Date', 'Time_Block', 'Segment']
+    # An alias that reuses a key column's name hides the real column
+    assert paginate_key_columns("SELECT Segment, Record_Date, MCP_Rs_MWh AS Time_Block FROM energy_bids_dam",
+                                ['Segment', 'Record_Date', 'Time_Block'], SNAPSHOT) is None
@@ -0,0 +1,40 @@
+import webinterface2
+from webinterface2 import llm_build_payload
+
+COLUMNS = [['Segment', 'varchar(50)', ''], ['Record_Date', 'date', 'MUL'], ['MCP_Rs_MWh', 'double', '']]
+
+
+def snapshot(sample):
+    return {
+        'fingerprint': 'test',
+        'text': '',
+        'tables': {table: {'columns': COLUMNS, 'row_estimate': 1000, 'samples': [{'Segment': sample}]}
+                   for table in ('energy_bids_dam', 'energy_bids_rtm', 'energy_bids_gtam')}
+    }
+
+
+def system_prompt(question, snapshot):
+    return llm_build_payload(question, snapshot)['messages'][0]['content']
+
+
+def test_stable_prefix_keeps_schema_pruning(monkeypatch):
+    monkeypatch.setitem(webinterface2.PROMPT_CONFIG, 'stable_prefix', True)
+    monkeypatch.setattr(webinterface2, 'prompt_prefixes', (None, {}))
+    
+    system = system_prompt("Average real-time price yesterday", snapshot('first'))
+    
+    assert 'Table: energy_bids_rtm' in system
+    assert 'energy_bids_dam (' not in system and 'energy_bids_gtam (' not in system
+
+
+def test_stable_prefix_is_pinned_per_table_set(monkeypatch):
+    monkeypatch.setitem(webinterface2.PROMPT_CONFIG, 'stable_prefix', True)
+    monkeypatch.setattr(webinterface2, 'prompt_prefixes', (None, {}))
+    
+    first = system_prompt("Average real-time price yesterday", snapshot('first'))
+    # A refresh that only changes sample rows keeps the fingerprint and the prefix
+    again = system_prompt("Highest RTM price this week", snapshot('second'))
+    other = system_prompt("Highest day-ahead price this week", snapshot('second'))
+    
+    assert again == first
+    assert 'Table: energy_bids_dam' in other and other != first
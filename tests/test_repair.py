@@ -0,0 +1,69 @@
+import json
+
+import pytest
+
+import webinterface2
+from webinterface2 import app, sql_cache, sql_cache_key
+
+COLUMNS = ['Segment', 'Record_Date', 'MCP_Rs_MWh']
+SNAPSHOT = {
+    'fingerprint': 'test',
+    'tables': {'energy_bids_dam': {'columns': [[column, 'double', ''] for column in COLUMNS], 'samples': []}}
+}
+BAD_SQL = "SELECT Price FROM energy_bids_dam;"
+GOOD_SQL = "SELECT MCP_Rs_MWh FROM energy_bids_dam;"
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    """The model first answers with an unknown column; repairs come from repairs, an exception means it gives up"""
+    repairs = []
+    
+    def llm_repair_sql(natural_query, sql, error, snapshot, timeout):
+        if not repairs:
+            raise ValueError("No SQL statement found in the model output")
+        return repairs.pop(0)
+    
+    def db_iter_results(sql, chunk_size, max_rows=None):
+        yield ['MCP_Rs_MWh']
+        yield [[4200.0]]
+    
+    monkeypatch.setattr(webinterface2, 'db_get_schema_snapshot', lambda: SNAPSHOT)
+    monkeypatch.setattr(webinterface2, 'template_lookup', lambda natural_query, snapshot: (None, None))
+    monkeypatch.setattr(webinterface2, 'llm_generate_sql', lambda natural_query, snapshot: BAD_SQL)
+    monkeypatch.setattr(webinterface2, 'llm_repair_sql', llm_repair_sql)
+    monkeypatch.setattr(webinterface2, 'rollup_route', lambda sql: sql)
+    monkeypatch.setattr(webinterface2, 'db_iter_results', db_iter_results)
+    yield repairs
+    sql_cache.pop(sql_cache_key('average price', 'test'))
+
+
+def ndjson(question):
+    response = app.test_client().post('/query', json={'query': question, 'format': 'ndjson'})
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+def test_ndjson_repairs_and_caches_the_fixed_translation(backend):
+    backend.append(GOOD_SQL)
+    
+    header, row, summary = ndjson('average price')
+    
+    assert header['generated_sql'] == GOOD_SQL and header['repair']['repaired']
+    assert row == [4200.0] and summary['row_count'] == 1
+    assert sql_cache.get(sql_cache_key('average price', 'test')) == GOOD_SQL
+
+
+def test_ndjson_drops_a_translation_that_still_fails(backend):
+    (error,) = ndjson('average price')
+    
+    assert error['success'] is False and 'Price' in error['error']
+    assert sql_cache.get(sql_cache_key('average price', 'test')) is None
+
+
+def test_stream_drops_a_translation_that_still_fails(backend, monkeypatch):
+    monkeypatch.setattr(webinterface2, 'llm_stream_sql', lambda natural_query, snapshot: iter([BAD_SQL]))
+    
+    events = list(webinterface2.stream_natural_query('average price'))
+    
+    assert events[-1].startswith('event: error')
+    assert sql_cache.get(sql_cache_key('average price', 'test')) is None
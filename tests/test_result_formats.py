@@ -0,0 +1,81 @@
+import json
+
+import pytest
+
+import webinterface2
+from webinterface2 import app, columnar_results
+
+
+@pytest.fixture
+def client():
+    return app.test_client()
+
+
+@pytest.fixture
+def answer(monkeypatch):
+    """Answer every question with a fixed two-row result"""
+    response = {
+        'natural_query': 'prices',
+        'generated_sql': 'SELECT Segment, MCP_Rs_MWh FROM energy_bids_dam;',
+        'results': {'success': True, 'columns': ['Segment', 'MCP_Rs_MWh'],
+                    'rows': [['DAM', 3000.5], ['RTM', 2800.0]], 'row_count': 2}
+    }
+    monkeypatch.setattr(webinterface2, 'process_natural_query', lambda *args: response)
+    return response
+
+
+def test_columnar_results_transpose_rows():
+    results = {'success': True, 'columns': ['a', 'b'], 'rows': [[1, 'x'], [2, 'y']], 'row_count': 2}
+    
+    assert columnar_results(results) == {'success': True, 'columns': ['a', 'b'], 'row_count': 2,
+                                         'data': [[1, 2], ['x', 'y']]}
+    assert columnar_results(dict(results, rows=[]))['data'] == [[], []]
+
+
+def test_format_field_selects_columnar(client, answer):
+    response = client.post('/query', json={'query': 'prices', 'format': 'columnar'})
+    
+    assert response.status_code == 200
+    assert response.mimetype == 'application/vnd.columnar+json'
+    assert json.loads(response.data)['results']['data'] == [['DAM', 'RTM'], [3000.5, 2800.0]]
+
+
+def test_accept_header_selects_the_format(client, answer):
+    response = client.post('/query', json={'query': 'prices'},
+                           headers={'Accept': 'application/vnd.columnar+json'})
+    
+    assert 'data' in json.loads(response.data)['results']
+
+
+def test_unknown_format_is_a_bad_request(client, answer):
+    response = client.post('/query', json={'query': 'prices', 'format': 'xml'})
+    
+    assert response.status_code == 400
+
+
+def test_page_requests_reject_ndjson(client, monkeypatch):
+    monkeypatch.setattr(webinterface2, 'process_page_cursor', lambda cursor: pytest.fail("page was fetched"))
+    
+    response = client.post('/query', json={'cursor': 'abc', 'format': 'ndjson'})
+    
+    assert response.status_code == 400
+    assert 'ndjson' in json.loads(response.data)['error']
+
+
+def test_missing_encoder_package_is_not_acceptable(client, answer, monkeypatch):
+    monkeypatch.setattr(webinterface2, 'msgpack', None)
+    
+    response = client.post('/query', json={'query': 'prices', 'format': 'msgpack'})
+    
+    assert response.status_code == 406
+    assert 'msgpack' in json.loads(response.data)['error']
+
+
+def test_lookup_errors_from_query_handling_are_server_errors(client, answer, monkeypatch):
+    def broken(response, result_format):
+        raise KeyError('rows')
+    monkeypatch.setattr(webinterface2, 'encode_query_response', broken)
+    
+    response = client.post('/query', json={'query': 'prices'})
+    
+    assert response.status_code == 500
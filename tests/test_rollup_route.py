@@ -0,0 +1,76 @@
+import pytest
+
+import webinterface2
+from webinterface2 import rollup_route
+
+COLUMNS = ['Segment', 'Record_Date', 'Time_Block', 'Record_Hour', 'MCP_Rs_MWh', 'MCV_MW']
+# Only MCP_Rs_MWh has rollup columns
+ROLLUP_COLUMNS = {name.lower(): name for name in
+                  ['Segment', 'Record_Date', 'row_count', 'MCP_Rs_MWh_sum', 'MCP_Rs_MWh_count', 'MCP_Rs_MWh_min',
+                   'MCP_Rs_MWh_max']}
+AVG_PRICE = "(SUM(`MCP_Rs_MWh_sum`) / SUM(`MCP_Rs_MWh_count`))"
+
+
+@pytest.fixture
+def versions(monkeypatch):
+    """Table versions as table_versions would hold them, every rollup current by default"""
+    current = {'energy_bids_dam': 3, 'energy_bids_dam_daily': 3, 'energy_bids_dam_monthly': 3}
+    monkeypatch.setattr(webinterface2, 'schema_snapshot', {
+        'fingerprint': 'test',
+        'tables': {'energy_bids_dam': {'columns': [[column, 'double', ''] for column in COLUMNS]}},
+        'rollups': {'energy_bids_dam_daily': ROLLUP_COLUMNS, 'energy_bids_dam_monthly': ROLLUP_COLUMNS}
+    })
+    monkeypatch.setattr(webinterface2, 'db_table_versions', lambda: current)
+    return current
+
+
+@pytest.mark.parametrize('sql, expected', [
+    # AVG becomes sum over count, keeping the result column name
+    ("SELECT Segment, AVG(MCP_Rs_MWh) FROM energy_bids_dam GROUP BY Segment;",
+     f"SELECT Segment, {AVG_PRICE} AS `AVG(MCP_Rs_MWh)` FROM `energy_bids_dam_monthly` GROUP BY Segment;"),
+    ("SELECT COUNT(*) FROM energy_bids_dam WHERE Segment = 'DAM'",
+     "SELECT SUM(`row_count`) AS `COUNT(*)` FROM `energy_bids_dam_monthly` WHERE Segment = 'DAM';"),
+    # An existing alias is kept and HAVING is rewritten too
+    ("SELECT Segment, AVG(MCP_Rs_MWh) AS avg_price FROM energy_bids_dam GROUP BY Segment "
+     "HAVING AVG(MCP_Rs_MWh) > 100",
+     f"SELECT Segment, {AVG_PRICE} AS avg_price FROM `energy_bids_dam_monthly` GROUP BY Segment "
+     f"HAVING {AVG_PRICE} > 100;"),
+    # Month-level functions of Record_Date stay on the monthly rollup
+    ("SELECT YEAR(Record_Date), MONTH(Record_Date), SUM(MCP_Rs_MWh) FROM energy_bids_dam "
+     "GROUP BY YEAR(Record_Date), MONTH(Record_Date)",
+     "SELECT YEAR(Record_Date), MONTH(Record_Date), SUM(`MCP_Rs_MWh_sum`) AS `SUM(MCP_Rs_MWh)` "
+     "FROM `energy_bids_dam_monthly` GROUP BY YEAR(Record_Date), MONTH(Record_Date);"),
+    # Days need the daily rollup
+    ("SELECT Record_Date, MAX(MCP_Rs_MWh) FROM energy_bids_dam GROUP BY Record_Date",
+     "SELECT Record_Date, MAX(`MCP_Rs_MWh_max`) AS `MAX(MCP_Rs_MWh)` FROM `energy_bids_dam_daily` "
+     "GROUP BY Record_Date;"),
+    ("SELECT AVG(MCP_Rs_MWh) FROM energy_bids_dam WHERE Record_Date BETWEEN '2024-01-01' AND '2024-01-15'",
+     f"SELECT {AVG_PRICE} AS `AVG(MCP_Rs_MWh)` FROM `energy_bids_dam_daily` "
+     f"WHERE Record_Date BETWEEN '2024-01-01' AND '2024-01-15';"),
+])
+def test_aggregates_are_routed_to_the_coarsest_rollup(versions, sql, expected):
+    assert rollup_route(sql) == expected
+
+
+@pytest.mark.parametrize('sql', [
+    "SELECT AVG(MCV_MW) FROM energy_bids_dam",                              # no rollup columns for MCV_MW
+    "SELECT AVG(MCP_Rs_MWh) FROM energy_bids_dam WHERE Record_Hour = 5",    # hours aren't in the rollups
+    "SELECT Time_Block, AVG(MCP_Rs_MWh) FROM energy_bids_dam GROUP BY Time_Block",
+    "SELECT AVG(MCP_Rs_MWh) FROM energy_bids_dam d JOIN energy_bids_rtm r ON r.Record_Date = d.Record_Date",
+    "SELECT * FROM energy_bids_dam",
+])
+def test_queries_the_rollups_cannot_answer_are_unchanged(versions, sql):
+    assert rollup_route(sql) == sql
+
+
+def test_a_stale_monthly_rollup_falls_back_to_the_daily_one(versions):
+    versions['energy_bids_dam_monthly'] = 2
+    
+    assert "FROM `energy_bids_dam_daily`" in rollup_route("SELECT Segment, AVG(MCP_Rs_MWh) FROM energy_bids_dam GROUP BY Segment")
+
+
+def test_stale_rollups_are_not_used(versions):
+    sql = "SELECT Segment, AVG(MCP_Rs_MWh) FROM energy_bids_dam GROUP BY Segment"
+    versions['energy_bids_dam'] = 4
+    
+    assert rollup_route(sql) == sql
@@ -0,0 +1,93 @@
+import os
+import time
+
+import pytest
+
+import webinterface2
+from webinterface2 import SHARED_CACHE_CONFIG, SQL_CACHE_CONFIG, SQLiteCache, TTLCache
+
+
+@pytest.fixture
+def cache_path(tmp_path):
+    return str(tmp_path / 'cache.sqlite3')
+
+
+def test_values_round_trip(cache_path):
+    cache = SQLiteCache(cache_path, 'results', 10)
+    cache.put('q', {'rows': [(1, 'DAM')], 'row_count': 1})
+    
+    assert cache.get('q') == {'rows': [(1, 'DAM')], 'row_count': 1}
+    assert cache.get('missing') is None
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+
+
+def test_second_instance_sees_the_same_entries(cache_path):
+    SQLiteCache(cache_path, 'sql', 10).put('key', 'SELECT 1;')
+    
+    assert SQLiteCache(cache_path, 'sql', 10).get('key') == 'SELECT 1;'
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="needs fork")
+def test_forked_child_reads_and_writes_the_parent_cache(cache_path):
+    cache = SQLiteCache(cache_path, 'sql', 10)
+    cache.put('parent', 'SELECT 1;')
+    
+    pid = os.fork()
+    if pid == 0:
+        ok = cache.get('parent') == 'SELECT 1;' and cache.put('child', 'SELECT 2;')
+        os._exit(0 if ok else 1)
+    _, status = os.waitpid(pid, 0)
+    
+    assert os.WEXITSTATUS(status) == 0
+    assert cache.get('child') == 'SELECT 2;'
+
+
+def test_oldest_entry_is_evicted_first(cache_path):
+    cache = SQLiteCache(cache_path, 'sql', 2)
+    for key in ('a', 'b', 'c'):
+        cache.put(key, key.upper())
+        time.sleep(0.01)
+    
+    assert cache.get('a') is None
+    assert [key for key, _, _ in cache.items()] == ['b', 'c']
+    assert cache.stats()['evictions'] == 1
+
+
+def test_expired_and_invalid_entries_are_dropped(cache_path):
+    cache = SQLiteCache(cache_path, 'results', 10)
+    cache.put('old', 1, expires_at=time.time() - 1)
+    cache.put('stale', {'version': 1})
+    
+    assert cache.get('old') is None
+    assert cache.get('stale', is_valid=lambda value: value['version'] == 2) is None
+    assert cache.stats()['entries'] == 0
+
+
+def test_json_persistence_is_off_with_a_shared_cache(tmp_path, monkeypatch):
+    json_path = tmp_path / 'sql_cache.json'
+    json_path.write_text('[["stale", "SELECT 0;", null]]')
+    monkeypatch.setitem(SQL_CACHE_CONFIG, 'persist_path', str(json_path))
+    monkeypatch.setitem(SHARED_CACHE_CONFIG, 'path', str(tmp_path / 'cache.sqlite3'))
+    monkeypatch.setattr(webinterface2, 'sql_cache', TTLCache(10))
+    
+    webinterface2.sql_cache_load()
+    webinterface2.sql_cache.put('fresh', 'SELECT 1;')
+    webinterface2.sql_cache_save()
+    
+    assert webinterface2.sql_cache.get('stale') is None
+    assert json_path.read_text() == '[["stale", "SELECT 0;", null]]'
+
+
+def test_json_persistence_round_trip(tmp_path, monkeypatch):
+    json_path = tmp_path / 'sql_cache.json'
+    monkeypatch.setitem(SQL_CACHE_CONFIG, 'persist_path', str(json_path))
+    monkeypatch.setitem(SHARED_CACHE_CONFIG, 'path', None)
+    monkeypatch.setattr(webinterface2, 'sql_cache', TTLCache(10))
+    webinterface2.sql_cache.put('key', 'SELECT 1;')
+    
+    webinterface2.sql_cache_save()
+    monkeypatch.setattr(webinterface2, 'sql_cache', TTLCache(10))
+    webinterface2.sql_cache_load()
+    
+    assert webinterface2.sql_cache.get('key') == 'SELECT 1;'
+    assert os.listdir(tmp_path) == ['sql_cache.json']
@@ -0,0 +1,108 @@
+import json
+
+import pytest
+
+import webinterface2
+from webinterface2 import SQLValidationError, app, clean_sql, sql_check, sql_referenced_tables, sql_scan, sql_tokens
+
+COLUMNS = ['Segment', 'Record_Date', 'Time_Block', 'Record_Hour', 'MCP_Rs_MWh', 'MCV_MW']
+SNAPSHOT = {
+    'fingerprint': 'test',
+    'tables': {table: {'columns': [[column, 'double', ''] for column in COLUMNS], 'samples': []}
+               for table in ('energy_bids_dam', 'energy_bids_gdam', 'energy_bids_rtm')}
+}
+
+
+@pytest.mark.parametrize('output, expected', [
+    ("SELECT * FROM energy_bids_dam LIMIT 100", "SELECT * FROM energy_bids_dam LIMIT 100;"),
+    ("Here is the query:\n```sql\nSELECT Segment FROM energy_bids_dam;\n```\nIt selects the segments.",
+     "SELECT Segment FROM energy_bids_dam;"),
+    ("SELECT * FROM energy_bids_dam; DROP TABLE energy_bids_dam;", "SELECT * FROM energy_bids_dam;"),
+    ("SELECT Segment FROM energy_bids_dam WHERE Segment = 'a;b'", "SELECT Segment FROM energy_bids_dam WHERE Segment = 'a;b';"),
+])
+def test_one_statement_is_extracted(output, expected):
+    assert clean_sql(output, SNAPSHOT) == expected
+
+
+def test_comments_inside_the_statement_are_dropped():
+    sql = clean_sql("SELECT Segment, AVG(MCP_Rs_MWh)\n-- day-ahead only\nFROM energy_bids_dam\nGROUP BY Segment", SNAPSHOT)
+    
+    assert sql.split() == "SELECT Segment, AVG(MCP_Rs_MWh) FROM energy_bids_dam GROUP BY Segment;".split()
+
+
+def test_explanation_after_an_own_line_comment_is_cut_off():
+    sql = clean_sql("SELECT * FROM energy_bids_dam\n-- all rows\nThis query returns every row.", SNAPSHOT)
+    
+    assert sql.split() == "SELECT * FROM energy_bids_dam;".split()
+
+
+def test_common_table_expressions_are_kept():
+    output = "WITH daily AS (SELECT Record_Date, AVG(MCP_Rs_MWh) AS price FROM energy_bids_dam GROUP BY Record_Date) " \
+             "SELECT d.Record_Date, d.price FROM daily d"
+    
+    assert clean_sql(output, SNAPSHOT) == output + ';'
+    assert sql_referenced_tables(output) == {'energy_bids_dam'}
+
+
+def test_tables_inside_common_table_expressions_are_checked():
+    with pytest.raises(SQLValidationError) as error:
+        clean_sql("WITH t AS (SELECT 1 FROM energy_bids_xyz) SELECT * FROM t", SNAPSHOT)
+    
+    assert error.value.errno == 1146
+
+
+@pytest.mark.parametrize('output, errno', [
+    ("SELECT Price FROM energy_bids_dam", 1054),
+    ("SELECT * FROM energy_bids_xyz", 1146),
+    ("SELECT x.Segment FROM energy_bids_dam d", 1054),
+    ("SELECT d.Price FROM energy_bids_dam d", 1054),
+])
+def test_unknown_identifiers_get_mysql_error_codes(output, errno):
+    with pytest.raises(SQLValidationError) as error:
+        clean_sql(output, SNAPSHOT)
+    
+    assert error.value.errno == errno
+
+
+@pytest.mark.parametrize('output', [
+    "SELECT * FROM energy_bids_dam INTO OUTFILE '/tmp/x'",
+    "SELECT SLEEP(10)",
+    "SELECT * FROM energy_bids_dam FOR UPDATE",
+    "SELECT @a := 1",
+    "DELETE FROM energy_bids_dam",
+    "The answer is 42",
+])
+def test_writes_and_non_queries_are_rejected(output):
+    with pytest.raises(ValueError):
+        clean_sql(output)
+
+
+def test_scan_resolves_aliases_and_derived_tables():
+    scan = sql_scan(sql_tokens(
+        "SELECT d.Segment, sub.m FROM energy_bids_dam AS d "
+        "JOIN (SELECT MAX(MCP_Rs_MWh) AS m FROM energy_bids_rtm) sub ON 1"
+    ))
+    
+    assert scan['tables'] == ['energy_bids_dam', 'energy_bids_rtm']
+    assert scan['aliases']['d'] == 'energy_bids_dam' and 'sub' in scan['opaque']
+    assert ('d', 'Segment') in scan['columns'] and 'm' in scan['names']
+
+
+def test_sql_check_returns_a_repairable_error():
+    assert sql_check("SELECT Segment FROM energy_bids_dam", SNAPSHOT) is None
+    assert sql_check("SELECT Price FROM energy_bids_dam", SNAPSHOT) == {
+        'success': False, 'error': "Unknown column 'Price' in 'field list'", 'error_code': 1054, 'rejected': 'validation'
+    }
+
+
+def test_ndjson_results_are_validated_before_execution(monkeypatch):
+    monkeypatch.setattr(webinterface2, 'resolve_sql', lambda natural_query: ("SELECT Price FROM energy_bids_dam;", False, None))
+    monkeypatch.setattr(webinterface2, 'db_get_schema_snapshot', lambda: SNAPSHOT)
+    
+    def db_iter_results(*args):
+        raise AssertionError("the query must not reach MySQL")
+    monkeypatch.setattr(webinterface2, 'db_iter_results', db_iter_results)
+    
+    response = app.test_client().post('/query', json={'query': 'prices', 'format': 'ndjson'})
+    
+    assert json.loads(response.data)['error'] == "Unknown column 'Price' in 'field list'"
@@ -0,0 +1,44 @@
+from datetime import date
+
+import pytest
+
+import webinterface2
+from webinterface2 import template_sql
+
+COLUMNS = ['Segment', 'Record_Date', 'Time_Block', 'Record_Hour', 'MCP_Rs_MWh', 'MCV_MW']
+SNAPSHOT = {
+    'fingerprint': 'test',
+    'tables': {table: {'columns': [[column, 'double', ''] for column in COLUMNS], 'samples': []}
+               for table in ('energy_bids_dam', 'energy_bids_rtm')}
+}
+
+
+class FixedDate(date):
+    @classmethod
+    def today(cls):
+        return cls(2024, 3, 10)
+
+
+@pytest.fixture(autouse=True)
+def fixed_today(monkeypatch):
+    monkeypatch.setattr(webinterface2, 'date', FixedDate)
+
+
+@pytest.mark.parametrize('question, expected', [
+    ("Show data for the last 7 days", "SELECT * FROM energy_bids_dam WHERE Record_Date >= '2024-03-04';"),
+    ("Show data for the last 1 day", "SELECT * FROM energy_bids_dam WHERE Record_Date >= '2024-03-10';"),
+    ("Show data for today", "SELECT * FROM energy_bids_dam WHERE Record_Date = '2024-03-10';"),
+    ("Average RTM price in February 2024",
+     "SELECT AVG(MCP_Rs_MWh) FROM energy_bids_rtm WHERE Record_Date BETWEEN '2024-02-01' AND '2024-02-29';"),
+])
+def test_date_phrases_become_record_date_ranges(question, expected):
+    assert template_sql(question, SNAPSHOT)[0] == expected
+
+
+@pytest.mark.parametrize('question', [
+    "Show data for the last 0 days",
+    "Show data for 2024-02-30",
+    "Compare DAM and RTM prices yesterday",
+])
+def test_questions_the_templates_cannot_answer_go_to_the_llm(question):
+    assert template_sql(question, SNAPSHOT) == (None, None)
@@ -1,8 +1,42 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 import mysql.connector
 import requests
 import re
 import logging
+import threading
+import queue
+import atexit
+import time
+import hashlib
+import hmac
+import base64
+import secrets
+import json
+import os
+import calendar
+import gzip
+import gc
+import pickle
+import sqlite3
+from datetime import date, datetime, time as dt_time, timedelta
+from decimal import Decimal
+
+# Optional result encodings and compression, each format is only offered when its package is installed
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -17,138 +51,1722 @@ DB_CONFIG = {
     'port': 3306
 }
 
+POOL_CONFIG = {
+    'size': 8,                        # maximum number of open connections
+    'checkout_timeout': 10,           # seconds to wait for a free connection
+    'recycle_seconds': 1800,          # reopen connections older than this
+    'health_check_idle_seconds': 30   # ping connections idle longer than this on borrow
+}
+
 LLM_CONFIG = {
-    'endpoint': 'http://127.0.0.1:1234',
+    # Servers running the same model; requests are balanced across them by LLM_POOL_CONFIG
+    'endpoints': ['http://127.0.0.1:1234'],
     'model_name': 'mistral-7b-instruct-v0.3',
     'temperature': 0.1,
-    'max_tokens': 500
+    'max_tokens': 500,
+    'timeout_seconds': 30,
+    # Extra fields sent with every request. cache_prompt makes llama.cpp-style servers reuse
+    # the KV cache of the shared prompt prefix; add 'id_slot' to pin requests to one slot.
+    # Set to {} for servers that reject unknown fields.
+    'request_options': {'cache_prompt': True},
+    'warm_up_timeout': 120
+}
+
+SQL_CACHE_CONFIG = {
+    'max_entries': 1000,
+    'max_bytes': 2 * 1024 * 1024,
+    'ttl_seconds': 6 * 3600,
+    'persist_path': None,   # e.g. 'sql_cache.json' to survive restarts, unused with a shared cache
+    'persist_every': 20     # write the file after this many new entries
+}
+
+SHARED_CACHE_CONFIG = {
+    # SQLite file holding the SQL and result caches for every worker process on this host,
+    # e.g. under gunicorn. None keeps both caches in process memory.
+    'path': os.environ.get('ENERGY_ASSISTANT_CACHE_PATH'),
+    'busy_timeout_seconds': 5
+}
+
+SCHEMA_CONFIG = {
+    'refresh_seconds': 600,   # background re-introspection interval
+    'sample_rows': 2,         # sample rows per table shown to the LLM
+    # Ingestion bookkeeping tables written by conversion.py, never shown to the LLM
+    'exclude_tables': {'table_versions', 'load_manifest', 'load_manifest_dates', 'load_manifest_file_dates'}
+}
+
+PROMPT_CONFIG = {
+    # Pin the pruned system message per set of tables a question is about, so it is
+    # byte-identical for every question on those tables until the schema changes and the
+    # server only prefills it once. False re-renders it for every question.
+    'stable_prefix': True,
+    'warm_up': True,                      # prefill the prefix in the background when the schema changes
+    'schema_token_budget': 1500,          # estimated tokens allowed for schema + glossary
+    'default_table': 'energy_bids_dam'    # used when the question names no market
+}
+
+# Phrases that name a market segment, matched against table names such as energy_bids_gdam
+SEGMENT_SYNONYMS = {
+    'dam': ['dam', 'day ahead', 'day-ahead'],
+    'gdam': ['gdam', 'green day ahead', 'green day-ahead', 'green dam'],
+    'rtm': ['rtm', 'real time', 'real-time'],
+    'tam': ['tam', 'term ahead', 'term-ahead'],
+    'gtam': ['gtam', 'green term ahead', 'green term-ahead', 'green tam']
+}
+
+# Column descriptions given to the LLM, with the question words that make each one relevant
+COLUMN_GLOSSARY = {
+    'Segment': ("Market segment (e.g., DAM - Day Ahead Market, RTM - Real Time Market)", ['segment', 'segments', 'market']),
+    'Record_Date': ("Date of the record(YYYY-MM-DD format)", ['date', 'dates', 'day', 'days', 'daily', 'today', 'yesterday', 'week', 'month', 'year']),
+    'Record_Hour': ("Hour of the day (0-23)", ['hour', 'hours', 'hourly']),
+    'Time_Block': ("Time block identifier", ['block', 'blocks', 'interval']),
+    'Purchase_Bid_MW': ("Purchase bid in megawatts", ['purchase', 'buy', 'bid', 'bids', 'demand']),
+    'Sell_Bid_MW': ("Sell bid in megawatts", ['sell', 'supply', 'bid', 'bids', 'offer']),
+    'MCV_MW': ("Market Clearing Volume in megawatts", ['volume', 'mcv', 'cleared', 'clearing']),
+    'Final_Scheduled_Volume_MW': ("Final scheduled volume in megawatts", ['scheduled', 'schedule', 'volume']),
+    'MCP_Rs_MWh': ("Market Clearing Price in Rupees per MWh", ['price', 'prices', 'mcp', 'cost', 'rate', 'clearing']),
+    'MCP_Rs_MW': ("Market Clearing Price in Rupees per MW", ['price', 'prices', 'mcp', 'cost', 'rate', 'clearing'])
+}
+
+TEMPLATE_CONFIG = {
+    'enabled': True,
+    # Words a templated question may contain beyond the recognised phrases. Any other word
+    # means the question says something the templates don't understand, so the LLM answers it.
+    'filler_words': {
+        'show', 'me', 'give', 'get', 'list', 'display', 'find', 'what', 'whats', 'is', 'was', 'were',
+        'are', 'the', 'a', 'an', 'of', 'for', 'in', 'on', 'at', 'during', 'from', 'over', 'all',
+        'market', 'please', 'value', 'values'
+    },
+    'all_rows_limit': 100
+}
+
+# Question phrases for the measures templates can aggregate, longest first, with the columns
+# that hold them in order of preference
+TEMPLATE_MEASURES = [
+    ('final scheduled volume', ['Final_Scheduled_Volume_MW']),
+    ('scheduled volume', ['Final_Scheduled_Volume_MW']),
+    ('market clearing price', ['MCP_Rs_MWh', 'MCP_Rs_MW']),
+    ('market clearing volume', ['MCV_MW']),
+    ('clearing price', ['MCP_Rs_MWh', 'MCP_Rs_MW']),
+    ('clearing volume', ['MCV_MW']),
+    ('cleared volume', ['MCV_MW']),
+    ('purchase bids', ['Purchase_Bid_MW']),
+    ('purchase bid', ['Purchase_Bid_MW']),
+    ('sell bids', ['Sell_Bid_MW']),
+    ('sell bid', ['Sell_Bid_MW']),
+    ('prices', ['MCP_Rs_MWh', 'MCP_Rs_MW']),
+    ('price', ['MCP_Rs_MWh', 'MCP_Rs_MW']),
+    ('mcp', ['MCP_Rs_MWh', 'MCP_Rs_MW']),
+    ('mcv', ['MCV_MW']),
+    ('volume', ['MCV_MW'])
+]
+TEMPLATE_AGGREGATES = {
+    'average': 'AVG', 'avg': 'AVG', 'mean': 'AVG',
+    'total': 'SUM', 'sum': 'SUM',
+    'maximum': 'MAX', 'max': 'MAX', 'highest': 'MAX', 'peak': 'MAX',
+    'minimum': 'MIN', 'min': 'MIN', 'lowest': 'MIN'
+}
+TEMPLATE_GROUPS = {
+    'segment': 'Segment', 'date': 'Record_Date', 'day': 'Record_Date', 'daily': 'Record_Date',
+    'hour': 'Record_Hour', 'hourly': 'Record_Hour', 'time block': 'Time_Block', 'block': 'Time_Block',
+    'month': 'month', 'monthly': 'month'
+}
+
+STREAM_CONFIG = {
+    'row_chunk_size': 200,      # rows per server-sent event
+    'ndjson_batch_size': 1000,  # rows fetched from MySQL per NDJSON write
+    'max_rows': 1000000         # hard ceiling on rows streamed for a single query
+}
+
+GUARD_CONFIG = {
+    'max_estimated_rows': 5000000,      # reject plans EXPLAIN expects to examine more rows than this
+    'default_limit': 10000,             # added to SELECTs without a LIMIT
+    'max_execution_ms': 15000,          # per-statement MAX_EXECUTION_TIME
+    'stream_max_execution_ms': 120000   # streamed results are read for longer
+}
+
+# MySQL error raised when MAX_EXECUTION_TIME is exceeded
+ER_QUERY_TIMEOUT = 3024
+
+ENCODING_CONFIG = {
+    'compress_min_bytes': 1024,   # smaller responses are sent uncompressed
+    'gzip_level': 6,
+    'zstd_level': 3
+}
+
+# /query result formats by Accept media type; 'columnar' is also available as format=columnar
+RESULT_MIMETYPES = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+    'columnar': 'application/vnd.columnar+json',
+    'msgpack': 'application/x-msgpack',
+    'arrow': 'application/vnd.apache.arrow.stream'
+}
+
+METRICS_CONFIG = {
+    'prefix': 'energy_assistant',
+    # Histogram bucket upper bounds in seconds
+    'buckets': (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+    'quantiles': (0.5, 0.95, 0.99),
+    'quantile_window': 1024     # most recent observations per stage used for the quantiles
+}
+
+LLM_POOL_CONFIG = {
+    'connections_per_backend': 8,   # keep-alive connections held open to each endpoint
+    'hedge': False,                 # send a duplicate to a second backend when the first is slow
+    'hedge_quantile': 0.9,          # ... after this quantile of recent successful latencies
+    'hedge_min_samples': 20,        # no hedging until this many latencies have been seen
+    'hedge_min_seconds': 0.5,
+    'hedge_workers': 32,
+    'latency_window': 256,
+    'failure_threshold': 3,         # consecutive failures that open a backend's circuit breaker
+    'probe_interval_seconds': 10,   # health probe of every backend; a good probe closes the breaker
+    'probe_path': '/v1/models',
+    'probe_timeout_seconds': 5
+}
+
+REPAIR_CONFIG = {
+    'max_attempts': 2,            # follow-up prompts per question
+    'time_budget_seconds': 20,    # total time spent repairing one question
+    'min_attempt_seconds': 2,     # don't start an attempt with less time than this left
+    'max_tokens': 300,
+    # MySQL errors the model can fix from the message: bad syntax, unknown column/table/function,
+    # ambiguous column, GROUP BY violations and wrong function arguments
+    'error_codes': {1064, 1054, 1146, 1052, 1055, 1056, 1111, 1140, 1305, 1582, 1583, 1630},
+    # Guard rejections worth a retry, e.g. a join without a condition
+    'rejections': {'row_estimate'}
+}
+
+BATCH_CONFIG = {
+    'max_questions': 100,
+    'llm_concurrency': 4,           # requests in flight to the LLM server at once, across all batches
+    'db_concurrency': 4,            # statements run at once, the rest of the pool stays free for /query
+    'llm_prompts_per_request': 1    # >1 sends several prompts per /v1/completions call, for servers
+                                    # that accept a list of prompts
+}
+
+PAGINATION_CONFIG = {
+    'max_page_size': 5000,
+    # Preferred keyset sort orders, Segment is appended whenever the result has it. One is
+    # used only if it covers a unique key of the table, otherwise the unique key itself is
+    'key_candidates': [
+        ('Record_Date', 'Time_Block'),
+        ('Record_Date', 'Record_Hour'),
+        ('Record_Date', 'Instrument_Name')
+    ],
+    # Signs page cursors, set it explicitly when several processes serve the same clients
+    'secret': os.environ.get('QUERY_CURSOR_SECRET') or secrets.token_hex(32)
+}
+
+RESULT_CACHE_CONFIG = {
+    'max_entries': 500,
+    'max_bytes': 64 * 1024 * 1024,
+    'max_entry_bytes': 8 * 1024 * 1024,   # don't cache results bigger than this
+    'version_table': 'table_versions',     # bumped by conversion.py on every load
+    'version_poll_seconds': 5
+}
+
+ROLLUP_CONFIG = {
+    'enabled': True,
+    # Pre-aggregated tables conversion.py keeps next to each market table, coarsest first
+    'grains': [('monthly', '_monthly'), ('daily', '_daily')],
+    # Raw columns a routed query may use outside aggregates
+    'group_columns': {'segment', 'record_date'}
+}
+
+# Functions that make a result depend on when the query runs. Date-level ones are
+# safe to cache for the rest of the day, anything finer is never cached.
+DATE_VOLATILE_FUNCTIONS = {'CURDATE', 'CURRENT_DATE', 'UTC_DATE'}
+VOLATILE_SQL_PATTERN = re.compile(
+    r'\b(CURDATE|CURRENT_DATE|UTC_DATE|NOW|SYSDATE|CURTIME|CURRENT_TIME|CURRENT_TIMESTAMP|'
+    r'UTC_TIME|UTC_TIMESTAMP|LOCALTIME|LOCALTIMESTAMP|UNIX_TIMESTAMP|RAND|UUID)\b',
+    re.IGNORECASE
+)
+# Longest phrases first so "green day ahead" isn't also read as "day ahead"
+SEGMENT_PATTERNS = [
+    (re.compile(rf'\b{re.escape(phrase)}\b'), segment)
+    for phrase, segment in sorted(
+        ((phrase, segment) for segment, phrases in SEGMENT_SYNONYMS.items() for phrase in phrases),
+        key=lambda item: -len(item[0])
+    )
+]
+TOKEN_PATTERN = re.compile(r'\w+|[^\w\s]')
+# One pass over generated SQL: every token kind MySQL distinguishes in a SELECT, most common first
+SQL_TOKEN_PATTERN = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<word>[A-Za-z_@$][\w$@]*)
+  | (?P<number>\d+(?:\.\d*)?(?:[eE][-+]?\d+)?|\.\d+)
+  | (?P<comment>(?:--(?=\s|$)|\#)[^\n]*|/\*.*?(?:\*/|$))
+  | (?P<string>'(?:[^'\\]|\\.|'')*(?:'|$)|"(?:[^"\\]|\\.|"")*(?:"|$))
+  | (?P<quoted>`(?:[^`]|``)*`)
+  | (?P<op><=>|<=|>=|<>|!=|:=|\|\||&&|<<|>>|.)
+""", re.VERBOSE | re.DOTALL)
+SQL_FENCE_PATTERN = re.compile(r'```(?:sql|mysql)?\s*(.*?)(?:```|$)', re.IGNORECASE | re.DOTALL)
+# A query starts at SELECT or at a WITH that defines a common table expression
+SQL_START_PATTERN = re.compile(
+    r'\bSELECT\b|\bWITH\s+(?:RECURSIVE\s+)?(?:`[^`]+`|\w+)\s*(?:\([^()]*\)\s*)?AS\s*\(',
+    re.IGNORECASE
+)
+# Words that are never table or column names in a SELECT: clauses, operators, literals,
+# CAST types and INTERVAL units
+SQL_KEYWORDS = frozenset("""
+    SELECT DISTINCT DISTINCTROW ALL FROM WHERE GROUP BY ORDER HAVING LIMIT OFFSET AS ON USING
+    JOIN INNER LEFT RIGHT OUTER CROSS NATURAL STRAIGHT_JOIN UNION EXCEPT INTERSECT WITH RECURSIVE
+    ROLLUP WINDOW OVER PARTITION ROWS RANGE UNBOUNDED PRECEDING FOLLOWING CURRENT ROW
+    AND OR NOT XOR IN IS NULL LIKE ESCAPE BETWEEN EXISTS REGEXP RLIKE SOUNDS DIV MOD
+    CASE WHEN THEN ELSE END ASC DESC TRUE FALSE UNKNOWN INTERVAL SEPARATOR BINARY COLLATE
+    DUAL FORCE USE IGNORE INDEX KEY HIGH_PRIORITY SQL_NO_CACHE SQL_CALC_FOUND_ROWS SQL_SMALL_RESULT
+    SQL_BIG_RESULT SQL_BUFFER_RESULT LATERAL ANY SOME LEADING TRAILING BOTH
+    CURRENT_DATE CURRENT_TIME CURRENT_TIMESTAMP LOCALTIME LOCALTIMESTAMP UTC_DATE UTC_TIME UTC_TIMESTAMP
+    CHAR CHARACTER VARCHAR NCHAR SIGNED UNSIGNED INTEGER INT DECIMAL DOUBLE FLOAT REAL JSON
+    DATE DATETIME TIME TIMESTAMP YEAR MONTH WEEK QUARTER DAY HOUR MINUTE SECOND MICROSECOND
+    SECOND_MICROSECOND MINUTE_MICROSECOND MINUTE_SECOND HOUR_MICROSECOND HOUR_SECOND HOUR_MINUTE
+    DAY_MICROSECOND DAY_SECOND DAY_MINUTE DAY_HOUR YEAR_MONTH
+""".split())
+# Clauses that end a FROM list
+SQL_FROM_END_KEYWORDS = frozenset("WHERE GROUP ORDER HAVING LIMIT UNION EXCEPT INTERSECT WINDOW FOR INTO".split())
+# Statements that write, lock or change session state, rejected at the top level
+SQL_WRITE_KEYWORDS = frozenset("""
+    INSERT UPDATE DELETE REPLACE DROP ALTER CREATE TRUNCATE GRANT REVOKE RENAME LOAD HANDLER
+    CALL DO SET LOCK UNLOCK KILL SHUTDOWN FLUSH RESET PREPARE EXECUTE DEALLOCATE
+""".split())
+# Never allowed anywhere: SELECT ... INTO writes files or variables, the functions block or read files
+SQL_FORBIDDEN_WORDS = frozenset("INTO SLEEP BENCHMARK GET_LOCK RELEASE_LOCK RELEASE_ALL_LOCKS LOAD_FILE".split())
+# Top-level clauses that give a SELECT its own order, row count or row identity, keyset
+# pages can't be layered on top of them
+SQL_PAGE_BLOCKING_KEYWORDS = frozenset(
+    "ORDER LIMIT GROUP HAVING DISTINCT DISTINCTROW UNION EXCEPT INTERSECT JOIN STRAIGHT_JOIN WITH".split()
+)
+SQL_STRING_PATTERN = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.|\"\")*\"")
+# Single-table aggregate queries without aliases, subqueries or joins are candidates for the rollups
+ROLLUP_QUERY_PATTERN = re.compile(
+    r'^SELECT\s+(?P<select>.+?)\s+FROM\s+`?(?P<table>\w+)`?(?P<rest>(?:\s+(?:WHERE|GROUP|HAVING|ORDER|LIMIT)\b.*)?)$',
+    re.IGNORECASE | re.DOTALL
+)
+ROLLUP_UNSUPPORTED_PATTERN = re.compile(r'\b(?:SELECT|FROM|JOIN|UNION|DISTINCT|OVER)\b', re.IGNORECASE)
+AGGREGATE_PATTERN = re.compile(r'\b(AVG|SUM|MIN|MAX|COUNT)\s*\(\s*(\*|`?\w+`?)\s*\)', re.IGNORECASE)
+# Functions of Record_Date that give the same value for every day of a month
+MONTH_GRAIN_PATTERN = re.compile(r'\b(?:YEAR|MONTH|QUARTER)\s*\(\s*`?Record_Date`?\s*\)', re.IGNORECASE)
+SELECT_ALIAS_PATTERN = re.compile(r'(?:\bAS\s+[`\w]+|\)\s+[`\w]+)\s*$', re.IGNORECASE)
+TRAILING_LIMIT_PATTERN = re.compile(r'\bLIMIT\s+\d+(?:\s*(?:,|OFFSET)\s*\d+)?\s*$', re.IGNORECASE)
+# Aggregate functions read every row they aggregate, whatever the LIMIT says
+GUARD_AGGREGATE_PATTERN = re.compile(
+    r'\b(?:AVG|SUM|MIN|MAX|COUNT|GROUP_CONCAT|STD|STDDEV|STDDEV_POP|STDDEV_SAMP|VARIANCE|VAR_POP|VAR_SAMP'
+    r'|BIT_AND|BIT_OR|BIT_XOR|JSON_ARRAYAGG|JSON_OBJECTAGG)\s*\(',
+    re.IGNORECASE
+)
+# Clauses that end the select list of a SELECT
+SELECT_LIST_END_KEYWORDS = {'FROM', 'INTO', 'WHERE', 'GROUP', 'HAVING', 'WINDOW', 'ORDER', 'LIMIT', 'FOR',
+                            'UNION', 'EXCEPT', 'INTERSECT'}
+
+MONTH_NAMES = {name.lower(): number for number, name in enumerate(calendar.month_name) if name}
+MONTH_NAMES.update({name.lower(): number for number, name in enumerate(calendar.month_abbr) if name})
+TEMPLATE_MEASURE_PHRASES = "|".join(re.escape(phrase).replace(r"\ ", r"\s+") for phrase, _ in TEMPLATE_MEASURES)
+TEMPLATE_PATTERNS = {
+    'last_days': re.compile(r'\b(?:last|past|previous)\s+(\d{1,3})\s+days?\b'),
+    'relative_day': re.compile(r'\b(today|yesterday)\b'),
+    'relative_month': re.compile(r'\b(this|last|previous)\s+month\b'),
+    'iso_date': re.compile(r'\b(\d{4})-(\d{1,2})-(\d{1,2})\b'),
+    'dmy_date': re.compile(r'\b(\d{1,2})[/-](\d{1,2})[/-](\d{4})\b'),
+    'month': re.compile(rf'\b({"|".join(sorted(MONTH_NAMES, key=len, reverse=True))})\b(?:\s+(\d{{4}}))?'),
+    'relative_year': re.compile(r'\b(this|last|previous)\s+year\b'),
+    'year': re.compile(r'\b((?:19|20)\d{2})\b'),
+    'hour': re.compile(r'\b(?:hour|hr)\s+(\d{1,2})\b'),
+    'aggregate': re.compile(
+        rf'\b({"|".join(sorted(TEMPLATE_AGGREGATES, key=len, reverse=True))})\s+(?:of\s+)?(?:the\s+)?'
+        rf'({TEMPLATE_MEASURE_PHRASES})\b'
+    ),
+    'group': re.compile(
+        rf'\b(?:by|per|for each|each)\s+({"|".join(sorted(TEMPLATE_GROUPS, key=len, reverse=True))})\b'
+        r'|\b(daily|hourly|monthly)\b'
+    ),
+    'rows': re.compile(r'\b(?:data|rows|records|entries|everything)\b')
 }
 
 # Global state
-db_connection = None
-schema_cache = None
+db_pool = None
+db_pool_lock = threading.Lock()
+schema_snapshot = None
+schema_build_lock = threading.Lock()
+schema_refresh_stop = threading.Event()
+schema_refresher = None
+prompt_prefixes = (None, {})   # (schema fingerprint, {selected tables: system prompt text})
+schema_identifiers = None   # (schema fingerprint, {table: columns})
+sql_cache_fingerprint = None
+table_versions = {}
+table_versions_checked = 0.0
+table_versions_lock = threading.Lock()
+template_stats = {'lookups': 0, 'hits': {}}
+template_stats_lock = threading.Lock()
+batch_llm_executor = ThreadPoolExecutor(max_workers=BATCH_CONFIG['llm_concurrency'], thread_name_prefix="batch-llm")
+batch_db_executor = ThreadPoolExecutor(max_workers=BATCH_CONFIG['db_concurrency'], thread_name_prefix="batch-db")
+
+# Cache
+class TTLCache:
+    """Thread-safe LRU cache with per-entry expiry, bounded by entry count and size in bytes"""
+    
+    def __init__(self, max_entries, max_bytes=None, ttl_seconds=None, sizer=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.sizer = sizer or (lambda value: len(repr(value)))
+        self.entries = OrderedDict()  # key -> (value, expires_at, size)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+    
+    def get(self, key, is_valid=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] is not None and entry[1] < time.time():
+                self._remove(key)
+                entry = None
+            if entry is not None and is_valid is not None and not is_valid(entry[0]):
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+    
+    def put(self, key, value, expires_at=None, size=None):
+        if size is None:
+            size = self.sizer(value)
+        if self.max_bytes and size > self.max_bytes:
+            return False
+        if expires_at is None and self.ttl_seconds:
+            expires_at = time.time() + self.ttl_seconds
+        
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (value, expires_at, size)
+            self.total_bytes += size
+            while self.entries and (len(self.entries) > self.max_entries or
+                                    (self.max_bytes and self.total_bytes > self.max_bytes)):
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+        return True
+    
+    def pop(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self._remove(key)
+                return entry[0]
+            return None
+    
+    def remove_if(self, predicate):
+        """Drop every entry for which predicate(key, value) is true"""
+        with self.lock:
+            stale = [key for key, (value, _, _) in self.entries.items() if predicate(key, value)]
+            for key in stale:
+                self._remove(key)
+        return len(stale)
+    
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+    
+    def items(self):
+        """Snapshot of live (key, value, expires_at) tuples, least recently used first"""
+        now = time.time()
+        with self.lock:
+            return [(key, value, expires_at) for key, (value, expires_at, _) in self.entries.items()
+                    if expires_at is None or expires_at >= now]
+    
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+            }
+    
+    def _remove(self, key):
+        _, _, size = self.entries.pop(key)
+        self.total_bytes -= size
 
-# Database functions
-def db_connect():
-    global db_connection
-    try:
-        db_connection = mysql.connector.connect(**DB_CONFIG)
-        logger.info("Database connection established")
+class SQLiteCache:
+    """TTLCache's interface over a table in a local SQLite file, shared by every process that opens it.
+    
+    Values are pickled, so the file must only be writable by this service. Eviction is oldest
+    stored first rather than least recently used, so a hit never writes. Hit and miss counts
+    are per process.
+    """
+    
+    def __init__(self, path, table, max_entries, max_bytes=None, ttl_seconds=None, sizer=None):
+        self.path = path
+        self.table = table
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.sizer = sizer or (lambda value: len(repr(value)))
+        self.local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()  # guards the counters
+        self.connect().execute(
+            f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+            f"expires_at REAL, size INTEGER NOT NULL, stored_at REAL NOT NULL)"
+        )
+        self.connect().execute(f"CREATE INDEX IF NOT EXISTS {table}_stored_at ON {table} (stored_at)")
+    
+    def connect(self):
+        """This thread's connection; one opened before a fork is never used by the child"""
+        connection = getattr(self.local, 'connection', None)
+        if connection is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=SHARED_CACHE_CONFIG['busy_timeout_seconds'],
+                                         isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+    
+    def count(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+    
+    def get(self, key, is_valid=None):
+        connection = self.connect()
+        row = connection.execute(f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)).fetchone()
+        value = None
+        if row is not None and (row[1] is None or row[1] >= time.time()):
+            value = pickle.loads(row[0])
+            if is_valid is not None and not is_valid(value):
+                value = None
+        if row is not None and value is None:
+            connection.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+        self.count(value is not None)
+        return value
+    
+    def put(self, key, value, expires_at=None, size=None):
+        if size is None:
+            size = self.sizer(value)
+        if self.max_bytes and size > self.max_bytes:
+            return False
+        if expires_at is None and self.ttl_seconds:
+            expires_at = time.time() + self.ttl_seconds
+        
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        connection = self.connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute(f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?, ?, ?)",
+                               (key, blob, expires_at, size, time.time()))
+            entries, total_bytes = connection.execute(
+                f"SELECT COUNT(*), COALESCE(SUM(size), 0) FROM {self.table}").fetchone()
+            evicted = 0
+            while entries > self.max_entries or (self.max_bytes and total_bytes > self.max_bytes):
+                oldest = connection.execute(
+                    f"SELECT key, size FROM {self.table} ORDER BY stored_at LIMIT 1").fetchone()
+                connection.execute(f"DELETE FROM {self.table} WHERE key = ?", (oldest[0],))
+                entries -= 1
+                total_bytes -= oldest[1]
+                evicted += 1
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        if evicted:
+            with self.lock:
+                self.evictions += evicted
         return True
-    except mysql.connector.Error as e:
-        logger.error(f"Database connection failed: {e}")
-        return False
+    
+    def pop(self, key):
+        connection = self.connect()
+        row = connection.execute(f"SELECT value FROM {self.table} WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        connection.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+        return pickle.loads(row[0])
+    
+    def remove_if(self, predicate):
+        """Drop every entry for which predicate(key, value) is true"""
+        connection = self.connect()
+        rows = connection.execute(f"SELECT key, value FROM {self.table}").fetchall()
+        stale = [(key,) for key, blob in rows if predicate(key, pickle.loads(blob))]
+        connection.executemany(f"DELETE FROM {self.table} WHERE key = ?", stale)
+        return len(stale)
+    
+    def clear(self):
+        self.connect().execute(f"DELETE FROM {self.table}")
+    
+    def items(self):
+        """Snapshot of live (key, value, expires_at) tuples, oldest first"""
+        rows = self.connect().execute(
+            f"SELECT key, value, expires_at FROM {self.table} WHERE expires_at IS NULL OR expires_at >= ? "
+            f"ORDER BY stored_at", (time.time(),)
+        ).fetchall()
+        return [(key, pickle.loads(blob), expires_at) for key, blob, expires_at in rows]
+    
+    def stats(self):
+        entries, total_bytes = self.connect().execute(
+            f"SELECT COUNT(*), COALESCE(SUM(size), 0) FROM {self.table}").fetchone()
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": entries,
+                "bytes": total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+            }
 
-def db_get_schema():
-    global schema_cache, db_connection
+def cache_create(name, max_entries, **options):
+    """In-process TTLCache, or a table in the shared SQLite file when one is configured"""
+    if SHARED_CACHE_CONFIG['path']:
+        return SQLiteCache(SHARED_CACHE_CONFIG['path'], name, max_entries, **options)
+    return TTLCache(max_entries, **options)
+
+sql_cache = cache_create(
+    'sql_cache',
+    SQL_CACHE_CONFIG['max_entries'],
+    max_bytes=SQL_CACHE_CONFIG['max_bytes'],
+    ttl_seconds=SQL_CACHE_CONFIG['ttl_seconds'],
+    sizer=lambda sql: len(sql.encode('utf-8'))
+)
+sql_cache_unsaved = 0
+
+def schema_fingerprint(tables):
+    """Hash of table and column definitions only, so new data doesn't change it"""
+    structure = [[name, info['columns']] for name, info in sorted(tables.items())]
+    return hashlib.sha1(json.dumps(structure).encode('utf-8')).hexdigest()[:16]
+
+def sql_cache_key(natural_query, fingerprint):
+    """Key on the normalised question plus everything that changes the model's answer"""
+    normalized = re.sub(r'\s+', ' ', natural_query.strip().lower()).rstrip(' ?.!')
+    return f"{fingerprint}|{LLM_CONFIG['model_name']}|{LLM_CONFIG['temperature']}|{normalized}"
+
+def sql_cache_check_schema(fingerprint):
+    """Drop cached translations made against a different schema"""
+    global sql_cache_fingerprint
+    if fingerprint == sql_cache_fingerprint:
+        return
+    dropped = sql_cache.remove_if(lambda key, value: not key.startswith(f"{fingerprint}|"))
+    if dropped:
+        logger.info(f"Schema changed, dropped {dropped} cached SQL translations")
+    sql_cache_fingerprint = fingerprint
+
+def sql_cache_persist_path():
+    """JSON file the SQL cache is saved to; None with the shared SQLite cache, which is
+    already on disk and would be overwritten by every worker's stale copy"""
+    return None if SHARED_CACHE_CONFIG['path'] else SQL_CACHE_CONFIG['persist_path']
+
+def sql_cache_store(key, sql):
+    global sql_cache_unsaved
+    sql_cache.put(key, sql)
+    if sql_cache_persist_path():
+        sql_cache_unsaved += 1
+        if sql_cache_unsaved >= SQL_CACHE_CONFIG['persist_every']:
+            sql_cache_save()
+
+def sql_cache_save():
+    global sql_cache_unsaved
+    path = sql_cache_persist_path()
+    if not path:
+        return
+    entries = [[key, sql, expires_at] for key, sql, expires_at in sql_cache.items()]
+    # One temporary file per writer, so concurrent saves can't interleave in it
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, path)
+        sql_cache_unsaved = 0
+    except OSError as e:
+        logger.warning(f"Saving SQL cache to {path} failed: {e}")
+
+def sql_cache_load():
+    path = sql_cache_persist_path()
+    if not path or not os.path.exists(path):
+        return
+    try:
+        with open(path, encoding='utf-8') as f:
+            entries = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Loading SQL cache from {path} failed: {e}")
+        return
     
-    if schema_cache:
-        return schema_cache
+    now = time.time()
+    loaded = 0
+    for key, sql, expires_at in entries:
+        if expires_at is None or expires_at > now:
+            sql_cache.put(key, sql, expires_at)
+            loaded += 1
+    logger.info(f"Loaded {loaded} cached SQL translations from {path}")
+
+result_cache = cache_create(
+    'result_cache',
+    RESULT_CACHE_CONFIG['max_entries'],
+    max_bytes=RESULT_CACHE_CONFIG['max_bytes']
+)
+
+def sql_referenced_tables(sql):
+    scan = sql_scan(sql_tokens(sql))
+    return {table for table in scan['tables'] if table not in scan['opaque']}
+
+def result_cache_plan(sql):
+    """Return (cache_key, tables) for a cacheable SELECT, or (None, None)"""
+    normalized = re.sub(r'\s+', ' ', sql.strip()).rstrip('; ')
+    if not normalized.upper().startswith(('SELECT', 'WITH')):
+        return None, None
     
-    if not db_connection or not db_connection.is_connected():
-        if not db_connect():
-            raise RuntimeError("Failed to connect to database")
+    tables = sql_referenced_tables(normalized)
+    if not tables:
+        return None, None
     
-    cursor = db_connection.cursor()
-    schema_info = []
+    volatile = {name.upper() for name in VOLATILE_SQL_PATTERN.findall(normalized)}
+    if volatile - DATE_VOLATILE_FUNCTIONS:
+        return None, None
+    if volatile:
+        normalized = f"{date.today().isoformat()}|{normalized}"
+    return normalized, tables
+
+def result_cache_get(cache_key):
+    versions = db_table_versions()
+    entry = result_cache.get(
+        cache_key,
+        is_valid=lambda entry: all(versions.get(table, 0) == version
+                                   for table, version in entry['versions'].items())
+    )
+    if entry is None:
+        return None
+    return dict(entry['result'], cached=True)
+
+def result_cache_store(cache_key, tables, versions, result):
+    size = len(json.dumps(result['rows'], default=str)) + 256
+    if size > RESULT_CACHE_CONFIG['max_entry_bytes']:
+        return
+    entry = {
+        'result': result,
+        'versions': {table: versions.get(table, 0) for table in tables}
+    }
+    result_cache.put(cache_key, entry, size=size)
+
+# Metrics
+class Metrics:
+    """Thread-safe counters and latency histograms, rendered in the Prometheus text format"""
+    
+    def __init__(self, prefix, buckets, quantiles, window):
+        self.prefix = prefix
+        self.buckets = buckets
+        self.quantiles = quantiles
+        self.window = window
+        self.counters = {}    # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> {'buckets', 'sum', 'count', 'recent'}
+        self.lock = threading.Lock()
+    
+    def value(self, name, **labels):
+        with self.lock:
+            return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+    
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+    
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {
+                    'buckets': [0] * len(self.buckets),
+                    'sum': 0.0,
+                    'count': 0,
+                    'recent': deque(maxlen=self.window)
+                }
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+            histogram['recent'].append(seconds)
+    
+    def summary(self, name):
+        """{label value: {count, p50, p95, p99}} in milliseconds for a single-label histogram"""
+        with self.lock:
+            selected = [(labels[0][1] if labels else '', histogram['count'], sorted(histogram['recent']))
+                        for (hist_name, labels), histogram in self.histograms.items() if hist_name == name]
+        result = {}
+        for label, count, values in sorted(selected):
+            result[label] = {'count': count}
+            for q in self.quantiles:
+                result[label][f"p{int(q * 100)}"] = round(quantile(values, q) * 1000, 2)
+        return result
+    
+    def render(self, gauges=()):
+        """Prometheus exposition text; gauges are extra (name, labels, value) samples read at scrape time"""
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, dict(histogram, recent=sorted(histogram['recent'])))
+                                for key, histogram in self.histograms.items())
+        
+        declared = set()
+        def declare(name, kind):
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+        
+        for (name, labels), value in counters:
+            declare(f"{self.prefix}_{name}", 'counter')
+            lines.append(f"{self.prefix}_{name}{format_labels(labels)} {value}")
+        for name, labels, value in gauges:
+            declare(f"{self.prefix}_{name}", 'gauge')
+            lines.append(f"{self.prefix}_{name}{format_labels(tuple(sorted(labels.items())))} {value}")
+        
+        for (name, labels), histogram in histograms:
+            full_name = f"{self.prefix}_{name}"
+            declare(full_name, 'histogram')
+            for bound, count in zip(self.buckets, histogram['buckets']):
+                lines.append(f"{full_name}_bucket{format_labels(labels + (('le', repr(float(bound))),))} {count}")
+            lines.append(f"{full_name}_bucket{format_labels(labels + (('le', '+Inf'),))} {histogram['count']}")
+            lines.append(f"{full_name}_sum{format_labels(labels)} {histogram['sum']:.6f}")
+            lines.append(f"{full_name}_count{format_labels(labels)} {histogram['count']}")
+        # Quantiles over the recent window go in a separate summary, a name can't be both
+        for (name, labels), histogram in histograms:
+            full_name = f"{self.prefix}_{name}_recent"
+            declare(full_name, 'summary')
+            for q in self.quantiles:
+                value = quantile(histogram['recent'], q)
+                lines.append(f"{full_name}{format_labels(labels + (('quantile', str(q)),))} {value:.6f}")
+        return "\n".join(lines) + "\n"
+
+def quantile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+metrics = Metrics(
+    METRICS_CONFIG['prefix'],
+    METRICS_CONFIG['buckets'],
+    METRICS_CONFIG['quantiles'],
+    METRICS_CONFIG['quantile_window']
+)
+# Per-request stage timings, set by process_natural_query when the caller asks for them
+span_state = threading.local()
+
+@contextmanager
+def span(stage):
+    """Time a pipeline stage into the stage histogram and the current request's timings"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.observe('stage_duration_seconds', elapsed, stage=stage)
+        timings = getattr(span_state, 'timings', None)
+        if timings is not None:
+            timings[stage] = round(timings.get(stage, 0.0) + elapsed * 1000, 2)
+
+# Database functions
+def db_connect():
+    """Open a new connection for the pool"""
+    connection = mysql.connector.connect(**DB_CONFIG)
+    # Pooled connections are long-lived, so don't pin them to a stale snapshot
+    connection.autocommit = True
+    logger.info("Database connection established")
+    now = time.monotonic()
+    return {'connection': connection, 'created_at': now, 'last_used': now}
+
+def db_close_entry(entry):
+    try:
+        entry['connection'].close()
+    except mysql.connector.Error as e:
+        logger.warning(f"Closing pooled connection failed: {e}")
+
+def db_pool_init():
+    global db_pool
+    with db_pool_lock:
+        if db_pool is None:
+            pool = queue.LifoQueue(maxsize=POOL_CONFIG['size'])
+            # Empty slots are connected lazily on first borrow
+            for _ in range(POOL_CONFIG['size']):
+                pool.put(None)
+            db_pool = pool
+            logger.info(f"Database pool initialised with {POOL_CONFIG['size']} slots")
+    return db_pool
+
+def db_pool_acquire():
+    pool = db_pool or db_pool_init()
+    try:
+        entry = pool.get(timeout=POOL_CONFIG['checkout_timeout'])
+    except queue.Empty:
+        raise RuntimeError("Timed out waiting for a database connection")
     
     try:
-        cursor.execute("SHOW TABLES")
-        tables = cursor.fetchall()
+        if entry is not None:
+            now = time.monotonic()
+            if now - entry['created_at'] > POOL_CONFIG['recycle_seconds']:
+                db_close_entry(entry)
+                entry = None
+            elif (now - entry['last_used'] > POOL_CONFIG['health_check_idle_seconds']
+                  and not entry['connection'].is_connected()):
+                logger.warning("Discarding dead pooled connection")
+                db_close_entry(entry)
+                entry = None
         
-        for (table_name,) in tables:
-            schema_info.append(f"\nTable: {table_name}")
-            
-            cursor.execute(f"DESCRIBE {table_name}")
-            columns = cursor.fetchall()
-            
-            for column in columns:
-                col_name, col_type, null, key, default, extra = column
-                key_info = f" ({key})" if key else ""
-                schema_info.append(f"  - {col_name}: {col_type}{key_info}")
-            
-            cursor.execute(f"SELECT * FROM {table_name} LIMIT 3")
-            sample_data = cursor.fetchall()
-            if sample_data:
-                schema_info.append(f"  Sample data: {sample_data[:2]}")
+        if entry is None:
+            entry = db_connect()
+        return entry
+    except Exception:
+        # Give the slot back so a failed connect doesn't shrink the pool
+        pool.put(None)
+        raise
+
+def db_pool_release(entry, discard=False):
+    if discard:
+        db_close_entry(entry)
+        entry = None
+    else:
+        entry['last_used'] = time.monotonic()
+    
+    pool = db_pool
+    if pool is None:  # pool was closed while the connection was out
+        if entry is not None:
+            db_close_entry(entry)
+        return
+    pool.put(entry)
+
+@contextmanager
+def db_borrow():
+    """Borrow a pooled connection for the duration of a with-block"""
+    with span('pool_wait'):
+        entry = db_pool_acquire()
+    discard = False
+    try:
+        yield entry['connection']
+    except (mysql.connector.InterfaceError, mysql.connector.OperationalError):
+        # The connection itself is suspect, don't hand it to the next request
+        discard = True
+        raise
+    finally:
+        db_pool_release(entry, discard)
+
+def db_build_schema_snapshot():
+    """Introspect every table in three round trips: columns, unique keys and one batched sample query"""
+    tables = OrderedDict()
+    rollups = {}
+    rollup_suffixes = tuple(suffix for _, suffix in ROLLUP_CONFIG['grains'])
+    
+    try:
+        with db_borrow() as connection:
+            cursor = connection.cursor()
+            try:
+                cursor.execute("""
+                    SELECT c.TABLE_NAME, c.COLUMN_NAME, c.COLUMN_TYPE, c.COLUMN_KEY, t.TABLE_ROWS
+                    FROM information_schema.COLUMNS c
+                    JOIN information_schema.TABLES t
+                      ON t.TABLE_SCHEMA = c.TABLE_SCHEMA AND t.TABLE_NAME = c.TABLE_NAME
+                    WHERE c.TABLE_SCHEMA = DATABASE() AND t.TABLE_TYPE = 'BASE TABLE'
+                    ORDER BY c.TABLE_NAME, c.ORDINAL_POSITION
+                """)
+                for table_name, col_name, col_type, key, row_estimate in cursor.fetchall():
+                    if table_name.lower() in SCHEMA_CONFIG['exclude_tables']:
+                        continue
+                    if table_name.lower().endswith(rollup_suffixes):
+                        # Queries are routed to rollups after generation, the LLM never sees them
+                        rollups.setdefault(table_name.lower(), {})[col_name.lower()] = col_name
+                        continue
+                    info = tables.setdefault(table_name, {
+                        'columns': [],
+                        'row_estimate': row_estimate or 0,
+                        'samples': [],
+                        'unique_keys': []
+                    })
+                    info['columns'].append([col_name, col_type, key or ""])
+                
+                # Primary and unique keys, page cursors need one to order rows unambiguously
+                cursor.execute("""
+                    SELECT TABLE_NAME, INDEX_NAME, COLUMN_NAME
+                    FROM information_schema.STATISTICS
+                    WHERE TABLE_SCHEMA = DATABASE() AND NON_UNIQUE = 0
+                    ORDER BY TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX
+                """)
+                unique_keys = OrderedDict()
+                for table_name, index_name, col_name in cursor.fetchall():
+                    if table_name in tables:
+                        unique_keys.setdefault((table_name, index_name), []).append(col_name)
+                for (table_name, _), key_columns in unique_keys.items():
+                    tables[table_name]['unique_keys'].append(key_columns)
+                
+                if tables and SCHEMA_CONFIG['sample_rows']:
+                    samples = []
+                    for table_name, info in tables.items():
+                        columns = ", ".join(f"`{col_name}`" for col_name, _, _ in info['columns'])
+                        samples.append(
+                            f"(SELECT %s, JSON_ARRAY({columns}) FROM `{table_name}` "
+                            f"LIMIT {SCHEMA_CONFIG['sample_rows']})"
+                        )
+                    cursor.execute(" UNION ALL ".join(samples), tuple(tables))
+                    for table_name, row in cursor.fetchall():
+                        tables[table_name]['samples'].append(json.loads(row))
+            finally:
+                cursor.close()
     
     except mysql.connector.Error as e:
         logger.error(f"Schema extraction failed: {e}")
         raise
-    finally:
-        cursor.close()
     
-    schema_cache = "\n".join(schema_info)
-    return schema_cache
+    return {
+        'text': schema_render(tables, tables),
+        'tables': tables,
+        'rollups': rollups,
+        'fingerprint': schema_fingerprint(tables),
+        'built_at': time.time()
+    }
 
-def db_execute_query(sql):
-    global db_connection
+def schema_render(tables, table_names, include_samples=True):
+    schema_info = []
+    for table_name in table_names:
+        info = tables[table_name]
+        schema_info.append(f"\nTable: {table_name} (~{info['row_estimate']} rows)")
+        for col_name, col_type, key in info['columns']:
+            key_info = f" ({key})" if key else ""
+            schema_info.append(f"  - {col_name}: {col_type}{key_info}")
+        if include_samples and info['samples']:
+            schema_info.append(f"  Sample data: {json.dumps(info['samples'])}")
+    return "\n".join(schema_info)
+
+def estimate_tokens(text):
+    """Rough BPE token count: words and punctuation marks"""
+    return len(TOKEN_PATTERN.findall(text))
+
+def schema_select_tables(natural_query, tables):
+    """Rank the tables a question is about, best first"""
+    question = natural_query.lower()
+    segments = set()
+    for pattern, segment in SEGMENT_PATTERNS:
+        if pattern.search(question):
+            segments.add(segment)
+            question = pattern.sub(' ', question)
     
-    if not db_connection or not db_connection.is_connected():
-        if not db_connect():
-            return {"success": False, "error": "Database connection failed"}
+    words = set(re.findall(r'\w+', natural_query.lower()))
+    scores = {}
+    for table_name, info in tables.items():
+        name = table_name.lower()
+        score = 0
+        if name in natural_query.lower():
+            score += 100
+        score += 10 * len(segments & set(name.split('_')))
+        if score:
+            # Column matches only break ties between tables the question already names
+            score += sum(1 for col_name, _, _ in info['columns']
+                         if words & set(COLUMN_GLOSSARY.get(col_name, ((), ()))[1]))
+            scores[table_name] = score
     
-    cursor = db_connection.cursor()
+    if not scores:
+        default = PROMPT_CONFIG['default_table']
+        return [name for name in tables if name.lower() == default] or list(tables)[:1]
+    return sorted(scores, key=lambda name: -scores[name])
+
+def schema_prune(natural_query, snapshot):
+    """Schema text and column glossary limited to the tables the question is about, within the token budget"""
+    tables = snapshot['tables']
+    selected = schema_select_tables(natural_query, tables)
     
-    try:
-        cursor.execute(sql)
-        
-        if cursor.description:  # SELECT query
-            columns = [desc[0] for desc in cursor.description]
-            rows = cursor.fetchall()
-            return {
-                "success": True,
-                "columns": columns,
-                "rows": rows,
-                "row_count": len(rows)
-            }
-        else:  # Non-SELECT query
-            db_connection.commit()
-            return {
-                "success": True,
-                "affected_rows": cursor.rowcount,
-                "message": "Query executed successfully"
-            }
+    present = {col_name for name in selected for col_name, _, _ in tables[name]['columns']}
+    glossary = "\n".join(f"- {col_name}: {description}"
+                         for col_name, (description, _) in COLUMN_GLOSSARY.items() if col_name in present)
     
-    except mysql.connector.Error as e:
-        logger.error(f"Query execution failed: {e}")
+    # Drop sample rows first, then the lowest ranked tables, until the budget is met
+    budget = PROMPT_CONFIG['schema_token_budget'] - estimate_tokens(glossary)
+    schema = schema_render(tables, selected)
+    if estimate_tokens(schema) > budget:
+        schema = schema_render(tables, selected, include_samples=False)
+    while len(selected) > 1 and estimate_tokens(schema) > budget:
+        selected = selected[:-1]
+        schema = schema_render(tables, selected, include_samples=False)
+    return schema, glossary
+
+def db_get_schema_snapshot():
+    """Current schema snapshot, built on the spot only if the startup build hasn't finished"""
+    if schema_snapshot is None:
+        with schema_build_lock:
+            if schema_snapshot is None:
+                schema_install(db_build_schema_snapshot())
+    return schema_snapshot
+
+def db_get_schema():
+    return db_get_schema_snapshot()['text']
+
+def schema_install(snapshot, warm_up=True):
+    global schema_snapshot
+    previous, schema_snapshot = schema_snapshot, snapshot
+    if previous is None or previous['fingerprint'] != snapshot['fingerprint']:
+        logger.info(f"Schema snapshot {snapshot['fingerprint']} built with {len(snapshot['tables'])} tables")
+        sql_cache_check_schema(snapshot['fingerprint'])
+        if warm_up and PROMPT_CONFIG['stable_prefix'] and PROMPT_CONFIG['warm_up']:
+            threading.Thread(target=llm_warm_prefix, args=(snapshot,), name="llm-warm-up", daemon=True).start()
+
+def schema_refresh():
+    """Rebuild the snapshot, readers keep using the old one until the new one is ready"""
+    with schema_build_lock:
+        schema_install(db_build_schema_snapshot())
+    return schema_snapshot
+
+def schema_refresh_loop():
+    # A snapshot inherited from a pre-fork master is current, wait a full interval before rebuilding it
+    if schema_snapshot is not None and schema_refresh_stop.wait(SCHEMA_CONFIG['refresh_seconds']):
+        return
+    while True:
+        try:
+            schema_refresh()
+        except Exception as e:
+            logger.error(f"Background schema refresh failed: {e}")
+        if schema_refresh_stop.wait(SCHEMA_CONFIG['refresh_seconds']):
+            return
+
+def schema_start_refresher():
+    """Build the schema in the background at startup and keep it fresh on a timer"""
+    global schema_refresher
+    if schema_refresher is not None and schema_refresher.is_alive():
+        return
+    schema_refresh_stop.clear()
+    schema_refresher = threading.Thread(target=schema_refresh_loop, name="schema-refresh", daemon=True)
+    schema_refresher.start()
+
+def db_table_versions():
+    """Per-table load versions written by conversion.py, re-read at most every poll interval"""
+    global table_versions, table_versions_checked
+    poll_seconds = RESULT_CACHE_CONFIG['version_poll_seconds']
+    if time.monotonic() - table_versions_checked < poll_seconds:
+        return table_versions
+    
+    with table_versions_lock:
+        if time.monotonic() - table_versions_checked < poll_seconds:
+            return table_versions
+        try:
+            with db_borrow() as connection:
+                cursor = connection.cursor()
+                try:
+                    cursor.execute(f"SELECT table_name, version FROM {RESULT_CACHE_CONFIG['version_table']}")
+                    table_versions = {name.lower(): version for name, version in cursor.fetchall()}
+                finally:
+                    cursor.close()
+        except mysql.connector.ProgrammingError:
+            # Nothing has been loaded through conversion.py yet
+            table_versions = {}
+        table_versions_checked = time.monotonic()
+    return table_versions
+
+class QueryRejected(ValueError):
+    """A statement refused before execution, the message says why"""
+
+def sql_mask_literals(sql):
+    """Replace string literals with placeholders, returns (masked_sql, literals)"""
+    literals = []
+    def mask(match):
+        literals.append(match.group(0))
+        return f"\x00{len(literals) - 1}\x00"
+    return SQL_STRING_PATTERN.sub(mask, sql), literals
+
+def sql_unmask_literals(sql, literals):
+    return re.sub(r'\x00(\d+)\x00', lambda match: literals[int(match.group(1))], sql)
+
+def sql_outer_select(sql):
+    """(start, end) offsets of the outer SELECT's select list, after any WITH list; None if there is none"""
+    depth = 0
+    start = None
+    for match in SQL_TOKEN_PATTERN.finditer(sql):
+        text = match.group()
+        if text == '(':
+            depth += 1
+        elif text == ')':
+            depth -= 1
+        elif depth == 0 and match.lastgroup == 'word':
+            if start is None and text.upper() == 'SELECT':
+                start = match.end()
+            elif start is not None and text.upper() in SELECT_LIST_END_KEYWORDS:
+                return start, match.start()
+    return None if start is None else (start, len(sql))
+
+def guard_prepare(sql, limit, max_execution_ms):
+    """Add a LIMIT when the statement has none and a MAX_EXECUTION_TIME hint.
+    
+    Returns (sql, limit_added), limit_added is None when the statement already had a LIMIT.
+    """
+    sql = sql.strip().rstrip(';').rstrip()
+    masked, _ = sql_mask_literals(sql)
+    limit_added = None
+    if limit and not TRAILING_LIMIT_PATTERN.search(masked):
+        sql = f"{sql} LIMIT {limit}"
+        limit_added = limit
+    if max_execution_ms and 'MAX_EXECUTION_TIME' not in masked.upper():
+        # The hint belongs to the outer SELECT, which follows the WITH list of a CTE
+        select_list = sql_outer_select(sql)
+        if select_list:
+            sql = f"{sql[:select_list[0]]} /*+ MAX_EXECUTION_TIME({max_execution_ms}) */{sql[select_list[0]:]}"
+    return sql, limit_added
+
+def guard_check_plan(cursor, sql):
+    """EXPLAIN the statement and raise QueryRejected if it would examine too many rows"""
+    cursor.execute(f"EXPLAIN {sql}")
+    return guard_evaluate_plan(sql, [desc[0] for desc in cursor.description], cursor.fetchall())
+
+def guard_evaluate_plan(sql, names, rows):
+    """Row estimate of an EXPLAIN result, raises QueryRejected when it is over the limit.
+    
+    Within one SELECT each table is read once per row that survives the tables joined before
+    it (rows x filtered), and the SELECTs add up. A single-table index lookup that streams rows
+    straight out is let through whatever its estimate, because its LIMIT stops MySQL early; an
+    aggregate or a full table or index scan has to examine every row first.
+    """
+    names = [name.lower() for name in names]
+    plan = [dict(zip(names, row)) for row in rows]
+    
+    examined = {}
+    fanout = {}
+    for step in plan:
+        rows_read = max(int(step.get('rows') or 1), 1)
+        select_id = step.get('id')
+        examined[select_id] = examined.get(select_id, 0) + fanout.get(select_id, 1) * rows_read
+        filtered = float(step.get('filtered') or 100) / 100
+        fanout[select_id] = fanout.get(select_id, 1) * max(rows_read * filtered, 1)
+    estimate = int(sum(examined.values()))
+    if estimate <= GUARD_CONFIG['max_estimated_rows']:
+        return estimate
+    
+    masked = sql_mask_literals(sql)[0]
+    select_list = sql_outer_select(masked)
+    extra = " ".join(str(step.get('extra') or '') for step in plan)
+    if len(plan) == 1 and 'filesort' not in extra and 'temporary' not in extra \
+            and str(plan[0].get('type') or '').upper() not in ('ALL', 'INDEX') \
+            and select_list and not GUARD_AGGREGATE_PATTERN.search(masked[select_list[0]:select_list[1]]) \
+            and TRAILING_LIMIT_PATTERN.search(masked):
+        return estimate
+    
+    tables = ", ".join(sorted({str(step['table']) for step in plan if step.get('table')}))
+    reason = (f"Query rejected: MySQL estimates it would examine about {estimate:,} rows "
+              f"(limit {GUARD_CONFIG['max_estimated_rows']:,})")
+    if len(plan) > 1:
+        reason += f" across {tables}. Check for a missing join condition or add filters on Record_Date."
+    else:
+        reason += f" in {tables}. Add filters on Record_Date or Segment."
+    raise QueryRejected(reason)
+
+def guard_error_result(e):
+    """Result dict for a rejected, timed out or failed statement"""
+    if isinstance(e, QueryRejected):
+        return {"success": False, "error": str(e), "rejected": "row_estimate"}
+    errno = getattr(e, 'errno', None)
+    if errno is None and e.args and isinstance(e.args[0], int):
+        errno = e.args[0]  # PyMySQL/aiomysql errors carry the code as their first argument
+    if errno == ER_QUERY_TIMEOUT:
         return {
             "success": False,
-            "error": str(e)
+            "error": f"Query stopped after {GUARD_CONFIG['max_execution_ms'] / 1000:g}s, "
+                     f"narrow the date range or add filters",
+            "rejected": "timeout"
         }
-    finally:
-        cursor.close()
+    return {"success": False, "error": str(e), "error_code": errno}
 
-def db_close():
-    global db_connection
-    if db_connection and db_connection.is_connected():
-        db_connection.close()
-        logger.info("Database connection closed")
+def db_execute_query(sql):
+    try:
+        sql, limit_added = guard_prepare(sql, GUARD_CONFIG['default_limit'], GUARD_CONFIG['max_execution_ms'])
+        cache_key, tables = result_cache_plan(sql)
+        if cache_key:
+            cached = result_cache_get(cache_key)
+            if cached is not None:
+                logger.info("Result cache hit")
+                metrics.inc('rows_returned_total', cached['row_count'])
+                return cached
+            # Capture versions before running so a concurrent load invalidates this entry
+            versions = db_table_versions()
+        
+        with db_borrow() as connection:
+            cursor = connection.cursor()
+            try:
+                with span('explain'):
+                    guard_check_plan(cursor, sql)
+                with span('execute'):
+                    cursor.execute(sql)
+                
+                if cursor.description:  # SELECT query
+                    columns = [desc[0] for desc in cursor.description]
+                    with span('fetch'):
+                        rows = cursor.fetchall()
+                    metrics.inc('rows_returned_total', len(rows))
+                    result = {
+                        "success": True,
+                        "columns": columns,
+                        "rows": rows,
+                        "row_count": len(rows)
+                    }
+                    if limit_added and len(rows) >= limit_added:
+                        # Tell the user the result was cut off by the automatic LIMIT
+                        result["limit_applied"] = limit_added
+                    if cache_key:
+                        result_cache_store(cache_key, tables, versions, result)
+                    return result
+                else:  # Non-SELECT query
+                    return {
+                        "success": True,
+                        "affected_rows": cursor.rowcount,
+                        "message": "Query executed successfully"
+                    }
+            finally:
+                cursor.close()
+    
+    except (mysql.connector.Error, RuntimeError, QueryRejected) as e:
+        logger.error(f"Query execution failed: {e}")
+        result = guard_error_result(e)
+        metrics.inc('errors_total', stage=result.get('rejected') or 'database')
+        return result
 
-# LLM functions
-def llm_generate_sql(natural_query, schema):
-    prompt = f"""You are an expert SQL generator for an electricity market database. Convert natural language queries to valid MySQL SQL.
+def db_stream_query(sql, chunk_size, max_rows=None):
+    """Yield the column names, then lists of up to chunk_size rows, without buffering the result.
+    
+    The cursor is unbuffered, so rows stay on the server until fetched and memory per
+    request is bounded by chunk_size. At most max_rows rows are yielded.
+    """
+    sql, _ = guard_prepare(sql, max_rows, GUARD_CONFIG['stream_max_execution_ms'])
+    with span('pool_wait'):
+        entry = db_pool_acquire()
+    drained = False
+    cursor = None
+    try:
+        cursor = entry['connection'].cursor(buffered=False)
+        with span('explain'):
+            guard_check_plan(cursor, sql)
+        with span('execute'):
+            cursor.execute(sql)
+        if not cursor.description:
+            raise ValueError("Query did not return a result set")
+        
+        yield [desc[0] for desc in cursor.description]
+        remaining = max_rows
+        while remaining is None or remaining > 0:
+            with span('fetch'):
+                rows = cursor.fetchmany(chunk_size if remaining is None else min(chunk_size, remaining))
+            if not rows:
+                drained = True
+                break
+            metrics.inc('rows_returned_total', len(rows))
+            if remaining is not None:
+                remaining -= len(rows)
+            yield rows
+    finally:
+        if cursor is not None:
+            try:
+                cursor.close()
+            except mysql.connector.Error:
+                pass
+        # A connection with unread rows can't be reused, drop it instead of draining
+        db_pool_release(entry, discard=not drained)
+
+def db_iter_results(sql, chunk_size, max_rows=None):
+    """Like db_stream_query, but served from the result cache when possible"""
+    # Results are cached under the statement db_execute_query runs, a cut-off one is no use here
+    cache_key, _ = result_cache_plan(
+        guard_prepare(sql, GUARD_CONFIG['default_limit'], GUARD_CONFIG['max_execution_ms'])[0]
+    )
+    cached = result_cache_get(cache_key) if cache_key else None
+    if cached is not None and cached.get('limit_applied'):
+        cached = None
+    if cached is None:
+        yield from db_stream_query(sql, chunk_size, max_rows)
+        return
+    
+    logger.info("Result cache hit")
+    rows = cached['rows'] if max_rows is None else cached['rows'][:max_rows]
+    metrics.inc('rows_returned_total', len(rows))
+    yield from iter_result_chunks(cached['columns'], rows, chunk_size)
+
+def iter_result_chunks(columns, rows, chunk_size):
+    """Present an in-memory result in the same shape as db_stream_query"""
+    yield columns
+    for start in range(0, len(rows), chunk_size):
+        yield rows[start:start + chunk_size]
+
+def sql_literal(value):
+    """Render a value taken from a page cursor as a MySQL literal"""
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    text = str(value).replace("\\", "\\\\").replace("'", "''")
+    return f"'{text}'"
+
+def keyset_condition(key_columns, after):
+    """(a, b) > (x, y) spelled out as OR-ed prefixes so MySQL can use an index range.
+    
+    NULLs sort first as in ORDER BY, so rows with a NULL in the key aren't dropped.
+    """
+    clauses = []
+    for i, column in enumerate(key_columns):
+        terms = [f"`{prev}` <=> {sql_literal(value)}" for prev, value in zip(key_columns[:i], after)]
+        if after[i] is None:
+            terms.append(f"`{column}` IS NOT NULL")
+        else:
+            terms.append(f"`{column}` > {sql_literal(after[i])}")
+        clauses.append("(" + " AND ".join(terms) + ")")
+    return " OR ".join(clauses)
 
-Database Schema:
-{schema}
+def keyset_equals(key_columns, values):
+    return " AND ".join(f"`{column}` <=> {sql_literal(value)}" for column, value in zip(key_columns, values))
 
-Key columns explained:
-- Segment: Market segment (e.g., DAM - Day Ahead Market, RTM - Real Time Market)
-- Record_Date: Date of the record(YYYY-MM-DD format)
-- Record_Hour: Hour of the day (0-23)
-- Time_Block: Time block identifier
-- Purchase_Bid_MW: Purchase bid in megawatts
-- Sell_Bid_MW: Sell bid in megawatts
-- MCV_MW: Market Clearing Volume in megawatts
-- Final_Scheduled_Volume_MW: Final scheduled volume in megawatts
-- MCP_Rs_MWh: Market Clearing Price in Rupees per MWh
-- MCP_Rs_MW: Market Clearing Price in Rupees per MW
+def paginate_key_columns(sql, columns, snapshot):
+    """Keyset sort key for sql's result columns, or None if the result must be returned whole.
+    
+    Only a single-table SELECT without its own ORDER BY, LIMIT, grouping, DISTINCT or set
+    operation qualifies, and its result must carry one of the table's unique keys, so the
+    order is total and no row is skipped or repeated between pages.
+    """
+    tokens = sql_tokens(sql)
+    depth = 0
+    for kind, text in tokens:
+        if text == '(':
+            depth += 1
+        elif text == ')':
+            depth -= 1
+        elif depth == 0 and kind == 'word' and text.upper() in SQL_PAGE_BLOCKING_KEYWORDS:
+            return None
+    scan = sql_scan(tokens)
+    if len(scan['tables']) != 1 or scan['opaque']:
+        return None
+    info = next((info for name, info in snapshot['tables'].items() if name.lower() == scan['tables'][0]), None)
+    if info is None:
+        return None
+    
+    # Select-list aliases may reuse a column name for some other expression
+    by_name = {column.lower(): column for column in columns if column.lower() not in scan['names']}
+    unique_keys = [[name.lower() for name in key] for key in info.get('unique_keys', [])]
+    unique_keys = [key for key in unique_keys if all(name in by_name for name in key)]
+    if not unique_keys:
+        return None
+    for candidate in PAGINATION_CONFIG['key_candidates']:
+        names = [name.lower() for name in candidate]
+        if 'segment' in by_name and 'segment' not in names:
+            names.append('segment')
+        if all(name in by_name for name in names) and any(set(key) <= set(names) for key in unique_keys):
+            return [by_name[name] for name in names]
+    return [by_name[name] for name in unique_keys[0]]
+
+def encode_page_cursor(sql, key_columns, after, page_size):
+    payload = json.dumps(
+        {'sql': sql, 'key': key_columns, 'after': after, 'size': page_size},
+        default=lambda value: str(value) if isinstance(value, (Decimal, timedelta)) else json_default(value),
+        separators=(',', ':')
+    )
+    body = base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+    signature = hmac.new(PAGINATION_CONFIG['secret'].encode(), body.encode(), hashlib.sha256).hexdigest()[:32]
+    return f"{body}.{signature}"
+
+def decode_page_cursor(token):
+    body, _, signature = token.rpartition('.')
+    expected = hmac.new(PAGINATION_CONFIG['secret'].encode(), body.encode(), hashlib.sha256).hexdigest()[:32]
+    if not body or not hmac.compare_digest(signature, expected):
+        raise ValueError("Invalid or expired page cursor")
+    return json.loads(base64.urlsafe_b64decode(body + '=' * (-len(body) % 4)))
+
+def db_fetch_page(sql, page_size, key_columns=None, after=None):
+    """Fetch one keyset page of sql's result, ordered by key_columns and starting after the key tuple `after`.
+    
+    On the first page the key is picked from the result columns and the table's unique keys.
+    Results without a usable key are returned whole, without a next_cursor.
+    """
+    inner = sql.strip().rstrip(';')
+    if key_columns is None:
+        # LIMIT 0 is resolved by the optimizer without reading any rows
+        probe = db_execute_query(f"SELECT * FROM ({inner}) AS page_src LIMIT 0")
+        if probe['success']:
+            key_columns = paginate_key_columns(inner, probe['columns'], db_get_schema_snapshot())
+        if key_columns is None:
+            result = db_execute_query(sql)
+            return dict(result, next_cursor=None) if result['success'] else result
+    
+    where = f" WHERE {keyset_condition(key_columns, after)}" if after else ""
+    order = ", ".join(f"`{column}`" for column in key_columns)
+    # Fetch one extra row to know whether another page exists
+    result = db_execute_query(f"SELECT * FROM ({inner}) AS page_src{where} ORDER BY {order} LIMIT {page_size + 1}")
+    if not result['success']:
+        return result
+    
+    rows = result['rows']
+    next_cursor = None
+    if len(rows) > page_size:
+        key_indexes = [result['columns'].index(column) for column in key_columns]
+        last = [rows[page_size - 1][i] for i in key_indexes]
+        if None in last and [rows[page_size][i] for i in key_indexes] == last:
+            # A unique key only repeats with a NULL in it, the tied rows all go on this page
+            tied = db_execute_query(f"SELECT * FROM ({inner}) AS page_src WHERE {keyset_equals(key_columns, last)}")
+            if not tied['success']:
+                return tied
+            rows = [row for row in rows[:page_size] if [row[i] for i in key_indexes] != last] + tied['rows']
+        else:
+            rows = rows[:page_size]
+        next_cursor = encode_page_cursor(sql, key_columns, last, page_size)
+    return dict(result, rows=rows, row_count=len(rows), next_cursor=next_cursor)
+
+def db_pool_close():
+    global db_pool
+    with db_pool_lock:
+        pool, db_pool = db_pool, None
+    if pool is None:
+        return
+    
+    closed = 0
+    while True:
+        try:
+            entry = pool.get_nowait()
+        except queue.Empty:
+            break
+        if entry is not None:
+            db_close_entry(entry)
+            closed += 1
+    logger.info(f"Database pool closed ({closed} connections)")
+
+# LLM backend pool
+class LLMUnavailable(requests.ConnectionError):
+    """Every backend's circuit breaker is open"""
+
+class LLMBackend:
+    def __init__(self, url, connections):
+        self.url = url.rstrip('/')
+        self.connections = connections
+        self.session = self.open_session()
+        self.outstanding = 0
+        self.failures = 0
+        self.open = False
+    
+    def open_session(self):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.connections)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+class LLMPool:
+    """Least-outstanding-requests balancing over several model servers, with
+    per-backend circuit breakers and optional hedging at the recent p90 latency"""
+    
+    def __init__(self, urls, config):
+        if not urls:
+            raise ValueError("At least one LLM endpoint is required")
+        self.config = config
+        self.backends = [LLMBackend(url, config['connections_per_backend']) for url in urls]
+        self.latencies = deque(maxlen=config['latency_window'])
+        self.lock = threading.Lock()
+        self.next_index = 0
+    
+    def acquire(self, exclude=()):
+        """Claim the closed backend with the fewest requests in flight, rotating between ties"""
+        with self.lock:
+            count = len(self.backends)
+            candidates = [self.backends[(self.next_index + i) % count] for i in range(count)]
+            candidates = [backend for backend in candidates if not backend.open and backend not in exclude]
+            if not candidates:
+                raise LLMUnavailable("No LLM backend available, every circuit breaker is open")
+            backend = min(candidates, key=lambda candidate: candidate.outstanding)
+            backend.outstanding += 1
+            self.next_index = (self.next_index + 1) % count
+            return backend
+    
+    def release(self, backend, error=None, elapsed=None, completed=True):
+        """Return a claimed backend; completed=False (e.g. a cancelled hedge) leaves its health alone"""
+        with self.lock:
+            backend.outstanding -= 1
+            if not completed:
+                return
+            if error is None:
+                backend.failures = 0
+                if elapsed is not None:
+                    self.latencies.append(elapsed)
+            elif self.backend_fault(error):
+                self.record_failure(backend)
+    
+    @staticmethod
+    def backend_fault(error):
+        """Connection errors, timeouts and 5xx count against the backend, a 4xx is the request's fault"""
+        # requests errors carry the response, aiohttp ones the status
+        status = getattr(error, 'status', None) or getattr(getattr(error, 'response', None), 'status_code', None)
+        return status is None or status >= 500
+    
+    def record_failure(self, backend):
+        backend.failures += 1
+        if not backend.open and backend.failures >= self.config['failure_threshold']:
+            backend.open = True
+            metrics.inc('llm_breaker_opens_total', backend=backend.url)
+            logger.warning(f"LLM backend {backend.url} circuit opened after {backend.failures} failures")
+    
+    def hedge_delay(self):
+        if not self.config['hedge'] or len(self.backends) < 2:
+            return None
+        with self.lock:
+            if len(self.latencies) < self.config['hedge_min_samples']:
+                return None
+            delay = quantile(sorted(self.latencies), self.config['hedge_quantile'])
+        return max(delay, self.config['hedge_min_seconds'])
+    
+    def send(self, backend, path, payload, timeout):
+        """POST to a backend already claimed with acquire, and release it"""
+        started = time.perf_counter()
+        try:
+            response = backend.session.post(f"{backend.url}{path}", json=payload, timeout=timeout)
+            response.raise_for_status()
+            result = response.json()
+        except requests.RequestException as e:
+            self.release(backend, error=e)
+            metrics.inc('llm_requests_total', backend=backend.url, outcome='error')
+            raise
+        self.release(backend, elapsed=time.perf_counter() - started)
+        metrics.inc('llm_requests_total', backend=backend.url, outcome='ok')
+        return result
+    
+    def request(self, path, payload, timeout, hedge=True):
+        """JSON response from the least busy backend. With hedging on, a request still running
+        after the p90 latency is duplicated to another backend and the first answer wins; the
+        loser is left to finish in the background."""
+        primary = self.acquire()
+        delay = self.hedge_delay() if hedge else None
+        if delay is None or delay >= timeout:
+            return self.send(primary, path, payload, timeout)
+        
+        first = llm_hedge_executor.submit(self.send, primary, path, payload, timeout)
+        if wait([first], timeout=delay).done:
+            return first.result()
+        try:
+            secondary = self.acquire(exclude=(primary,))
+        except LLMUnavailable:
+            return first.result()
+        
+        metrics.inc('llm_hedges_total')
+        second = llm_hedge_executor.submit(self.send, secondary, path, payload, timeout - delay)
+        error = None
+        for future in as_completed([first, second]):
+            try:
+                result = future.result()
+            except requests.RequestException as e:
+                error = error or e
+                continue
+            if future is second:
+                metrics.inc('llm_hedge_wins_total')
+            return result
+        raise error
+    
+    @contextmanager
+    def stream(self, path, payload, timeout):
+        """Streaming POST to the least busy backend; never hedged, tokens may already be on screen"""
+        backend = self.acquire()
+        error = None
+        try:
+            with backend.session.post(f"{backend.url}{path}", json=payload, timeout=timeout, stream=True) as response:
+                response.raise_for_status()
+                yield response
+        except requests.RequestException as e:
+            error = e
+            raise
+        finally:
+            self.release(backend, error=error)
+            metrics.inc('llm_requests_total', backend=backend.url, outcome='error' if error else 'ok')
+    
+    def request_each(self, path, payload, timeout):
+        """Send the same request to every closed backend, e.g. to warm each server's prompt cache"""
+        succeeded = 0
+        for backend in self.backends:
+            with self.lock:
+                if backend.open:
+                    continue
+                backend.outstanding += 1
+            try:
+                self.send(backend, path, payload, timeout)
+                succeeded += 1
+            except requests.RequestException as e:
+                logger.warning(f"LLM backend {backend.url} request failed: {e}")
+        return succeeded
+    
+    def probe(self):
+        """Health check every backend: a good probe closes an open breaker, a bad one counts as a failure"""
+        for backend in self.backends:
+            try:
+                response = backend.session.get(f"{backend.url}{self.config['probe_path']}",
+                                               timeout=self.config['probe_timeout_seconds'])
+                response.raise_for_status()
+            except requests.RequestException as e:
+                with self.lock:
+                    if self.backend_fault(e):
+                        self.record_failure(backend)
+                continue
+            with self.lock:
+                if backend.open:
+                    logger.info(f"LLM backend {backend.url} circuit closed after a good health probe")
+                backend.open = False
+                backend.failures = 0
+    
+    def reset(self):
+        """Fresh keep-alive sessions and in-flight counts, so no socket is shared across a fork"""
+        with self.lock:
+            for backend in self.backends:
+                backend.session.close()
+                backend.session = backend.open_session()
+                backend.outstanding = 0
+    
+    def stats(self):
+        with self.lock:
+            return [{
+                'url': backend.url,
+                'outstanding': backend.outstanding,
+                'failures': backend.failures,
+                'open': backend.open
+            } for backend in self.backends]
+
+llm_pool = LLMPool(LLM_CONFIG['endpoints'], LLM_POOL_CONFIG)
+llm_hedge_executor = ThreadPoolExecutor(max_workers=LLM_POOL_CONFIG['hedge_workers'], thread_name_prefix="llm-hedge")
+llm_probe_stop = threading.Event()
+llm_prober = None
+
+def llm_probe_loop():
+    while not llm_probe_stop.wait(LLM_POOL_CONFIG['probe_interval_seconds']):
+        try:
+            llm_pool.probe()
+        except Exception as e:
+            logger.error(f"LLM health probe failed: {e}")
+
+def llm_start_prober():
+    global llm_prober
+    if llm_prober is not None and llm_prober.is_alive():
+        return
+    llm_probe_stop.clear()
+    llm_prober = threading.Thread(target=llm_probe_loop, name="llm-probe", daemon=True)
+    llm_prober.start()
+
+# LLM functions
+def llm_render_prefix(schema, glossary):
+    return f"""You are an expert SQL generator for an electricity market database. Convert natural language queries to valid MySQL SQL.
 
 Rules:
 1. Generate ONLY SELECT statements for safety
 2. Use proper MySQL syntax
 3. Return ONLY the SQL query, no explanations or additional text
-4. For date comparisons, use DATE() function or proper date format
+4. Record_Date is a DATE, compare it directly or with a half-open range (Record_Date >= '2024-01-01' AND Record_Date < '2024-02-01'), never wrapped in DATE(), YEAR() or MONTH()
 5. Use LIMIT when appropriate for large results
 6. Common queries involve aggregations by date, hour, segment
 7. When asked about "last month", "yesterday", use appropriate date functions
@@ -158,113 +1776,1203 @@ Rules:
 11. If the table name is not specified, assume the query is for energy_bids_dam.
 Examples:
 - "Show all data" → SELECT * FROM table_name LIMIT 100;
-- "Data for today" → SELECT * FROM table_name WHERE DATE(Record_Date) = CURDATE();
+- "Data for today" → SELECT * FROM table_name WHERE Record_Date = CURDATE();
 - "Average price by segment" → SELECT Segment, AVG(MCP_Rs_MWh) FROM table_name GROUP BY Segment;
 
-Natural Language Query: {natural_query}
+Key columns explained:
+{glossary}
 
-SQL Query:"""
+Database Schema:
+{schema}"""
 
+def llm_prompt_prefix(natural_query, snapshot):
+    """Pruned system prompt for the tables a question is about, rendered once per table set and schema fingerprint.
+    
+    Row estimates and sample rows change between refreshes without changing the
+    fingerprint; pinning the first rendering keeps each prefix byte-stable so the
+    server's prompt cache stays valid."""
+    global prompt_prefixes
+    fingerprint, cached = prompt_prefixes
+    if fingerprint != snapshot['fingerprint']:
+        cached = {}
+        prompt_prefixes = (snapshot['fingerprint'], cached)
+    
+    selected = tuple(schema_select_tables(natural_query, snapshot['tables']))
+    text = cached.get(selected)
+    if text is None:
+        text = cached.setdefault(selected, llm_render_prefix(*schema_prune(natural_query, snapshot)))
+        logger.info(f"Prompt prefix for {', '.join(selected)} pinned for schema {snapshot['fingerprint']} "
+                    f"({estimate_tokens(text)} tokens est.)")
+    return text
+
+def llm_build_payload(natural_query, snapshot, stream=False):
+    question = f"Natural Language Query: {natural_query}\n\nSQL Query:"
+    if PROMPT_CONFIG['stable_prefix']:
+        system = llm_prompt_prefix(natural_query, snapshot)
+    else:
+        system = llm_render_prefix(*schema_prune(natural_query, snapshot))
+    full_glossary = "\n".join(f"- {col_name}: {description}" for col_name, (description, _) in COLUMN_GLOSSARY.items())
+    prompt_tokens = estimate_tokens(system) + estimate_tokens(question)
+    unpruned_tokens = estimate_tokens(llm_render_prefix(snapshot['text'], full_glossary)) + estimate_tokens(question)
+    logger.info(f"Prompt tokens (est.): {unpruned_tokens} before pruning, {prompt_tokens} after")
+    
     payload = {
         "model": LLM_CONFIG['model_name'],
         "messages": [
+            {
+                "role": "system",
+                "content": system
+            },
             {
                 "role": "user",
-                "content": prompt
+                "content": question
             }
         ],
         "temperature": LLM_CONFIG['temperature'],
         "max_tokens": LLM_CONFIG['max_tokens'],
-        "stream": False
+        "stream": stream
     }
+    payload.update(LLM_CONFIG['request_options'])
+    return payload
+
+def llm_warm_prefix(snapshot):
+    """Prefill the default table's prompt prefix so the first real question doesn't pay for it"""
+    payload = llm_build_payload("Show all data", snapshot)
+    payload['max_tokens'] = 1
+    with span('llm_warm_up'):
+        warmed = llm_pool.request_each("/v1/chat/completions", payload, LLM_CONFIG['warm_up_timeout'])
+    logger.info(f"LLM prompt prefix for schema {snapshot['fingerprint']} warmed on {warmed}/{len(llm_pool.backends)} backends")
+
+def llm_generate_sql(natural_query, snapshot):
+    payload = llm_build_payload(natural_query, snapshot)
     
     try:
-        response = requests.post(
-            f"{LLM_CONFIG['endpoint']}/v1/chat/completions",
-            json=payload,
-            timeout=30
-        )
-        response.raise_for_status()
-        
-        result = response.json()
-        sql_query = result["choices"][0]["message"]["content"].strip()
+        with span('llm_request'):
+            result = llm_pool.request("/v1/chat/completions", payload, LLM_CONFIG['timeout_seconds'])
+        return llm_completion_sql(payload, result)
         
-        # Clean up the SQL query
+    except requests.RequestException as e:
+        logger.error(f"LLM request failed: {e}")
+        metrics.inc('errors_total', stage='llm')
+        raise
+
+def llm_completion_sql(payload, result):
+    """Cleaned SQL from a chat completion response"""
+    sql_query = result["choices"][0]["message"]["content"].strip()
+    llm_count_tokens(payload, sql_query, result.get("usage"))
+    
+    # Clean up the SQL query
+    with span('clean_sql'):
         sql_query = clean_sql(sql_query)
+    
+    logger.info(f"Generated SQL: {sql_query}")
+    return sql_query
+
+def llm_count_tokens(payload, completion, usage=None):
+    """Add to the token counters, from the server's usage block when it sends one"""
+    usage = usage or {}
+    prompt_tokens = usage.get("prompt_tokens")
+    if prompt_tokens is None:
+        prompt_tokens = sum(estimate_tokens(message["content"]) for message in payload["messages"])
+    completion_tokens = usage.get("completion_tokens")
+    if completion_tokens is None:
+        completion_tokens = estimate_tokens(completion)
+    metrics.inc('llm_prompt_tokens_total', prompt_tokens)
+    metrics.inc('llm_completion_tokens_total', completion_tokens)
+
+def llm_stream_sql(natural_query, snapshot):
+    """Yield raw SQL text fragments as the model produces them"""
+    payload = llm_build_payload(natural_query, snapshot, stream=True)
+    parts = []
+    
+    try:
+        with llm_pool.stream("/v1/chat/completions", payload, LLM_CONFIG['timeout_seconds']) as response:
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith('data:'):
+                    continue
+                data = line[len('data:'):].strip()
+                if data == '[DONE]':
+                    break
+                
+                choices = json.loads(data).get("choices") or [{}]
+                token = (choices[0].get("delta") or {}).get("content")
+                if token:
+                    parts.append(token)
+                    yield token
+        llm_count_tokens(payload, ''.join(parts))
+    
+    except requests.RequestException as e:
+        logger.error(f"LLM streaming request failed: {e}")
+        metrics.inc('errors_total', stage='llm')
+        raise
+
+def llm_repair_payload(natural_query, sql, error, snapshot):
+    """Short follow-up prompt: the failed SQL, the error and the columns of the tables it used,
+    instead of the full schema prompt"""
+    referenced = sql_referenced_tables(sql)
+    tables = snapshot['tables']
+    lines = [f"- {name}: {', '.join(col_name for col_name, _, _ in info['columns'])}"
+             for name, info in tables.items() if name.lower() in referenced]
+    if not lines:
+        lines = [f"- {name}: {', '.join(col_name for col_name, _, _ in info['columns'])}"
+                 for name, info in tables.items()]
+    columns = "\n".join(lines)
+    
+    prompt = f"""This MySQL query was generated for the question below and failed.
+
+Question: {natural_query}
+SQL: {sql}
+Error: {error}
+
+Available columns:
+{columns}
+
+Return ONLY the corrected SELECT query, no explanations."""
+    
+    payload = {
+        "model": LLM_CONFIG['model_name'],
+        "messages": [
+            {
+                "role": "user",
+                "content": prompt
+            }
+        ],
+        "temperature": LLM_CONFIG['temperature'],
+        "max_tokens": REPAIR_CONFIG['max_tokens']
+    }
+    return payload
+
+def llm_repair_sql(natural_query, sql, error, snapshot, timeout):
+    """Ask the model to fix SQL that MySQL rejected"""
+    payload = llm_repair_payload(natural_query, sql, error, snapshot)
+    try:
+        with span('llm_repair'):
+            result = llm_pool.request("/v1/chat/completions", payload, timeout)
         
-        logger.info(f"Generated SQL: {sql_query}")
-        return sql_query
+        repaired = result["choices"][0]["message"]["content"].strip()
+        llm_count_tokens(payload, repaired, result.get("usage"))
+        return clean_sql(repaired)
+    
+    except requests.RequestException as e:
+        logger.error(f"LLM repair request failed: {e}")
+        metrics.inc('errors_total', stage='llm')
+        raise
+
+def llm_complete_batch(prompts):
+    """Raw completions for several prompts in one /v1/completions request, in prompt order"""
+    payload = {
+        "model": LLM_CONFIG['model_name'],
+        "prompt": prompts,
+        "temperature": LLM_CONFIG['temperature'],
+        "max_tokens": LLM_CONFIG['max_tokens']
+    }
+    payload.update(LLM_CONFIG['request_options'])
+    try:
+        # Not hedged, a duplicate batch would double the load on the busiest path
+        result = llm_pool.request("/v1/completions", payload, LLM_CONFIG['timeout_seconds'] * len(prompts), hedge=False)
         
+        choices = sorted(result["choices"], key=lambda choice: choice.get("index", 0))
+        if len(choices) != len(prompts):
+            raise ValueError(f"Expected {len(prompts)} completions, got {len(choices)}")
+        return [choice["text"].strip() for choice in choices]
+    
     except requests.RequestException as e:
-        logger.error(f"LLM request failed: {e}")
+        logger.error(f"Batched LLM request failed: {e}")
         raise
 
-def clean_sql(sql):
-    """Clean and validate generated SQL"""
-    # Remove markdown code blocks if present
-    sql = re.sub(r'```sql\s*', '', sql, flags=re.IGNORECASE)
-    sql = re.sub(r'```\s*', '', sql)
-    
-    # Remove any explanatory text before SELECT
-    sql = re.sub(r'^.*?SELECT', 'SELECT', sql, flags=re.IGNORECASE | re.DOTALL)
-    
-    # Remove trailing explanations after semicolon
-    sql = sql.split(';')[0] + ';'
-    
-    # Remove any remaining explanatory text after the query
-    lines = sql.split('\n')
-    sql_lines = []
-    for line in lines:
-        stripped = line.strip()
-        if stripped and not stripped.startswith('--') and not stripped.startswith('#'):
-            sql_lines.append(line)
-        elif not stripped:  # Keep empty lines within the query
-            sql_lines.append(line)
+class SQLValidationError(ValueError):
+    """Generated SQL names a table or column the schema doesn't have; errno is MySQL's code for the same error"""
+    
+    def __init__(self, message, errno):
+        super().__init__(message)
+        self.errno = errno
+
+def sql_tokens(sql):
+    """Significant (kind, text) tokens of a statement: whitespace and comments dropped"""
+    return [(match.lastgroup, match.group()) for match in SQL_TOKEN_PATTERN.finditer(sql)
+            if match.lastgroup not in ('space', 'comment')]
+
+def sql_identifier(kind, text):
+    """Name of a word or backtick-quoted token, None for keywords and anything else"""
+    if kind == 'quoted':
+        return text[1:-1].replace('``', '`')
+    if kind == 'word' and text.upper() not in SQL_KEYWORDS and not text.startswith('@'):
+        return text
+    return None
+
+def sql_scan(tokens):
+    """Classify the identifiers of a SELECT in one pass over its tokens.
+    
+    Returns a dict of tables (lowercased names in FROM/JOIN), aliases (alias -> table, None
+    for derived tables), opaque (derived-table and CTE names and aliases, whose columns
+    aren't known), names (select-list aliases) and columns ((qualifier or None, column) references).
+    """
+    scan = {'tables': [], 'aliases': {}, 'opaque': set(), 'names': set(), 'columns': []}
+    ctes = set()
+    # One frame per open parenthesis: whether it is a function call, where its FROM list is,
+    # whether it is in a WITH list
+    frames = [{'call': False, 'from': False, 'expect': None, 'derived': False, 'with': False}]
+    value_end = False  # previous token ends an operand, so a following name is an alias
+    i = 0
+    while i < len(tokens):
+        kind, text = tokens[i]
+        upper = text.upper()
+        frame = frames[-1]
+        next_text = tokens[i + 1][1] if i + 1 < len(tokens) else ''
+        name = sql_identifier(kind, text)
+        
+        if text == '(' and frame['expect'] == 'cte_columns':
+            while i + 1 < len(tokens) and tokens[i][1] != ')':
+                i += 1  # a CTE's column names, nothing to resolve
+        elif text == '(':
+            previous = tokens[i - 1] if i else ('op', '')
+            call = sql_identifier(*previous) is not None and frame['expect'] is None
+            frames.append({'call': call, 'from': False, 'expect': None, 'derived': frame['expect'] == 'table',
+                           'with': False})
+            frame['expect'] = None
+            value_end = False
+        elif text == ')':
+            if len(frames) > 1:
+                closed = frames.pop()
+                if closed['derived']:
+                    frames[-1]['expect'] = 'derived_alias'
+            value_end = True
+        elif kind == 'word' and upper == 'WITH' and next_text.upper() != 'ROLLUP':
+            frame['with'] = True
+            frame['expect'] = 'cte'
+            value_end = False
+        elif frame['expect'] == 'cte' and name is not None:
+            ctes.add(name.lower())
+            frame['expect'] = 'cte_columns'
+        elif frame['expect'] == 'cte_columns' and upper == 'AS':
+            frame['expect'] = None
+        elif text == ',' and frame['with'] and not frame['from']:
+            frame['expect'] = 'cte'
+        elif kind == 'word' and upper == 'SELECT':
+            frame['with'] = False
+            value_end = False
+        elif kind == 'word' and upper in ('FROM', 'JOIN', 'STRAIGHT_JOIN') and not frame['call']:
+            frame['from'] = True
+            frame['expect'] = 'table'
+            value_end = False
+        elif kind == 'word' and upper in SQL_FROM_END_KEYWORDS:
+            frame['from'] = False
+            frame['expect'] = None
+            value_end = False
+        elif text == ',' and frame['from']:
+            frame['expect'] = 'table'
+            value_end = False
+        elif frame['expect'] == 'table' and name is not None and name.lower() in ctes and next_text != '.':
+            scan['aliases'][name.lower()] = None
+            scan['opaque'].add(name.lower())
+            frame['expect'] = 'derived_alias'
+            value_end = True
+        elif frame['expect'] == 'table' and name is not None:
+            if next_text == '.' and i + 2 < len(tokens):
+                i += 2  # database-qualified table
+                name = sql_identifier(*tokens[i]) or tokens[i][1]
+            scan['tables'].append(name.lower())
+            scan['aliases'][name.lower()] = name.lower()
+            frame['expect'] = 'alias'
+            value_end = True
+        elif frame['expect'] in ('alias', 'derived_alias') and (upper == 'AS' or name is not None):
+            if name is not None:
+                table = scan['tables'][-1] if frame['expect'] == 'alias' else None
+                scan['aliases'][name.lower()] = table
+                if table is None:
+                    scan['opaque'].add(name.lower())
+                frame['expect'] = None
+            value_end = False
+        elif name is not None and next_text == '(':
+            value_end = False  # function call
+        elif name is not None and next_text == '.':
+            qualifier = name
+            i += 2
+            if i + 2 < len(tokens) and tokens[i + 1][1] == '.':
+                qualifier = tokens[i][1].strip('`')  # database.table.column
+                i += 2
+            if i < len(tokens):
+                column = sql_identifier(*tokens[i])
+                if column is not None:
+                    scan['columns'].append((qualifier.lower(), column))
+            value_end = True
+        elif name is not None and (value_end or (i and tokens[i - 1][1].upper() == 'AS')):
+            scan['names'].add(name.lower())  # select-list alias
+            value_end = False
+        elif name is not None:
+            scan['columns'].append((None, name))
+            value_end = True
         else:
-            break  # Stop at comments that appear after the query
+            if frame['expect'] in ('alias', 'derived_alias'):
+                frame['expect'] = None
+            value_end = kind in ('string', 'number') or upper == 'END' or (text == '*' and not value_end)
+        i += 1
+    return scan
+
+def schema_identifier_index(snapshot):
+    """{table: frozenset of columns}, lowercased, built once per schema fingerprint"""
+    global schema_identifiers
+    cached = schema_identifiers
+    if cached is not None and cached[0] == snapshot['fingerprint']:
+        return cached[1]
+    index = {name.lower(): frozenset(col_name.lower() for col_name, _, _ in info['columns'])
+             for name, info in snapshot['tables'].items()}
+    schema_identifiers = (snapshot['fingerprint'], index)
+    return index
+
+def sql_resolve(scan, index):
+    """Raise SQLValidationError for the first table or column the schema doesn't have"""
+    for table in scan['tables']:
+        if table not in index:
+            raise SQLValidationError(f"Table '{DB_CONFIG['database']}.{table}' doesn't exist", 1146)
     
-    sql = '\n'.join(sql_lines)
+    known = set()
+    for table in scan['tables']:
+        known |= index.get(table, frozenset())
+    # Columns of derived tables aren't known, so bare names can't be checked against them
+    check_bare = not scan['opaque']
+    for qualifier, column in scan['columns']:
+        name = column.lower()
+        if qualifier is None:
+            if check_bare and name not in known and name not in scan['names']:
+                raise SQLValidationError(f"Unknown column '{column}' in 'field list'", 1054)
+            continue
+        if qualifier in scan['opaque']:
+            continue
+        table = scan['aliases'].get(qualifier)
+        if table is None or table not in index:
+            raise SQLValidationError(f"Unknown column '{qualifier}.{column}' in 'field list'", 1054)
+        if name not in index[table]:
+            raise SQLValidationError(f"Unknown column '{qualifier}.{column}' in 'field list'", 1054)
+
+def clean_sql(sql, snapshot=None):
+    """Extract one read-only SELECT from model output.
     
-    # Basic validation - ensure it's a SELECT query
-    if not sql.strip().upper().startswith('SELECT'):
+    A single tokenizer pass takes everything from the first SELECT (or WITH) of the first
+    code block up to the first top-level semicolon, so text after it and semicolons inside
+    strings can't smuggle in a second statement. Comments are dropped wherever they are,
+    which also removes MySQL's executable /*! */ sections. With a snapshot, every table and
+    column must resolve against the schema.
+    """
+    # Keep only the first markdown code block, then skip any explanatory text before the query
+    fence = SQL_FENCE_PATTERN.search(sql)
+    if fence is not None:
+        sql = fence.group(1)
+    start = SQL_START_PATTERN.search(sql)
+    if start is None:
         raise ValueError("Generated query is not a SELECT statement")
     
-    return sql.strip()
+    parts = []
+    tokens = []
+    depth = 0
+    after_comment = False
+    for match in SQL_TOKEN_PATTERN.finditer(sql, start.start()):
+        kind, text = match.lastgroup, match.group()
+        if kind == 'comment':
+            # A comment on its own line after a complete query may be followed by the model's
+            # explanation, which is cut off at its first word unless that word continues the SQL
+            if text[0] != '/' and depth == 0 and (not parts or '\n' in parts[-1]):
+                after_comment = tokens and (tokens[-1][0] != 'op' or tokens[-1][1] in (')', '*'))
+            parts.append(' ')
+            continue
+        if kind == 'space':
+            parts.append(text)
+            continue
+        if text == ';' or (after_comment and kind == 'word' and text.upper() not in SQL_KEYWORDS):
+            break
+        after_comment = False
+        if text == '(':
+            depth += 1
+        elif text == ')':
+            depth -= 1
+        parts.append(text)
+        tokens.append((kind, text))
+    
+    depth = 0
+    for i, (kind, text) in enumerate(tokens):
+        if text == '(':
+            depth += 1
+        elif text == ')':
+            depth -= 1
+        elif text == ':=':
+            raise ValueError("Generated query is not read-only: variable assignment is not allowed")
+        elif kind == 'word':
+            upper = text.upper()
+            # REPLACE( is the string function, REPLACE INTO the statement
+            is_call = i + 1 < len(tokens) and tokens[i + 1][1] == '('
+            if upper in SQL_FORBIDDEN_WORDS or (depth == 0 and upper in SQL_WRITE_KEYWORDS and not is_call):
+                raise ValueError(f"Generated query is not read-only: {upper} is not allowed")
+    
+    if snapshot is not None:
+        sql_resolve(sql_scan(tokens), schema_identifier_index(snapshot))
+    return ''.join(parts).strip() + ';'
 
-# Core processing function
-def process_natural_query(natural_query):
+def sql_check(sql, snapshot):
+    """Result dict for SQL whose tables or columns don't resolve, None when it is fine.
+    
+    Run before every execution, so a bad identifier costs microseconds instead of a MySQL
+    round trip and still gets a repair prompt, with MySQL's error code and wording.
+    """
     try:
-        # Get database schema
-        schema = db_get_schema()
+        with span('validate'):
+            clean_sql(sql, snapshot)
+    except SQLValidationError as e:
+        logger.info(f"SQL rejected before execution: {e}")
+        metrics.inc('errors_total', stage='validation')
+        return {"success": False, "error": str(e), "error_code": e.errno, "rejected": "validation"}
+    return None
+
+# Rollup routing
+def rollup_aggregate(match, grain, rollup_columns):
+    """Rollup expression for one aggregate call, or None if the rollup can't answer it"""
+    function, argument = match.group(1).upper(), match.group(2).strip('`').lower()
+    if argument == '*':
+        return "SUM(`row_count`)" if function == 'COUNT' else None
+    if argument in ROLLUP_CONFIG['group_columns']:
+        # Only daily rows still carry the real dates
+        return match.group(0) if grain == 'daily' and function in ('MIN', 'MAX') else None
+    
+    total = rollup_columns.get(f"{argument}_sum")
+    if total is None:
+        return None
+    measure = total[:-len('_sum')]
+    return {
+        'SUM': f"SUM(`{measure}_sum`)",
+        'COUNT': f"SUM(`{measure}_count`)",
+        'MIN': f"MIN(`{measure}_min`)",
+        'MAX': f"MAX(`{measure}_max`)",
+        'AVG': f"(SUM(`{measure}_sum`) / SUM(`{measure}_count`))"
+    }[function]
+
+def rollup_rewrite(select, rest, grain, rollup_columns, raw_columns):
+    """Rewrite the select list and clauses of a query for one rollup grain, None if not eligible"""
+    unsupported = False
+    rewritten = 0
+    
+    def replace(match):
+        nonlocal unsupported, rewritten
+        expression = rollup_aggregate(match, grain, rollup_columns)
+        if expression is None:
+            unsupported = True
+            return match.group(0)
+        rewritten += expression != match.group(0)
+        return expression
+    
+    items = [item.strip() for item in split_select_list(select)]
+    new_items = [AGGREGATE_PATTERN.sub(replace, item) for item in items]
+    rest = AGGREGATE_PATTERN.sub(replace, rest)
+    if unsupported or not (rewritten or re.search(r'\bGROUP\s+BY\b', rest, re.IGNORECASE)):
+        return None
+    
+    # Every raw column left outside the aggregates has to exist at the rollup's grain
+    text = f"{' '.join(new_items)} {rest}"
+    if grain == 'monthly':
+        text = MONTH_GRAIN_PATTERN.sub(' ', text)
+        if re.search(r'\bRecord_Date\b', text, re.IGNORECASE):
+            return None
+    for word in re.findall(r'\w+', text):
+        if word.lower() in raw_columns and word.lower() not in ROLLUP_CONFIG['group_columns']:
+            return None
+    
+    # Keep result column names unchanged by aliasing rewritten, unaliased select items
+    select = ", ".join(
+        f"{new_item} AS `{item.replace('`', '``')}`"
+        if new_item != item and not SELECT_ALIAS_PATTERN.search(item) else new_item
+        for item, new_item in zip(items, new_items)
+    )
+    return select, rest
+
+def split_select_list(select):
+    """Split on commas outside parentheses"""
+    items, depth, start = [], 0, 0
+    for i, char in enumerate(select):
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            items.append(select[start:i])
+            start = i + 1
+    items.append(select[start:])
+    return items
+
+def rollup_route(sql):
+    """Send an aggregate query over a market table to its monthly or daily rollup when that gives the same answer.
+    
+    Rollups are only used while their version matches the market table's, i.e. they were
+    refreshed by the last load. Anything else is returned unchanged.
+    """
+    snapshot = schema_snapshot
+    if not ROLLUP_CONFIG['enabled'] or snapshot is None or not snapshot.get('rollups'):
+        return sql
+    
+    # Mask string literals so their contents are never parsed or rewritten
+    masked, literals = sql_mask_literals(re.sub(r'\s+', ' ', sql.strip()).rstrip('; '))
+    
+    match = ROLLUP_QUERY_PATTERN.match(masked)
+    if not match or ROLLUP_UNSUPPORTED_PATTERN.search(match.group('select') + match.group('rest')):
+        return sql
+    table_name = match.group('table').lower()
+    raw_info = next((info for name, info in snapshot['tables'].items() if name.lower() == table_name), None)
+    if raw_info is None:
+        return sql
+    raw_columns = {col_name.lower() for col_name, _, _ in raw_info['columns']}
+    
+    versions = db_table_versions()
+    for grain, suffix in ROLLUP_CONFIG['grains']:
+        rollup_name = f"{table_name}{suffix}"
+        rollup_columns = snapshot['rollups'].get(rollup_name)
+        if rollup_columns is None or versions.get(rollup_name) != versions.get(table_name, 0):
+            continue
+        parts = rollup_rewrite(match.group('select'), match.group('rest'), grain, rollup_columns, raw_columns)
+        if parts is None:
+            continue
+        routed = f"SELECT {parts[0]} FROM `{rollup_name}`{parts[1]};"
+        routed = sql_unmask_literals(routed, literals)
+        logger.info(f"Routed to {grain} rollup: {routed}")
+        return routed
+    return sql
+
+# Template fast path
+def template_date_condition(take):
+    """Record_Date condition for the date phrase take() finds in a question, ('', None) if it names none.
+    
+    Dates are computed here rather than with CURDATE() so MySQL sees a plain range on Record_Date.
+    Returns (None, None) for a date that doesn't exist.
+    """
+    today = date.today()
+    try:
+        match = take(TEMPLATE_PATTERNS['last_days'])
+        if match:
+            # The last N days are today and the N-1 days before it
+            days = int(match.group(1))
+            if days < 1:
+                return None, None
+            first = today - timedelta(days=days - 1)
+            return f"Record_Date >= {sql_literal(first.isoformat())}", 'last_days'
+        match = take(TEMPLATE_PATTERNS['relative_day'])
+        if match:
+            day = today if match.group(1) == 'today' else today - timedelta(days=1)
+            return f"Record_Date = {sql_literal(day.isoformat())}", 'day'
+        match = take(TEMPLATE_PATTERNS['iso_date'])
+        if match:
+            day = date(int(match.group(1)), int(match.group(2)), int(match.group(3)))
+            return f"Record_Date = {sql_literal(day.isoformat())}", 'day'
+        match = take(TEMPLATE_PATTERNS['dmy_date'])
+        if match:
+            day = date(int(match.group(3)), int(match.group(2)), int(match.group(1)))
+            return f"Record_Date = {sql_literal(day.isoformat())}", 'day'
         
-        # Generate SQL using LLM
-        sql_query = llm_generate_sql(natural_query, schema)
+        match = take(TEMPLATE_PATTERNS['relative_month'])
+        if match:
+            first = today.replace(day=1)
+            if match.group(1) != 'this':
+                first = (first - timedelta(days=1)).replace(day=1)
+        else:
+            match = take(TEMPLATE_PATTERNS['month'])
+            if match:
+                # A month without a year means the current year
+                first = date(int(match.group(2) or today.year), MONTH_NAMES[match.group(1)], 1)
+        if match:
+            last = first.replace(day=calendar.monthrange(first.year, first.month)[1])
+            return f"Record_Date BETWEEN {sql_literal(first.isoformat())} AND {sql_literal(last.isoformat())}", 'month'
         
-        # Execute SQL query
-        results = db_execute_query(sql_query)
+        match = take(TEMPLATE_PATTERNS['relative_year'])
+        if match:
+            year = today.year if match.group(1) == 'this' else today.year - 1
+        else:
+            match = take(TEMPLATE_PATTERNS['year'])
+            if not match:
+                return '', None
+            year = int(match.group(1))
+        return f"Record_Date BETWEEN {sql_literal(f'{year}-01-01')} AND {sql_literal(f'{year}-12-31')}", 'year'
+    except ValueError:
+        return None, None
+
+def template_sql(natural_query, snapshot):
+    """Return (sql, template_name) for a formulaic question, (None, None) if the LLM has to answer it.
+    
+    Market, date range, hour, aggregate and grouping phrases are taken out of the question one
+    by one. A template only matches when nothing but filler words is left over.
+    """
+    question = re.sub(r"[?!,;:'\"]|\.(?!\d)", ' ', natural_query.lower())
+    question = re.sub(r'\s+', ' ', question).strip()
+    
+    def take(pattern):
+        nonlocal question
+        match = pattern.search(question)
+        if match:
+            question = f"{question[:match.start()]} {question[match.end():]}"
+        return match
+    
+    segments = set()
+    for pattern, segment in SEGMENT_PATTERNS:
+        if pattern.search(question):
+            segments.add(segment)
+            question = pattern.sub(' ', question)
+    if len(segments) > 1:
+        return None, None
+    wanted = f"energy_bids_{segments.pop()}" if segments else PROMPT_CONFIG['default_table']
+    table_name = next((name for name in snapshot['tables'] if name.lower() == wanted), None)
+    if table_name is None:
+        return None, None
+    columns = {col_name.lower(): col_name for col_name, _, _ in snapshot['tables'][table_name]['columns']}
+    
+    conditions = []
+    date_condition, date_kind = template_date_condition(take)
+    if date_condition is None:
+        return None, None
+    if date_condition:
+        conditions.append(date_condition)
+    
+    hour = take(TEMPLATE_PATTERNS['hour'])
+    if hour:
+        if 'record_hour' not in columns or int(hour.group(1)) > 23:
+            return None, None
+        conditions.append(f"{columns['record_hour']} = {int(hour.group(1))}")
+    
+    aggregate = take(TEMPLATE_PATTERNS['aggregate'])
+    group = take(TEMPLATE_PATTERNS['group'])
+    rows = take(TEMPLATE_PATTERNS['rows'])
+    if any(word not in TEMPLATE_CONFIG['filler_words'] for word in re.findall(r'\w+', question)):
+        return None, None
+    
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    if aggregate is None:
+        if group:
+            return None, None
+        if not conditions:
+            if not rows:
+                return None, None
+            return f"SELECT * FROM {table_name} LIMIT {TEMPLATE_CONFIG['all_rows_limit']};", 'all_rows'
+        return f"SELECT * FROM {table_name}{where};", 'rows_by_hour' if hour else f"rows_by_{date_kind}"
+    
+    function = TEMPLATE_AGGREGATES[aggregate.group(1)]
+    candidates = dict(TEMPLATE_MEASURES)[re.sub(r'\s+', ' ', aggregate.group(2))]
+    measure = next((columns[name.lower()] for name in candidates if name.lower() in columns), None)
+    if measure is None:
+        return None, None
+    if group is None:
+        return f"SELECT {function}({measure}) FROM {table_name}{where};", 'aggregate'
+    
+    group_column = TEMPLATE_GROUPS[group.group(1) or group.group(2)]
+    if group_column == 'month':
+        if 'record_date' not in columns:
+            return None, None
+        return (f"SELECT YEAR(Record_Date) AS Year, MONTH(Record_Date) AS Month, {function}({measure}) "
+                f"FROM {table_name}{where} GROUP BY YEAR(Record_Date), MONTH(Record_Date) "
+                f"ORDER BY Year, Month;", 'aggregate_by_month')
+    if group_column.lower() not in columns:
+        return None, None
+    group_column = columns[group_column.lower()]
+    return (f"SELECT {group_column}, {function}({measure}) FROM {table_name}{where} "
+            f"GROUP BY {group_column} ORDER BY {group_column};", f"aggregate_by_{group_column.lower()}")
+
+def template_lookup(natural_query, snapshot):
+    """template_sql with per-template hit counting"""
+    if not TEMPLATE_CONFIG['enabled']:
+        return None, None
+    sql_query, name = template_sql(natural_query, snapshot)
+    with template_stats_lock:
+        template_stats['lookups'] += 1
+        if name:
+            template_stats['hits'][name] = template_stats['hits'].get(name, 0) + 1
+    if name:
+        logger.info(f"Template '{name}' matched: {sql_query}")
+    return sql_query, name
+
+def template_stats_snapshot():
+    with template_stats_lock:
+        lookups = template_stats['lookups']
+        hits = dict(template_stats['hits'])
+    return {
+        'lookups': lookups,
+        'hits': sum(hits.values()),
+        'hit_rate': sum(hits.values()) / lookups if lookups else 0.0,
+        'templates': {
+            name: {'hits': count, 'hit_rate': count / lookups}
+            for name, count in sorted(hits.items(), key=lambda item: -item[1])
+        }
+    }
+
+# Core processing function
+def sql_cache_lookup(natural_query):
+    """Return (schema_snapshot, cache_key, cached_sql) for a question, cached_sql is None on a miss"""
+    snapshot = db_get_schema_snapshot()
+    cache_key = sql_cache_key(natural_query, snapshot['fingerprint'])
+    return snapshot, cache_key, sql_cache.get(cache_key)
+
+def resolve_sql(natural_query):
+    """Return (sql, sql_cache_hit, template_name), asking the LLM only when no template matches
+    and the translation isn't cached"""
+    with span('schema'):
+        snapshot = db_get_schema_snapshot()
+    
+    # Templates come first and are never cached, their dates are relative to today
+    with span('template'):
+        template_query, template_name = template_lookup(natural_query, snapshot)
+    if template_query is not None:
+        metrics.inc('queries_total', source='template')
+        return template_query, False, template_name
+    
+    with span('sql_cache'):
+        snapshot, cache_key, sql_query = sql_cache_lookup(natural_query)
+    if sql_query is not None:
+        logger.info(f"SQL cache hit: {sql_query}")
+        metrics.inc('queries_total', source='sql_cache')
+        return sql_query, True, None
+    
+    sql_query = llm_generate_sql(natural_query, snapshot)
+    sql_cache_store(cache_key, sql_query)
+    metrics.inc('queries_total', source='llm')
+    return sql_query, False, None
+
+def repairable(results):
+    return (results.get('error_code') in REPAIR_CONFIG['error_codes']
+            or results.get('rejected') in REPAIR_CONFIG['rejections'])
+
+def statement_rejected(results):
+    """Whether a failure was caused by the statement itself rather than a timeout or the connection"""
+    return not results['success'] and (results.get('error_code') is not None or repairable(results))
+
+def execute_with_repair(natural_query, sql_query, run, cacheable=True):
+    """Run sql_query through run(executed_sql) -> results and, when MySQL rejects it, have the model fix it.
+    
+    Returns (sql, executed_sql, results, repair), repair is None when the first attempt didn't
+    need fixing. Repairs stop after REPAIR_CONFIG['max_attempts'] follow-up prompts or when the
+    time budget runs out. A repaired translation replaces the cached one, one that validation or
+    MySQL still rejects is dropped from the SQL cache.
+    """
+    snapshot = db_get_schema_snapshot()
+    with span('rollup_route'):
+        executed_sql = rollup_route(sql_query)
+    results = sql_check(sql_query, snapshot) or run(executed_sql)
+    if results['success'] or not repairable(results):
+        if cacheable and statement_rejected(results):
+            sql_cache.pop(sql_cache_key(natural_query, snapshot['fingerprint']))
+        return sql_query, executed_sql, results, None
+    
+    started = time.monotonic()
+    repair = {'original_sql': sql_query, 'errors': [], 'attempts': 0, 'repaired': False}
+    while not results['success'] and repairable(results) and repair['attempts'] < REPAIR_CONFIG['max_attempts']:
+        remaining = REPAIR_CONFIG['time_budget_seconds'] - (time.monotonic() - started)
+        if remaining < REPAIR_CONFIG['min_attempt_seconds']:
+            break
+        repair['errors'].append(results['error'])
+        repair['attempts'] += 1
+        metrics.inc('sql_repair_attempts_total')
+        try:
+            sql_query = llm_repair_sql(natural_query, sql_query, results['error'], snapshot, remaining)
+        except (requests.RequestException, ValueError, KeyError) as e:
+            logger.warning(f"SQL repair attempt {repair['attempts']} failed: {e}")
+            break
+        with span('rollup_route'):
+            executed_sql = rollup_route(sql_query)
+        results = sql_check(sql_query, snapshot) or run(executed_sql)
+    
+    repair['repaired'] = results['success']
+    metrics.inc('sql_repairs_total', outcome='repaired' if results['success'] else 'failed')
+    if cacheable:
+        cache_key = sql_cache_key(natural_query, snapshot['fingerprint'])
+        if results['success']:
+            sql_cache_store(cache_key, sql_query)
+        else:
+            sql_cache.pop(cache_key)
+    
+    repaired = metrics.value('sql_repairs_total', outcome='repaired')
+    total = repaired + metrics.value('sql_repairs_total', outcome='failed')
+    logger.info(f"SQL repair {'succeeded' if results['success'] else 'failed'} after {repair['attempts']} "
+                f"attempt(s) in {time.monotonic() - started:.2f}s, {repaired}/{total} repairs successful so far")
+    return sql_query, executed_sql, results, repair
+
+def stream_attempt(chunk_size):
+    """run() for execute_with_repair that starts streaming a statement.
+    
+    The statement is executed and its column names read, so errors still reach the repair
+    loop; the rows are left in the result's 'batches' generator.
+    """
+    def run(sql):
+        batches = db_iter_results(sql, chunk_size, STREAM_CONFIG['max_rows'])
+        try:
+            columns = next(batches)
+        except (mysql.connector.Error, RuntimeError, QueryRejected) as e:
+            batches.close()
+            logger.error(f"Query execution failed: {e}")
+            result = guard_error_result(e)
+            metrics.inc('errors_total', stage=result.get('rejected') or 'database')
+            return result
+        return {"success": True, "columns": columns, "batches": batches}
+    return run
+
+def process_natural_query(natural_query, page_size=None, include_timings=False):
+    """Answer a question; with include_timings the response gets per-stage milliseconds"""
+    span_state.timings = timings = {}
+    try:
+        with span('total'):
+            # Get database schema and reuse an earlier translation of the same question
+            sql_query, sql_cache_hit, template_name = resolve_sql(natural_query)
+            
+            # Execute SQL query, only the first page of it when paginating
+            if page_size:
+                run = lambda sql: db_fetch_page(sql, page_size)
+            else:
+                run = db_execute_query
+            sql_query, executed_sql, results, repair = execute_with_repair(
+                natural_query, sql_query, run, cacheable=template_name is None
+            )
         
-        return {
+        response = {
             "natural_query": natural_query,
             "generated_sql": sql_query,
+            "executed_sql": executed_sql,
+            "sql_cache_hit": sql_cache_hit,
+            "template": template_name,
             "results": results
         }
+        if repair:
+            response["repair"] = repair
     
     except Exception as e:
         logger.error(f"Query processing failed: {e}")
-        return {
+        metrics.inc('errors_total', stage='query')
+        response = {
             "natural_query": natural_query,
             "error": str(e),
             "success": False
         }
+    finally:
+        span_state.timings = None
+    
+    if include_timings:
+        response["timings"] = timings
+    return response
+
+def process_page_cursor(token):
+    """Fetch a follow-up page, the SQL comes from the cursor so the LLM is skipped"""
+    try:
+        page_cursor = decode_page_cursor(token)
+        results = db_fetch_page(page_cursor['sql'], page_cursor['size'], page_cursor['key'], page_cursor['after'])
+        return {
+            "generated_sql": page_cursor['sql'],
+            "results": results
+        }
+    except Exception as e:
+        logger.error(f"Page fetch failed: {e}")
+        return {
+            "error": str(e),
+            "success": False
+        }
 
-# Initialize database connection
-db_connect()
+def batch_generate(pending, snapshot):
+    """Translate a group of (question, sql_cache_key) pairs, returns (question, sql_or_exception, seconds) tuples"""
+    started = time.perf_counter()
+    outcomes = None
+    if len(pending) > 1:
+        try:
+            prompts = ["\n\n".join(message['content'] for message in llm_build_payload(natural_query, snapshot)['messages'])
+                       for natural_query, _ in pending]
+            outcomes = []
+            for text in llm_complete_batch(prompts):
+                try:
+                    outcomes.append(clean_sql(text))
+                except ValueError as e:
+                    outcomes.append(e)
+        except (requests.RequestException, ValueError, KeyError) as e:
+            # The server doesn't take prompt lists, ask one question at a time instead
+            logger.warning(f"Batched generation failed, falling back to single requests: {e}")
+            outcomes = None
+    
+    if outcomes is None:
+        outcomes = []
+        for natural_query, _ in pending:
+            try:
+                outcomes.append(llm_generate_sql(natural_query, snapshot))
+            except Exception as e:
+                outcomes.append(e)
+    
+    elapsed = time.perf_counter() - started
+    for (_, cache_key), sql_query in zip(pending, outcomes):
+        if not isinstance(sql_query, Exception):
+            sql_cache_store(cache_key, sql_query)
+    return [(natural_query, sql_query, elapsed) for (natural_query, _), sql_query in zip(pending, outcomes)]
+
+def batch_execute(item, batch_started):
+    """Run one item's SQL; anything raised is recorded on the item like a generation error"""
+    started = time.perf_counter()
+    try:
+        item['generated_sql'], item['executed_sql'], item['results'], repair = execute_with_repair(
+            item['natural_query'], item['generated_sql'], db_execute_query, cacheable=item.get('template') is None
+        )
+        if repair:
+            item['repair'] = repair
+    except Exception as e:
+        logger.error(f"Batch query execution failed: {e}")
+        metrics.inc('errors_total', stage='query')
+        item.update(error=str(e), success=False)
+    item['timings']['execute_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    item['timings']['total_ms'] = round((time.perf_counter() - batch_started) * 1000, 1)
+
+def process_batch(natural_queries):
+    """Answer several questions at once: duplicates are answered once, SQL is generated with bounded
+    LLM concurrency and each statement runs as soon as its SQL is ready"""
+    batch_started = time.perf_counter()
+    unique = list(dict.fromkeys(natural_queries))
+    items = {natural_query: {'natural_query': natural_query, 'timings': {}} for natural_query in unique}
+    snapshot = db_get_schema_snapshot()
+    db_futures = []
+    
+    def execute_when_ready(item, sql_query, seconds):
+        item['timings']['generate_ms'] = round(seconds * 1000, 1)
+        if isinstance(sql_query, Exception):
+            item.update(generated_sql=None, error=str(sql_query), success=False)
+            item['timings']['total_ms'] = round((time.perf_counter() - batch_started) * 1000, 1)
+            return
+        item['generated_sql'] = sql_query
+        db_futures.append(batch_db_executor.submit(batch_execute, item, batch_started))
+    
+    # Templates and cached translations need no LLM call
+    pending = []
+    for natural_query in unique:
+        item = items[natural_query]
+        if not natural_query:
+            execute_when_ready(item, ValueError("Query cannot be empty"), 0.0)
+            continue
+        started = time.perf_counter()
+        sql_query, template_name = template_lookup(natural_query, snapshot)
+        cache_key = None
+        if sql_query is None:
+            _, cache_key, sql_query = sql_cache_lookup(natural_query)
+        item.update(sql_cache_hit=template_name is None and sql_query is not None, template=template_name)
+        if sql_query is None:
+            pending.append((natural_query, cache_key))
+        else:
+            execute_when_ready(item, sql_query, time.perf_counter() - started)
+    
+    group = max(1, BATCH_CONFIG['llm_prompts_per_request'])
+    llm_futures = [batch_llm_executor.submit(batch_generate, pending[i:i + group], snapshot)
+                   for i in range(0, len(pending), group)]
+    for future in as_completed(llm_futures):
+        for natural_query, sql_query, seconds in future.result():
+            execute_when_ready(items[natural_query], sql_query, seconds)
+    wait(db_futures)
+    
+    first_index = {}
+    results = []
+    for index, natural_query in enumerate(natural_queries):
+        if natural_query in first_index:
+            results.append(dict(items[natural_query], duplicate_of=first_index[natural_query]))
+        else:
+            first_index[natural_query] = index
+            results.append(items[natural_query])
+    
+    logger.info(f"Batch of {len(natural_queries)} questions ({len(unique)} unique, {len(pending)} sent to the LLM) "
+                f"answered in {time.perf_counter() - batch_started:.2f}s")
+    return {
+        "results": results,
+        "question_count": len(natural_queries),
+        "unique_count": len(unique),
+        "llm_count": len(pending),
+        "elapsed_ms": round((time.perf_counter() - batch_started) * 1000, 1)
+    }
+
+def json_default(value):
+    if isinstance(value, (datetime, date, dt_time)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, timedelta):
+        return str(value)
+    if isinstance(value, (bytes, bytearray)):
+        return value.decode('utf-8', errors='replace')
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def columnar_results(results):
+    """Results with one array per column instead of one per row"""
+    columns = results['columns']
+    data = [list(values) for values in zip(*results['rows'])] if results['rows'] else [[] for _ in columns]
+    columnar = {key: value for key, value in results.items() if key != 'rows'}
+    columnar['data'] = data
+    return columnar
+
+def arrow_ipc_stream(response):
+    """Serialize a query response's rows as an Arrow IPC stream, the rest goes in the schema metadata"""
+    results = response['results']
+    arrays = []
+    for values in columnar_results(results)['data']:
+        try:
+            arrays.append(pa.array(values))
+        except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError):
+            # Mixed types in one column, fall back to their text form
+            arrays.append(pa.array([None if value is None else json_default_text(value) for value in values]))
+    
+    metadata = {key: value for key, value in response.items() if key != 'results'}
+    metadata['results'] = {key: value for key, value in results.items() if key != 'rows'}
+    table = pa.Table.from_arrays(arrays, names=results['columns'])
+    table = table.replace_schema_metadata({'query': json.dumps(metadata, default=json_default)})
+    
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+def json_default_text(value):
+    if isinstance(value, str):
+        return value
+    try:
+        return str(json_default(value))
+    except TypeError:
+        return str(value)
+
+def encode_query_response(response, result_format):
+    """Render a /query response in the negotiated format, errors always go out as JSON"""
+    results = response.get('results') or {}
+    if result_format == 'json' or not results.get('success') or 'rows' not in results:
+        return jsonify(response)
+    
+    if result_format == 'arrow':
+        return Response(arrow_ipc_stream(response), mimetype=RESULT_MIMETYPES['arrow'])
+    
+    columnar = dict(response, results=columnar_results(results))
+    if result_format == 'msgpack':
+        return Response(msgpack.packb(columnar, default=json_default), mimetype=RESULT_MIMETYPES['msgpack'])
+    return Response(json.dumps(columnar, default=json_default), mimetype=RESULT_MIMETYPES['columnar'])
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, default=json_default)}\n\n"
+
+def stream_natural_query(natural_query, page_size=None):
+    """Same pipeline as process_natural_query, emitted as server-sent events as each stage progresses"""
+    batches = None
+    try:
+        yield sse_event('status', {'stage': 'generating'})
+        sql_query, template_name = template_lookup(natural_query, db_get_schema_snapshot())
+        sql_cache_hit = False
+        if sql_query is None:
+            snapshot, cache_key, sql_query = sql_cache_lookup(natural_query)
+            sql_cache_hit = sql_query is not None
+        
+        if sql_query is None:
+            parts = []
+            for token in llm_stream_sql(natural_query, snapshot):
+                parts.append(token)
+                yield sse_event('sql_token', {'token': token})
+            sql_query = clean_sql(''.join(parts).strip())
+            logger.info(f"Generated SQL: {sql_query}")
+            sql_cache_store(cache_key, sql_query)
+        
+        executed_sql = rollup_route(sql_query)
+        yield sse_event('sql', {'sql': sql_query, 'executed_sql': executed_sql,
+                                'sql_cache_hit': sql_cache_hit, 'template': template_name})
+        yield sse_event('status', {'stage': 'executing'})
+        
+        if page_size:
+            run = lambda sql: db_fetch_page(sql, page_size)
+        else:
+            run = stream_attempt(STREAM_CONFIG['row_chunk_size'])
+        repaired_sql, executed_sql, results, repair = execute_with_repair(
+            natural_query, sql_query, run, cacheable=template_name is None
+        )
+        if repair and repair['repaired']:
+            yield sse_event('sql', {'sql': repaired_sql, 'executed_sql': executed_sql,
+                                    'sql_cache_hit': sql_cache_hit, 'template': template_name, 'repair': repair})
+        if not results['success']:
+            raise RuntimeError(results['error'])
+        next_cursor = results.get('next_cursor')
+        if page_size:
+            batches = iter_result_chunks(results['columns'], results['rows'], STREAM_CONFIG['row_chunk_size'])
+            next(batches)
+        else:
+            batches = results['batches']
+        
+        yield sse_event('columns', {'columns': results['columns']})
+        row_count = 0
+        for rows in batches:
+            row_count += len(rows)
+            yield sse_event('rows', {'rows': rows})
+        yield sse_event('done', {'row_count': row_count, 'next_cursor': next_cursor})
+    
+    except Exception as e:
+        logger.error(f"Streaming query failed: {e}")
+        yield sse_event('error', {'error': str(e)})
+    finally:
+        if batches is not None:
+            batches.close()
+
+def stream_ndjson(header, batches):
+    """Newline-delimited JSON: a header object, one array per row, then a summary object"""
+    row_count = 0
+    try:
+        yield json.dumps(header, default=json_default) + "\n"
+        for rows in batches:
+            row_count += len(rows)
+            yield "".join(json.dumps(row, default=json_default) + "\n" for row in rows)
+        yield json.dumps({
+            "row_count": row_count,
+            "row_limit_reached": row_count >= STREAM_CONFIG['max_rows']
+        }) + "\n"
+    except Exception as e:
+        logger.error(f"NDJSON streaming failed: {e}")
+        yield json.dumps({"error": str(e), "row_count": row_count}) + "\n"
+    finally:
+        batches.close()
+
+# Startup
+def app_startup():
+    """Open the pools and start the background threads of a serving process"""
+    # Initialize database connection pool, closed only when the process exits
+    db_pool_init()
+    atexit.register(db_pool_close)
+    
+    # Warm the SQL cache from disk and write it back on exit
+    sql_cache_load()
+    atexit.register(sql_cache_save)
+    
+    # Introspect the schema in the background so the first query doesn't pay for it
+    schema_start_refresher()
+    atexit.register(schema_refresh_stop.set)
+    
+    # Health-probe the LLM backends so an open circuit closes once its server recovers
+    llm_start_prober()
+    atexit.register(llm_probe_stop.set)
+
+def app_preload():
+    """Pre-fork master setup: build the schema snapshot once for every worker to inherit.
+    
+    Starts no threads and closes every connection it opened, so nothing unsafe crosses the fork.
+    """
+    try:
+        with schema_build_lock:
+            schema_install(db_build_schema_snapshot(), warm_up=False)
+        if PROMPT_CONFIG['stable_prefix'] and PROMPT_CONFIG['warm_up']:
+            llm_warm_prefix(schema_snapshot)
+    except Exception as e:
+        logger.error(f"Preloading the schema failed, workers will build it themselves: {e}")
+    finally:
+        db_pool_close()
+        llm_pool.reset()
+    # Keep the inherited objects out of the collector so it doesn't write to their shared pages
+    gc.freeze()
+
+def app_post_fork():
+    """Worker setup after a fork from app_preload's process"""
+    global db_pool, schema_refresher, llm_prober, table_versions_checked
+    db_pool = None
+    schema_refresher = None
+    llm_prober = None
+    table_versions_checked = 0.0
+    llm_pool.reset()
+    app_startup()
+
+# A pre-fork server (see gunicorn.conf.py) sets this and calls app_post_fork in each worker instead
+if not os.environ.get('ENERGY_ASSISTANT_DEFER_STARTUP'):
+    app_startup()
 
 # Flask Application
 app = Flask(__name__)
 
 @app.route('/')
-def index():
+def index(streaming=True):
+    """The query page; streaming=False makes it use paged /query instead of /query/stream"""
     return '''<!DOCTYPE html>
 <html lang="en">
 <head>
@@ -555,6 +3263,10 @@ def index():
             document.getElementById('queryInput').value = query;
         }
 
+        const PAGE_SIZE = 200;
+        const STREAMING = ''' + ('true' if streaming else 'false') + ''';
+        let activeStream = null;
+
         function executeQuery() {
             const query = document.getElementById('queryInput').value.trim();
             if (!query) {
@@ -562,6 +3274,11 @@ def index():
                 return;
             }
 
+            if (STREAMING && window.EventSource) {
+                streamQuery(query);
+                return;
+            }
+
             showLoading(true);
             
             fetch('/query', {
@@ -569,7 +3286,7 @@ def index():
                 headers: {
                     'Content-Type': 'application/json',
                 },
-                body: JSON.stringify({ query: query })
+                body: JSON.stringify({ query: query, page_size: PAGE_SIZE })
             })
             .then(response => response.json())
             .then(data => {
@@ -582,6 +3299,140 @@ def index():
             });
         }
 
+        function streamQuery(query) {
+            if (activeStream) {
+                activeStream.close();
+            }
+            showLoading(false);
+
+            const content = document.getElementById('resultsContent');
+            content.innerHTML = `
+                <div class="stats"><div class="stat-item" id="streamStatus">Generating SQL...</div></div>
+                <div class="sql-display" id="streamSql"></div>
+                <div id="streamTable"></div>
+            `;
+            const status = document.getElementById('streamStatus');
+            const sqlBox = document.getElementById('streamSql');
+            const tableBox = document.getElementById('streamTable');
+            let tbody = null;
+
+            const source = new EventSource(
+                '/query/stream?query=' + encodeURIComponent(query) + '&page_size=' + PAGE_SIZE
+            );
+            activeStream = source;
+
+            source.addEventListener('sql_token', e => {
+                sqlBox.textContent += JSON.parse(e.data).token;
+            });
+            source.addEventListener('sql', e => {
+                sqlBox.textContent = JSON.parse(e.data).sql;
+            });
+            source.addEventListener('status', e => {
+                const stage = JSON.parse(e.data).stage;
+                status.textContent = stage === 'executing' ? 'Running query...' : 'Generating SQL...';
+            });
+            source.addEventListener('columns', e => {
+                tbody = createResultTable(tableBox, JSON.parse(e.data).columns);
+            });
+            source.addEventListener('rows', e => {
+                appendRows(tbody, JSON.parse(e.data).rows);
+                status.innerHTML = `<span class="stat-value">${tbody.rows.length}</span> rows received...`;
+            });
+            source.addEventListener('done', e => {
+                source.close();
+                const nextCursor = JSON.parse(e.data).next_cursor;
+                showRowCount(status, tbody.rows.length, !!nextCursor);
+                loadPagesOnScroll(tableBox, tbody, nextCursor, more => showRowCount(status, tbody.rows.length, more));
+            });
+            source.addEventListener('error', e => {
+                source.close();
+                // Named error events carry a message, transport errors don't
+                const message = e.data ? JSON.parse(e.data).error : 'Stream interrupted';
+                content.insertAdjacentHTML('afterbegin', '<div class="error"></div>');
+                content.querySelector('.error').textContent = 'Error: ' + message;
+            });
+        }
+
+        function createResultTable(container, columns) {
+            const table = document.createElement('table');
+            table.className = 'data-table';
+            const headRow = table.createTHead().insertRow();
+            columns.forEach(col => {
+                const th = document.createElement('th');
+                th.textContent = col;
+                headRow.appendChild(th);
+            });
+            container.appendChild(table);
+            return table.createTBody();
+        }
+
+        function appendRows(tbody, rows) {
+            const fragment = document.createDocumentFragment();
+            rows.forEach(row => {
+                const tr = document.createElement('tr');
+                row.forEach(cell => {
+                    const td = document.createElement('td');
+                    td.textContent = cell !== null ? cell : 'NULL';
+                    tr.appendChild(td);
+                });
+                fragment.appendChild(tr);
+            });
+            tbody.appendChild(fragment);
+        }
+
+        function showRowCount(status, count, more) {
+            status.innerHTML = `<span class="stat-value">${count}</span> ${more ? 'rows loaded, scroll for more' : 'rows returned'}`;
+        }
+
+        // Fetch the next keyset page whenever the end of the table scrolls into view
+        function loadPagesOnScroll(container, tbody, nextCursor, onPage) {
+            if (!nextCursor) {
+                return;
+            }
+            const sentinel = document.createElement('div');
+            container.appendChild(sentinel);
+            let loading = false;
+
+            const observer = new IntersectionObserver(entries => {
+                if (!entries[0].isIntersecting || loading) {
+                    return;
+                }
+                loading = true;
+                fetch('/query', {
+                    method: 'POST',
+                    headers: {
+                        'Content-Type': 'application/json',
+                    },
+                    body: JSON.stringify({ cursor: nextCursor })
+                })
+                .then(response => response.json())
+                .then(data => {
+                    const page = data.results;
+                    if (!page || !page.success) {
+                        throw new Error(data.error || (page && page.error) || 'Unknown error');
+                    }
+                    appendRows(tbody, page.rows);
+                    nextCursor = page.next_cursor;
+                    onPage(!!nextCursor);
+                    loading = false;
+                    if (nextCursor) {
+                        // Re-observe so a sentinel that is still visible triggers the next page
+                        observer.unobserve(sentinel);
+                        observer.observe(sentinel);
+                    } else {
+                        observer.disconnect();
+                        sentinel.remove();
+                    }
+                })
+                .catch(error => {
+                    observer.disconnect();
+                    sentinel.className = 'error';
+                    sentinel.textContent = 'Loading more rows failed: ' + error.message;
+                });
+            }, { rootMargin: '400px' });
+            observer.observe(sentinel);
+        }
+
         function showSchema() {
             showLoading(true);
             
@@ -610,16 +3461,15 @@ def index():
             const content = document.getElementById('resultsContent');
             
             if (data.error) {
-                content.innerHTML = `<div class="error">Error: ${data.error}</div>`;
+                displayError('Error: ' + data.error);
                 return;
             }
 
-            let html = '';
-            
+            content.innerHTML = '';
 
             if (data.results) {
                 if (data.results.success) {
-                    html += `
+                    content.innerHTML = `
                         <div class="stats">
                             <div class="stat-item">
                                 <span class="stat-value">${data.results.row_count || data.results.affected_rows || 0}</span>
@@ -629,42 +3479,40 @@ def index():
                     `;
 
                     if (data.results.rows && data.results.rows.length > 0) {
-                        html += '<h4>Results:</h4>';
-                        html += '<table class="data-table"><thead><tr>';
-                        
-                        data.results.columns.forEach(col => {
-                            html += `<th>${col}</th>`;
-                        });
-                        html += '</tr></thead><tbody>';
-                        
-                        data.results.rows.forEach(row => {
-                            html += '<tr>';
-                            row.forEach(cell => {
-                                html += `<td>${cell !== null ? cell : 'NULL'}</td>`;
-                            });
-                            html += '</tr>';
-                        });
-                        html += '</tbody></table>';
+                        const status = content.querySelector('.stat-item');
+                        content.insertAdjacentHTML('beforeend', '<h4>Results:</h4>');
+                        // Rows are added as DOM nodes page by page rather than as one big HTML string
+                        const tbody = createResultTable(content, data.results.columns);
+                        appendRows(tbody, data.results.rows);
+                        showRowCount(status, tbody.rows.length, !!data.results.next_cursor);
+                        loadPagesOnScroll(content, tbody, data.results.next_cursor, more => showRowCount(status, tbody.rows.length, more));
                     }
+                    if (data.results.limit_applied) {
+                        content.querySelector('.stat-item').insertAdjacentText('beforeend', ` (first ${data.results.limit_applied} only, add a LIMIT or filters to change this)`);
+                    }
+                } else if (data.results.rejected) {
+                    displayError(data.results.error);
                 } else {
-                    html += `<div class="error">SQL Error: ${data.results.error}</div>`;
+                    displayError('SQL Error: ' + data.results.error);
                 }
             }
-
-            content.innerHTML = html;
         }
 
         function displaySchema(schema) {
             const content = document.getElementById('resultsContent');
             content.innerHTML = `
                 <h4>Database Schema:</h4>
-                <div class="sql-display">${schema.replace(/\\n/g, '<br>')}</div>
+                <div class="sql-display" style="white-space: pre-wrap"></div>
             `;
+            // Sample rows come from the database, so the schema is inserted as text
+            content.querySelector('.sql-display').textContent = schema;
         }
 
+        // Error messages can quote model-generated SQL, never parse them as HTML
         function displayError(error) {
             const content = document.getElementById('resultsContent');
-            content.innerHTML = `<div class="error">${error}</div>`;
+            content.innerHTML = '<div class="error"></div>';
+            content.firstChild.textContent = error;
         }
 
         // Allow Enter key to submit query
@@ -681,30 +3529,215 @@ def index():
 def query():
     try:
         data = request.get_json()
+        
+        result_format = negotiate_format(data)
+        
+        # Follow-up pages carry their SQL in the cursor and skip the LLM
+        if data.get('cursor'):
+            if result_format == 'ndjson':
+                page_formats = ', '.join(name for name in RESULT_MIMETYPES if name != 'ndjson')
+                raise ValueError(f"Format 'ndjson' isn't available for page requests, use one of {page_formats}")
+            return encode_query_response(process_page_cursor(data['cursor']), result_format)
+        
         natural_query = data.get('query', '').strip()
         
         if not natural_query:
             return jsonify({'error': 'Query cannot be empty'}), 400
         
-        result = process_natural_query(natural_query)
-        return jsonify(result)
+        if result_format == 'ndjson':
+            return query_ndjson(natural_query)
+        
+        page_size = parse_page_size(data.get('page_size'))
+        result = process_natural_query(natural_query, page_size, bool(data.get('timings')))
+        with span('serialize'):
+            return encode_query_response(result, result_format)
     
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except FormatUnavailable as e:
+        return jsonify({'error': str(e)}), 406
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/query/batch', methods=['POST'])
+def query_batch():
+    """Answer a list of questions concurrently, results in request order"""
+    try:
+        data = request.get_json() or {}
+        queries = data.get('queries')
+        if not isinstance(queries, list) or not queries:
+            return jsonify({'error': "'queries' must be a non-empty list of questions"}), 400
+        if len(queries) > BATCH_CONFIG['max_questions']:
+            return jsonify({'error': f"At most {BATCH_CONFIG['max_questions']} questions per batch"}), 400
+        
+        return jsonify(process_batch([str(natural_query).strip() for natural_query in queries]))
+    
+    except Exception as e:
+        logger.error(f"Batch processing failed: {e}")
+        return jsonify({'error': str(e)}), 500
+
+def parse_page_size(value):
+    if value in (None, ''):
+        return None
+    try:
+        page_size = int(value)
+    except (TypeError, ValueError):
+        raise ValueError("page_size must be an integer")
+    if not 1 <= page_size <= PAGINATION_CONFIG['max_page_size']:
+        raise ValueError(f"page_size must be between 1 and {PAGINATION_CONFIG['max_page_size']}")
+    return page_size
+
+class FormatUnavailable(Exception):
+    """A known result format whose encoder package isn't installed, answered with 406"""
+
+def negotiate_format(data):
+    """Result format from the 'format' field or the Accept header.
+    
+    ValueError for an unknown format, FormatUnavailable for one this server can't produce.
+    """
+    result_format = data.get('format')
+    if not result_format:
+        by_mimetype = {mimetype: name for name, mimetype in RESULT_MIMETYPES.items()}
+        best = request.accept_mimetypes.best_match(list(by_mimetype), default=RESULT_MIMETYPES['json'])
+        result_format = by_mimetype[best]
+    
+    if result_format not in RESULT_MIMETYPES:
+        raise ValueError(f"Unknown format '{result_format}', use one of {', '.join(RESULT_MIMETYPES)}")
+    if (result_format == 'msgpack' and msgpack is None) or (result_format == 'arrow' and pa is None):
+        raise FormatUnavailable(f"Format '{result_format}' needs the {'msgpack' if result_format == 'msgpack' else 'pyarrow'} package")
+    return result_format
+
+@app.after_request
+def compress_response(response):
+    """zstd or gzip encode buffered responses above the size threshold, streams are left alone"""
+    if (response.direct_passthrough or response.is_streamed or 'Content-Encoding' in response.headers
+            or not 200 <= response.status_code < 300):
+        return response
+    
+    body = response.get_data()
+    if len(body) < ENCODING_CONFIG['compress_min_bytes']:
+        return response
+    
+    accepted = request.accept_encodings
+    if zstandard is not None and accepted.quality('zstd') > 0:
+        body = zstandard.ZstdCompressor(level=ENCODING_CONFIG['zstd_level']).compress(body)
+        encoding = 'zstd'
+    elif accepted.quality('gzip') > 0:
+        body = gzip.compress(body, compresslevel=ENCODING_CONFIG['gzip_level'])
+        encoding = 'gzip'
+    else:
+        return response
+    
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+def query_ndjson(natural_query):
+    """Stream a large result as NDJSON, reading it from MySQL in fixed-size batches"""
+    try:
+        sql_query, sql_cache_hit, template_name = resolve_sql(natural_query)
+        # Run the query before committing to a streamed 200 so SQL errors still get a JSON error
+        sql_query, executed_sql, results, repair = execute_with_repair(
+            natural_query, sql_query, stream_attempt(STREAM_CONFIG['ndjson_batch_size']),
+            cacheable=template_name is None
+        )
+        if not results['success']:
+            raise RuntimeError(results['error'])
+    except Exception as e:
+        logger.error(f"Query processing failed: {e}")
+        return jsonify({'natural_query': natural_query, 'error': str(e), 'success': False})
+    
+    header = {
+        'natural_query': natural_query,
+        'generated_sql': sql_query,
+        'executed_sql': executed_sql,
+        'sql_cache_hit': sql_cache_hit,
+        'template': template_name,
+        'columns': results['columns']
+    }
+    if repair:
+        header['repair'] = repair
+    return Response(stream_with_context(stream_ndjson(header, results['batches'])), mimetype='application/x-ndjson')
+
+@app.route('/query/stream', methods=['GET', 'POST'])
+def query_stream():
+    """Stream SQL tokens, execution status and result rows as server-sent events"""
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+    else:
+        data = request.args
+    natural_query = data.get('query', '').strip()
+    
+    if not natural_query:
+        return jsonify({'error': 'Query cannot be empty'}), 400
+    
+    try:
+        page_size = parse_page_size(data.get('page_size'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return Response(
+        stream_with_context(stream_natural_query(natural_query, page_size)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/cache/stats')
+def cache_stats():
+    """Hit/miss counters for the query caches"""
+    return jsonify({
+        'sql_cache': sql_cache.stats(),
+        'result_cache': result_cache.stats(),
+        'sql_templates': template_stats_snapshot()
+    })
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape target: stage latency histograms, counters and cache gauges"""
+    gauges = []
+    for cache_name, cache in (('sql_cache', sql_cache), ('result_cache', result_cache)):
+        for stat, value in cache.stats().items():
+            gauges.append((f"{cache_name}_{stat}", {}, value))
+    templates = template_stats_snapshot()
+    gauges.append(('template_lookups', {}, templates['lookups']))
+    for name, template in templates['templates'].items():
+        gauges.append(('template_hits', {'template': name}, template['hits']))
+    for backend in llm_pool.stats():
+        gauges.append(('llm_backend_outstanding', {'backend': backend['url']}, backend['outstanding']))
+        gauges.append(('llm_backend_open', {'backend': backend['url']}, int(backend['open'])))
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+@app.route('/metrics/summary')
+def metrics_summary():
+    """p50/p95/p99 per stage in milliseconds over the recent window, as JSON"""
+    return jsonify(metrics.summary('stage_duration_seconds'))
+
 @app.route('/schema')
 def schema():
     """Get database schema for reference"""
     try:
-        schema = db_get_schema()
-        return jsonify({'schema': schema})
+        snapshot = db_get_schema_snapshot()
+        return jsonify({
+            'schema': snapshot['text'],
+            'fingerprint': snapshot['fingerprint'],
+            'built_at': snapshot['built_at']
+        })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.teardown_appcontext
-def cleanup(error):
-    """Clean up resources when app shuts down"""
-    db_close()
+@app.route('/schema/refresh', methods=['POST'])
+def schema_refresh_now():
+    """Re-introspect the schema on demand, e.g. after a migration"""
+    try:
+        snapshot = schema_refresh()
+        return jsonify({
+            'fingerprint': snapshot['fingerprint'],
+            'tables': list(snapshot['tables']),
+            'built_at': snapshot['built_at']
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
 if __name__ == '__main__':
     app.run(debug=True, host='127.0.0.1', port=5000)
\ No newline at end of file
@@ -0,0 +1,476 @@
+"""asyncio serving mode for the energy market assistant.
+
+Serves /, /query and /schema from one event loop: the LLM is called through aiohttp and
+queries run on an aiomysql pool, so a slow generation or query holds a coroutine instead of
+a thread. Identical questions and statements in flight at the same time share one LLM call
+and one execution. Prompts, templates, caches, rollup routing, guards and the LLM backend
+pool's balancing and circuit breakers are shared with webinterface2.
+
+    python webinterface_async.py
+"""
+import asyncio
+import atexit
+import json
+import logging
+import os
+import time
+
+# Only needed to serve, the module imports without them so its functions can be used and tested
+try:
+    from aiohttp import web
+    import aiohttp
+except ImportError:
+    web = aiohttp = None
+try:
+    import aiomysql
+    import pymysql
+except ImportError:
+    aiomysql = pymysql = None
+
+# Import webinterface2 without its serving startup, on_startup starts only the parts used here
+os.environ.setdefault('ENERGY_ASSISTANT_DEFER_STARTUP', '1')
+import webinterface2
+from webinterface2 import (
+    DB_CONFIG, POOL_CONFIG, LLM_CONFIG, GUARD_CONFIG, REPAIR_CONFIG, SHARED_CACHE_CONFIG,
+    LLMUnavailable, QueryRejected, llm_pool, metrics, span,
+    db_get_schema_snapshot, db_table_versions, template_lookup, sql_cache, sql_cache_key, sql_cache_store,
+    llm_build_payload, llm_completion_sql, llm_repair_payload, llm_count_tokens, clean_sql,
+    guard_prepare, guard_evaluate_plan, guard_error_result, sql_check, result_cache_plan, result_cache_get,
+    result_cache_store, rollup_route, repairable, statement_rejected, paginate_key_columns, keyset_condition,
+    keyset_equals, encode_page_cursor, decode_page_cursor, parse_page_size, json_default, index
+)
+
+logger = logging.getLogger(__name__)
+
+ASYNC_CONFIG = {
+    'host': '127.0.0.1',
+    'port': 5001,
+    'db_pool_min': 1,
+    'db_pool_max': 32,              # queries waiting beyond this queue on the pool, not on threads
+    'llm_connections_per_backend': 32
+}
+
+# Errors an LLM call can end with, a failed repair attempt is given up on any of them
+LLM_ERRORS = ((aiohttp.ClientError,) if aiohttp else ()) + (asyncio.TimeoutError, LLMUnavailable, ValueError, KeyError)
+
+# Global state, set up in on_startup
+db_pool = None
+llm_session = None
+inflight = {}
+
+async def cache_call(function, *args):
+    """Run a cache operation, on a worker thread when the shared cache makes it a blocking SQLite call"""
+    if SHARED_CACHE_CONFIG['path']:
+        return await asyncio.to_thread(function, *args)
+    return function(*args)
+
+# Single-flight
+async def single_flight(key, factory):
+    """Await factory() once for all concurrent callers with the same key.
+
+    The shared task is shielded, a caller that disconnects doesn't cancel it for the others.
+    """
+    task = inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(factory())
+        inflight[key] = task
+        task.add_done_callback(lambda _: inflight.pop(key, None))
+    else:
+        metrics.inc('coalesced_requests_total', stage=key[0])
+    return await asyncio.shield(task)
+
+# LLM functions
+async def llm_send(backend, path, payload, timeout):
+    """POST to a backend already claimed from llm_pool, and release it"""
+    started = time.perf_counter()
+    try:
+        async with llm_session.post(f"{backend.url}{path}", json=payload,
+                                    timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            response.raise_for_status()
+            result = await response.json(content_type=None)
+    except asyncio.CancelledError:
+        llm_pool.release(backend, completed=False)
+        raise
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        llm_pool.release(backend, error=e)
+        metrics.inc('llm_requests_total', backend=backend.url, outcome='error')
+        raise
+    llm_pool.release(backend, elapsed=time.perf_counter() - started)
+    metrics.inc('llm_requests_total', backend=backend.url, outcome='ok')
+    return result
+
+async def llm_request(path, payload, timeout):
+    """JSON response from the least busy backend, hedged like LLMPool.request; the losing
+    request is cancelled instead of left running"""
+    primary = llm_pool.acquire()
+    first = asyncio.ensure_future(llm_send(primary, path, payload, timeout))
+    delay = llm_pool.hedge_delay()
+    if delay is None or delay >= timeout:
+        return await first
+    
+    done, _ = await asyncio.wait([first], timeout=delay)
+    if done:
+        return first.result()
+    try:
+        secondary = llm_pool.acquire(exclude=(primary,))
+    except LLMUnavailable:
+        return await first
+    
+    metrics.inc('llm_hedges_total')
+    second = asyncio.ensure_future(llm_send(secondary, path, payload, timeout - delay))
+    pending = {first, second}
+    error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is second:
+                        metrics.inc('llm_hedge_wins_total')
+                    return task.result()
+                error = error or task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+async def llm_generate_sql(natural_query, snapshot, cache_key):
+    payload = llm_build_payload(natural_query, snapshot)
+    try:
+        with span('llm_request'):
+            result = await llm_request("/v1/chat/completions", payload, LLM_CONFIG['timeout_seconds'])
+    except (aiohttp.ClientError, asyncio.TimeoutError, LLMUnavailable) as e:
+        logger.error(f"LLM request failed: {e}")
+        metrics.inc('errors_total', stage='llm')
+        raise
+    sql_query = llm_completion_sql(payload, result)
+    await cache_call(sql_cache_store, cache_key, sql_query)
+    return sql_query
+
+async def llm_repair_sql(natural_query, sql, error, snapshot, timeout):
+    payload = llm_repair_payload(natural_query, sql, error, snapshot)
+    try:
+        with span('llm_repair'):
+            result = await llm_request("/v1/chat/completions", payload, timeout)
+    except (aiohttp.ClientError, asyncio.TimeoutError, LLMUnavailable) as e:
+        logger.error(f"LLM repair request failed: {e}")
+        metrics.inc('errors_total', stage='llm')
+        raise
+    repaired = result["choices"][0]["message"]["content"].strip()
+    llm_count_tokens(payload, repaired, result.get("usage"))
+    return clean_sql(repaired)
+
+# Database functions
+async def schema_snapshot():
+    """Current schema snapshot; the first build runs on a worker thread, off the event loop"""
+    snapshot = webinterface2.schema_snapshot
+    if snapshot is None:
+        snapshot = await asyncio.to_thread(db_get_schema_snapshot)
+    return snapshot
+
+async def db_run_query(sql, limit_added, cache_key, tables, versions):
+    with span('pool_wait'):
+        try:
+            connection = await asyncio.wait_for(db_pool.acquire(), POOL_CONFIG['checkout_timeout'])
+        except asyncio.TimeoutError:
+            raise RuntimeError("Timed out waiting for a database connection")
+    try:
+        async with connection.cursor() as cursor:
+            with span('explain'):
+                await cursor.execute(f"EXPLAIN {sql}")
+                guard_evaluate_plan(sql, [desc[0] for desc in cursor.description], await cursor.fetchall())
+            with span('execute'):
+                await cursor.execute(sql)
+            
+            if not cursor.description:  # Non-SELECT query
+                return {
+                    "success": True,
+                    "affected_rows": cursor.rowcount,
+                    "message": "Query executed successfully"
+                }
+            
+            columns = [desc[0] for desc in cursor.description]
+            with span('fetch'):
+                rows = list(await cursor.fetchall())
+    except (pymysql.err.InterfaceError, pymysql.err.OperationalError):
+        # The connection itself is suspect, closing it makes the pool drop it
+        connection.close()
+        raise
+    finally:
+        db_pool.release(connection)
+    
+    metrics.inc('rows_returned_total', len(rows))
+    result = {
+        "success": True,
+        "columns": columns,
+        "rows": rows,
+        "row_count": len(rows)
+    }
+    if limit_added and len(rows) >= limit_added:
+        result["limit_applied"] = limit_added
+    if cache_key:
+        await cache_call(result_cache_store, cache_key, tables, versions, result)
+    return result
+
+async def db_execute_query(sql):
+    """Same contract as webinterface2.db_execute_query; concurrent runs of one statement share an execution"""
+    try:
+        sql, limit_added = guard_prepare(sql, GUARD_CONFIG['default_limit'], GUARD_CONFIG['max_execution_ms'])
+        cache_key, tables = result_cache_plan(sql)
+        versions = None
+        if cache_key:
+            # Both poll table_versions through the sync pool, at most once per poll interval
+            versions = await asyncio.to_thread(db_table_versions)
+            cached = await asyncio.to_thread(result_cache_get, cache_key)
+            if cached is not None:
+                logger.info("Result cache hit")
+                metrics.inc('rows_returned_total', cached['row_count'])
+                return cached
+        
+        return await single_flight(('execute', sql),
+                                   lambda: db_run_query(sql, limit_added, cache_key, tables, versions))
+    
+    except (pymysql.MySQLError, RuntimeError, QueryRejected) as e:
+        logger.error(f"Query execution failed: {e}")
+        result = guard_error_result(e)
+        metrics.inc('errors_total', stage=result.get('rejected') or 'database')
+        return result
+
+async def db_fetch_page(sql, page_size, key_columns=None, after=None):
+    """Async counterpart of webinterface2.db_fetch_page"""
+    inner = sql.strip().rstrip(';')
+    if key_columns is None:
+        probe = await db_execute_query(f"SELECT * FROM ({inner}) AS page_src LIMIT 0")
+        if probe['success']:
+            key_columns = paginate_key_columns(inner, probe['columns'], await schema_snapshot())
+        if key_columns is None:
+            result = await db_execute_query(sql)
+            return dict(result, next_cursor=None) if result['success'] else result
+    
+    where = f" WHERE {keyset_condition(key_columns, after)}" if after else ""
+    order = ", ".join(f"`{column}`" for column in key_columns)
+    result = await db_execute_query(f"SELECT * FROM ({inner}) AS page_src{where} ORDER BY {order} LIMIT {page_size + 1}")
+    if not result['success']:
+        return result
+    
+    rows = result['rows']
+    next_cursor = None
+    if len(rows) > page_size:
+        key_indexes = [result['columns'].index(column) for column in key_columns]
+        last = [rows[page_size - 1][i] for i in key_indexes]
+        if None in last and [rows[page_size][i] for i in key_indexes] == last:
+            tied = await db_execute_query(f"SELECT * FROM ({inner}) AS page_src WHERE {keyset_equals(key_columns, last)}")
+            if not tied['success']:
+                return tied
+            rows = [row for row in rows[:page_size] if [row[i] for i in key_indexes] != last] + tied['rows']
+        else:
+            rows = rows[:page_size]
+        next_cursor = encode_page_cursor(sql, key_columns, last, page_size)
+    return dict(result, rows=rows, row_count=len(rows), next_cursor=next_cursor)
+
+# Core processing function
+async def resolve_sql(natural_query):
+    """Return (sql, sql_cache_hit, template_name); concurrent misses for one question share an LLM call"""
+    with span('schema'):
+        snapshot = await schema_snapshot()
+    
+    with span('template'):
+        template_query, template_name = template_lookup(natural_query, snapshot)
+    if template_query is not None:
+        metrics.inc('queries_total', source='template')
+        return template_query, False, template_name
+    
+    cache_key = sql_cache_key(natural_query, snapshot['fingerprint'])
+    sql_query = await cache_call(sql_cache.get, cache_key)
+    if sql_query is not None:
+        logger.info(f"SQL cache hit: {sql_query}")
+        metrics.inc('queries_total', source='sql_cache')
+        return sql_query, True, None
+    
+    sql_query = await single_flight(('llm', cache_key), lambda: llm_generate_sql(natural_query, snapshot, cache_key))
+    metrics.inc('queries_total', source='llm')
+    return sql_query, False, None
+
+async def execute_with_repair(natural_query, sql_query, run, cacheable=True):
+    """Async counterpart of webinterface2.execute_with_repair, run is a coroutine function"""
+    snapshot = await schema_snapshot()
+    with span('rollup_route'):
+        # Reads table_versions, which can mean a MySQL round trip
+        executed_sql = await asyncio.to_thread(rollup_route, sql_query)
+    results = sql_check(sql_query, snapshot) or await run(executed_sql)
+    if results['success'] or not repairable(results):
+        if cacheable and statement_rejected(results):
+            await cache_call(sql_cache.pop, sql_cache_key(natural_query, snapshot['fingerprint']))
+        return sql_query, executed_sql, results, None
+    
+    started = time.monotonic()
+    repair = {'original_sql': sql_query, 'errors': [], 'attempts': 0, 'repaired': False}
+    while not results['success'] and repairable(results) and repair['attempts'] < REPAIR_CONFIG['max_attempts']:
+        remaining = REPAIR_CONFIG['time_budget_seconds'] - (time.monotonic() - started)
+        if remaining < REPAIR_CONFIG['min_attempt_seconds']:
+            break
+        repair['errors'].append(results['error'])
+        repair['attempts'] += 1
+        metrics.inc('sql_repair_attempts_total')
+        try:
+            sql_query = await llm_repair_sql(natural_query, sql_query, results['error'], snapshot, remaining)
+        except LLM_ERRORS as e:
+            logger.warning(f"SQL repair attempt {repair['attempts']} failed: {e}")
+            break
+        with span('rollup_route'):
+            executed_sql = await asyncio.to_thread(rollup_route, sql_query)
+        results = sql_check(sql_query, snapshot) or await run(executed_sql)
+    
+    repair['repaired'] = results['success']
+    metrics.inc('sql_repairs_total', outcome='repaired' if results['success'] else 'failed')
+    if cacheable:
+        cache_key = sql_cache_key(natural_query, snapshot['fingerprint'])
+        if results['success']:
+            await cache_call(sql_cache_store, cache_key, sql_query)
+        else:
+            await cache_call(sql_cache.pop, cache_key)
+    logger.info(f"SQL repair {'succeeded' if results['success'] else 'failed'} after {repair['attempts']} attempt(s)")
+    return sql_query, executed_sql, results, repair
+
+async def process_natural_query(natural_query, page_size=None):
+    try:
+        with span('total'):
+            sql_query, sql_cache_hit, template_name = await resolve_sql(natural_query)
+            
+            if page_size:
+                run = lambda sql: db_fetch_page(sql, page_size)
+            else:
+                run = db_execute_query
+            sql_query, executed_sql, results, repair = await execute_with_repair(
+                natural_query, sql_query, run, cacheable=template_name is None
+            )
+        
+        response = {
+            "natural_query": natural_query,
+            "generated_sql": sql_query,
+            "executed_sql": executed_sql,
+            "sql_cache_hit": sql_cache_hit,
+            "template": template_name,
+            "results": results
+        }
+        if repair:
+            response["repair"] = repair
+        return response
+    
+    except Exception as e:
+        logger.error(f"Query processing failed: {e}")
+        metrics.inc('errors_total', stage='query')
+        return {
+            "natural_query": natural_query,
+            "error": str(e),
+            "success": False
+        }
+
+async def process_page_cursor(token):
+    try:
+        page_cursor = decode_page_cursor(token)
+        results = await db_fetch_page(page_cursor['sql'], page_cursor['size'], page_cursor['key'], page_cursor['after'])
+        return {
+            "generated_sql": page_cursor['sql'],
+            "results": results
+        }
+    except Exception as e:
+        logger.error(f"Page fetch failed: {e}")
+        return {
+            "error": str(e),
+            "success": False
+        }
+
+# aiohttp Application
+def json_response(data, status=200):
+    return web.json_response(data, status=status, dumps=lambda value: json.dumps(value, default=json_default))
+
+async def index_page(request):
+    # /query/stream is only served by webinterface2, the page falls back to paged /query
+    page = index(streaming=False)
+    return web.Response(text=page, content_type='text/html')
+
+async def query(request):
+    try:
+        data = await request.json()
+        
+        if data.get('format', 'json') != 'json':
+            return json_response({'error': "This server returns JSON only, other formats are served by webinterface2"}, 406)
+        
+        # Follow-up pages carry their SQL in the cursor and skip the LLM
+        if data.get('cursor'):
+            return json_response(await process_page_cursor(data['cursor']))
+        
+        natural_query = data.get('query', '').strip()
+        if not natural_query:
+            return json_response({'error': 'Query cannot be empty'}, 400)
+        
+        page_size = parse_page_size(data.get('page_size'))
+        result = await process_natural_query(natural_query, page_size)
+        with span('serialize'):
+            return json_response(result)
+    
+    except ValueError as e:
+        return json_response({'error': str(e)}, 400)
+    except Exception as e:
+        return json_response({'error': str(e)}, 500)
+
+async def schema(request):
+    """Get database schema for reference"""
+    try:
+        snapshot = await schema_snapshot()
+        return json_response({
+            'schema': snapshot['text'],
+            'fingerprint': snapshot['fingerprint'],
+            'built_at': snapshot['built_at']
+        })
+    except Exception as e:
+        return json_response({'error': str(e)}, 500)
+
+async def on_startup(app):
+    global db_pool, llm_session
+    # The sync pool behind schema builds and table_versions polls is opened lazily; the
+    # refresher and prober work on their own threads, off the event loop
+    webinterface2.sql_cache_load()
+    atexit.register(webinterface2.sql_cache_save)
+    webinterface2.schema_start_refresher()
+    webinterface2.llm_start_prober()
+    
+    db_pool = await aiomysql.create_pool(
+        host=DB_CONFIG['host'],
+        port=DB_CONFIG['port'],
+        user=DB_CONFIG['user'],
+        password=DB_CONFIG['password'],
+        db=DB_CONFIG['database'],
+        minsize=ASYNC_CONFIG['db_pool_min'],
+        maxsize=ASYNC_CONFIG['db_pool_max'],
+        pool_recycle=POOL_CONFIG['recycle_seconds'],
+        autocommit=True
+    )
+    llm_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=0, limit_per_host=ASYNC_CONFIG['llm_connections_per_backend'])
+    )
+    logger.info(f"Async pools ready: up to {ASYNC_CONFIG['db_pool_max']} MySQL connections, "
+                f"{len(llm_pool.backends)} LLM backend(s)")
+
+async def on_cleanup(app):
+    webinterface2.schema_refresh_stop.set()
+    webinterface2.llm_probe_stop.set()
+    await llm_session.close()
+    db_pool.close()
+    await db_pool.wait_closed()
+    webinterface2.db_pool_close()
+
+def create_app():
+    if web is None or aiomysql is None:
+        raise RuntimeError("The async server needs the aiohttp and aiomysql packages")
+    app = web.Application()
+    app.router.add_get('/', index_page)
+    app.router.add_post('/query', query)
+    app.router.add_get('/schema', schema)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+if __name__ == '__main__':
+    web.run_app(create_app(), host=ASYNC_CONFIG['host'], port=ASYNC_CONFIG['port'])
@@ -0,0 +1,12 @@
+"""WSGI entry point for a pre-fork server, see gunicorn.conf.py"""
+import os
+
+# Pools and background threads are started per worker by app_post_fork, not at import
+os.environ.setdefault('ENERGY_ASSISTANT_DEFER_STARTUP', '1')
+
+import webinterface2
+from webinterface2 import app
+
+__all__ = ['app']
+
+webinterface2.app_preload()